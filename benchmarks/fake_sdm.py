@@ -0,0 +1,169 @@
+import os
+import re
+import sys
+import time
+
+import nibabel
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from study_maps import study_map_paths, selected_studies, sample_map
+from threshold import threshold_pair, threshold_output_name
+from synthetic_data import write_report
+
+# ############################################################################################################
+# ## Stand-in for SDM, so the pipeline can be benchmarked without an SDM install                          ##
+# ## Understands the commands the scripts use - pp, mean, lm, threshold, mask coordinate and extract -     ##
+# ## and writes files with the same names SDM does, worked out from the preprocessed maps                   ##
+# ## Waits FAKE_SDM_DELAY seconds before each command to stand in for SDM's own run time                    ##
+# ## Use make_fake_sdm to get an executable to pass as sdm_path                                             ##
+# ############################################################################################################
+
+
+def make_fake_sdm(directory, delay=0.):
+    """
+    Writes an executable wrapper around this script that can be used as sdm_path
+
+    Arguments
+    ---------
+    directory: Directory to write the wrapper to
+    delay: Seconds to wait before each command
+
+    Returns
+    -------
+    Path to the wrapper
+    """
+    if os.name == 'nt':
+        path = os.path.join(directory, 'fake_sdm.bat')
+        script = '@set FAKE_SDM_DELAY=%s\r\n@"%s" "%s" %%*\r\n' % (delay, sys.executable, os.path.abspath(__file__))
+    else:
+        path = os.path.join(directory, 'fake_sdm')
+        script = '#!/bin/sh\nFAKE_SDM_DELAY=%s exec "%s" "%s" "$@"\n' % (delay, sys.executable,
+                                                                       os.path.abspath(__file__))
+    with open(path, 'w') as f:
+        f.write(script)
+    os.chmod(path, 0o755)
+    return path
+
+
+def _load_studies(ma_dir, selection_column=None):
+    studies = selected_studies(ma_dir, selection_column)
+    effects = []
+    variances = []
+    for study in studies:
+        effect_map, variance_map = study_map_paths(ma_dir, study)
+        img = nibabel.load(effect_map)
+        # asanyarray first - older nibabel's proxies can't take a dtype
+        effects.append(np.asarray(np.asanyarray(img.dataobj), dtype=np.float64))
+        variances.append(np.asarray(np.asanyarray(nibabel.load(variance_map).dataobj), dtype=np.float64))
+    return studies, np.array(effects), np.array(variances), img.affine
+
+
+def _save_z(prefix, z, affine):
+    from scipy.special import ndtr
+
+    nibabel.Nifti1Image(z.astype(np.float32), affine).to_filename(prefix + '_z.nii.gz')
+    nibabel.Nifti1Image(np.where(z != 0, ndtr(z), 0).astype(np.float32), affine).to_filename(prefix + '_p.nii.gz')
+
+
+def mean(ma_dir, name, selection_column=None):
+    """
+    Fixed-effects mean and heterogeneity z maps
+    """
+    studies, y, v, affine = _load_studies(ma_dir, selection_column)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(v > 0, 1 / v, 0)
+        sum_w = w.sum(0)
+        estimate = (w * y).sum(0) / sum_w
+        z = np.nan_to_num(estimate * np.sqrt(sum_w))
+        q = (w * (y - estimate) ** 2).sum(0)
+        qh = np.nan_to_num((q - (len(studies) - 1)) / np.sqrt(2 * max(len(studies) - 1, 1)))
+    _save_z(os.path.join(ma_dir, name), z, affine)
+    _save_z(os.path.join(ma_dir, name + '_QH'), qh, affine)
+    for prefix in [name + '_z', name + '_QH_z']:  # SDM writes a summary page for each map
+        with open(os.path.join(ma_dir, prefix + '.htm'), 'w') as f:
+            f.write('<html><body>%s</body></html>\n' % prefix)
+
+
+def lm(ma_dir, name, column, selection_column=None):
+    """
+    Weighted least squares slope z map for a single regressor
+    """
+    import pandas as pd
+
+    studies, y, v, affine = _load_studies(ma_dir, selection_column)
+    table = pd.read_csv(os.path.join(ma_dir, 'sdm_table.txt'), delimiter='\t').set_index('study')
+    x = table.loc[studies, column].values.astype(float)[:, None, None, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        w = np.where(v > 0, 1 / v, 0)
+        sum_w = w.sum(0)
+        x_bar = (w * x).sum(0) / sum_w
+        sxx = (w * (x - x_bar) ** 2).sum(0)
+        slope = (w * (x - x_bar) * y).sum(0) / sxx
+        z = np.nan_to_num(slope * np.sqrt(sxx))
+    _save_z(os.path.join(ma_dir, name + '_1m0'), z, affine)
+
+
+def threshold(ma_dir, map_name, p_threshold, z_threshold, extent):
+    """
+    Thresholded maps and an html report
+    """
+    z_image = os.path.join(ma_dir, map_name + '.nii.gz')
+    p_image = os.path.join(ma_dir, map_name[:-len('_z')] + '_p.nii.gz')
+    threshold_pair(p_image, z_image, p_threshold, z_threshold, extent)
+    out = threshold_output_name(z_image, p_threshold, z_threshold, extent)
+    write_report(out.replace('.nii.gz', '.htm'), out)
+
+
+def mask(ma_dir, name, coordinate):
+    with open(os.path.join(ma_dir, name + '.mask.txt'), 'w') as f:
+        f.write(coordinate)
+
+
+def extract(ma_dir, name):
+    with open(os.path.join(ma_dir, name + '.mask.txt')) as f:
+        coordinate = [[float(c) for c in f.read().split(',')]]
+    with open(os.path.join(ma_dir, 'extract_' + name + '.txt'), 'w') as f:
+        f.write('study estimate variance\n')
+        for study in selected_studies(ma_dir):
+            effect_map, variance_map = study_map_paths(ma_dir, study)
+            f.write('%s %.6f %.6f\n' % (study, sample_map(effect_map, coordinate)[0],
+                                        sample_map(variance_map, coordinate)[0]))
+
+
+def main(argv):
+    time.sleep(float(os.environ.get('FAKE_SDM_DELAY', 0)))
+    ma_dir = os.getcwd()
+    command = re.sub(r'\s+', ' ', ' '.join(argv)).strip()
+
+    match = re.match(r'pp\b', command)
+    if match:
+        return 0  # the synthetic data is already preprocessed
+    match = re.match(r'threshold (\S+), p, ([\d.]+), ([\d.]+), (\d+)$', command)
+    if match:
+        threshold(ma_dir, match.group(1), float(match.group(2)), float(match.group(3)), int(match.group(4)))
+        return 0
+    match = re.match(r'(\S+) = mean ?(\S*)$', command)
+    if match:
+        mean(ma_dir, match.group(1), match.group(2))
+        return 0
+    match = re.match(r'(\S+) = lm (\S+?),? ?(\S*)$', command)
+    if match:
+        lm(ma_dir, match.group(1), match.group(2), match.group(3))
+        return 0
+    match = re.match(r'(\S+) = mask coordinate, (-?\d+), (-?\d+), (-?\d+)$', command)
+    if match:
+        mask(ma_dir, match.group(1), ','.join(match.groups()[1:]))
+        return 0
+    match = re.match(r'extract (\S+)$', command)
+    if match:
+        extract(ma_dir, match.group(1))
+        return 0
+
+    sys.stderr.write('fake_sdm: unknown command: %s\n' % command)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
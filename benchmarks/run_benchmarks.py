@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# ############################################################################################################
+# ## Timed runs of the main stages of the toolkit on synthetic data                                       ##
+# ## The data are made, and each benchmark run, in a Python process of its own, so peak memory is measured ##
+# ## for that benchmark alone (Linux carries the peak over from a parent that had the data loaded)        ##
+# ## Results are printed (and optionally saved) as JSON so they can be compared between commits           ##
+# ##                                                                                                        ##
+# ## python benchmarks/run_benchmarks.py --studies 20 --clusters 5 --voxel-size 2 --out results.json        ##
+# ############################################################################################################
+
+ANALYSIS = 'BENCH'
+MEAN = ANALYSIS + '_mean_z_p_0.00500_1.000_10'
+
+
+def prepare(data_dir, n_studies, n_clusters, voxel_size, seed):
+    """
+    Makes the synthetic dataset, plus mean and jack-knife results with html reports and thresholded maps
+    """
+    from synthetic_data import make_dataset
+    from sdm_functions import write_jackknife_columns
+    from native_jackknife import native_jackknife
+    import fake_sdm
+
+    make_dataset(data_dir, n_studies, n_clusters, voxel_size, seed)
+    results_dir = os.path.join(data_dir, 'results')
+    shutil.copytree(data_dir, results_dir)
+
+    fake_sdm.mean(results_dir, ANALYSIS + '_mean', 'CombinedGroups')
+    fake_sdm.threshold(results_dir, ANALYSIS + '_mean_z', 0.005, 1, 10)
+    write_jackknife_columns(os.path.join(results_dir, 'sdm_table.txt'), 'CombinedGroups')
+    for p, z in native_jackknife(results_dir, ANALYSIS, 'CombinedGroups'):
+        fake_sdm.threshold(results_dir, os.path.basename(z)[:-len('.nii.gz')], 0.005, 1, 10)
+
+
+def bench_get_coords(data_dir):
+    from sdm_functions import get_coords
+    results_dir = os.path.join(data_dir, 'results')
+    reports = [f for f in os.listdir(results_dir) if f.endswith('.htm')]
+    for f in reports:
+        get_coords(os.path.join(results_dir, f))
+    return len(reports)
+
+
+def bench_check_jackknife(data_dir):
+    from sdm_functions import check_jackknife
+    results_dir = os.path.join(data_dir, 'results')
+    presence = check_jackknife(os.path.join(results_dir, MEAN + '.htm'), results_dir, save_results=False)
+    return presence.shape[1] - 1
+
+
+def bench_check_jk_niftis(data_dir):
+    from check_jk_niftis import check_jk_niftis
+    results_dir = os.path.join(data_dir, 'results')
+    mean_niftis = [os.path.join(results_dir, MEAN + '.nii.gz'), os.path.join(results_dir, MEAN + '_neg.nii.gz')]
+    check_jk_niftis(mean_niftis, results_dir)
+    return len([f for f in os.listdir(results_dir) if '_JK_' in f and f.endswith('_10.nii.gz')])
+
+
+def bench_threshold_img(data_dir):
+    from threshold import threshold_img
+    results_dir = os.path.join(data_dir, 'results')
+    threshold_img(os.path.join(results_dir, ANALYSIS + '_mean_p.nii.gz'),
+                  os.path.join(results_dir, ANALYSIS + '_mean_z.nii.gz'), 0.005, 1, 10)
+    return 1
+
+
+def bench_combine_subgroups(data_dir, n_workers=4):
+    from combine_subgroups import combine_subgroups
+    from study_maps import selected_studies, study_map_paths
+
+    # each study combined with the next one as a second subgroup, under names that give distinct outputs
+    work_dir = tempfile.mkdtemp(prefix='bench_combine_')
+    try:
+        studies = selected_studies(data_dir)
+        rows = []
+        for i, study in enumerate(studies):
+            for group, other in [('a', study), ('b', studies[(i + 1) % len(studies)])]:
+                os.symlink(study_map_paths(data_dir, other)[0], os.path.join(work_dir, 'pp_S%d_%s.nii.gz' % (i, group)))
+            rows.append('S%d_a,S%d_b,,20,25,0,30' % (i, i))
+        csv_file = os.path.join(work_dir, 'studies.csv')
+        with open(csv_file, 'w') as f:
+            f.write('group_a,group_b,group_c,na,nb,nc,c_n\n' + '\n'.join(rows) + '\n')
+        combine_subgroups(csv_file, work_dir, work_dir, workers=n_workers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return len(rows)
+
+
+def bench_run_entire_meta_analysis(data_dir, delay=0., n_workers=4):
+    from whole_ma_script import run_entire_meta_analysis
+    from fake_sdm import make_fake_sdm
+
+    work_dir = tempfile.mkdtemp(prefix='bench_ma_')
+    try:
+        for f in os.listdir(data_dir):
+            if os.path.isfile(os.path.join(data_dir, f)):
+                shutil.copy2(os.path.join(data_dir, f), work_dir)
+        sdm_path = make_fake_sdm(work_dir, delay)
+        run_entire_meta_analysis(work_dir + '/', sdm_path, ANALYSIS, ['Patient_age', 'Duration'],
+                                 filter_var='CombinedGroups', n_workers=n_workers)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 1
+
+
+BENCHMARKS = ['get_coords', 'check_jackknife', 'check_jk_niftis', 'threshold_img', 'combine_subgroups',
+              'run_entire_meta_analysis']
+
+
+def peak_rss_mb():
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,  # worker processes count too
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.  # bytes on mac, KB on linux
+
+
+def run_single(name, data_dir, delay, n_workers):
+    """
+    Runs one benchmark in this process and prints its result as JSON on the last line
+    """
+    devnull = open(os.devnull, 'w')
+    stdout = sys.stdout
+    sys.stdout = devnull  # the scripts print a lot
+    try:
+        kwargs = {'delay': delay, 'n_workers': n_workers} if name == 'run_entire_meta_analysis' else {}
+        if name == 'combine_subgroups':
+            kwargs = {'n_workers': n_workers}
+        start = time.time()
+        items = globals()['bench_' + name](data_dir, **kwargs)
+        wall = time.time() - start
+    finally:
+        sys.stdout = stdout
+        devnull.close()
+
+    if items is None:
+        result = {'skipped': True}
+    else:
+        result = {'wall_s': round(wall, 4), 'peak_rss_mb': peak_rss_mb(), 'items': items,
+                  'items_per_s': round(items / wall, 3) if wall > 0 else None}
+    print json.dumps(result)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the meta-analysis scripts on synthetic data')
+    parser.add_argument('--studies', type=int, default=20)
+    parser.add_argument('--clusters', type=int, default=5)
+    parser.add_argument('--voxel-size', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sdm-delay', type=float, default=0., help='seconds the fake SDM waits per command')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--only', nargs='*', choices=BENCHMARKS, help='benchmarks to run (default all)')
+    parser.add_argument('--data-dir', help='reuse (or keep) the synthetic data in this directory')
+    parser.add_argument('--out', help='file to save the JSON results to')
+    parser.add_argument('--single', help=argparse.SUPPRESS)
+    parser.add_argument('--prepare', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        run_single(args.single, args.data_dir, args.sdm_delay, args.workers)
+        return
+    if args.prepare:
+        prepare(args.data_dir, args.studies, args.clusters, args.voxel_size, args.seed)
+        return
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench_data_')
+    try:
+        if not os.path.exists(os.path.join(data_dir, 'results')):
+            start = time.time()
+            # in a process of its own, so the benchmarks aren't started from one that had all the data loaded
+            subprocess.check_call([sys.executable, os.path.abspath(__file__), '--prepare', '--data-dir', data_dir,
+                                   '--studies', str(args.studies), '--clusters', str(args.clusters),
+                                   '--voxel-size', str(args.voxel_size), '--seed', str(args.seed)])
+            sys.stderr.write('Made synthetic data in %.1f s\n' % (time.time() - start))
+
+        results = {}
+        for name in args.only or BENCHMARKS:
+            sys.stderr.write('Running %s\n' % name)
+            try:
+                output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--single', name,
+                                                  '--data-dir', data_dir, '--sdm-delay', str(args.sdm_delay),
+                                                  '--workers', str(args.workers)])
+                results[name] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+            except subprocess.CalledProcessError as e:
+                results[name] = {'error': 'exit status %d' % e.returncode}
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {'commit': git_commit(), 'python': sys.version.split()[0], 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'config': {'studies': args.studies, 'clusters': args.clusters, 'voxel_size': args.voxel_size,
+                         'seed': args.seed, 'sdm_delay': args.sdm_delay, 'workers': args.workers},
+              'benchmarks': results}
+    print json.dumps(report, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
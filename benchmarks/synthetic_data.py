@@ -0,0 +1,119 @@
+import os
+
+import nibabel
+import numpy as np
+
+# ############################################################################################################
+# ## Synthetic meta-analysis data for the benchmarks                                                      ##
+# ## make_dataset writes an SDM table and preprocessed effect size/variance maps for each study, on an MNI ##
+# ## grid at any resolution, with a number of true clusters plus noise                                    ##
+# ## write_report writes an SDM style html results file that sdm_functions.read_report can read            ##
+# ############################################################################################################
+
+
+def mni_grid(voxel_size=2):
+    """
+    Shape and affine of an MNI152 sized grid at a given voxel size in mm
+    """
+    shape = (int(182 / voxel_size) + 1, int(218 / voxel_size) + 1, int(182 / voxel_size) + 1)
+    affine = np.array([[-voxel_size, 0, 0, 90],
+                       [0, voxel_size, 0, -126],
+                       [0, 0, voxel_size, -72],
+                       [0, 0, 0, 1]], dtype=float)
+    return shape, affine
+
+
+def make_dataset(directory, n_studies=20, n_clusters=5, voxel_size=2, seed=0):
+    """
+    Writes a synthetic meta-analysis to a directory
+
+    Arguments
+    ---------
+    directory: Directory to write to (made if it doesn't exist)
+    n_studies: Number of studies
+    n_clusters: Number of true effects - half positive, half negative - shared by most studies
+    voxel_size: Voxel size in mm
+    seed: Random seed
+
+    Returns
+    -------
+    studies: List of study names
+    """
+    import pandas as pd
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = np.random.RandomState(seed)
+    shape, affine = mni_grid(voxel_size)
+
+    # brain-shaped ellipsoid, so most of the volume is background as in real maps
+    grid = np.indices(shape, dtype=np.float32)
+    centre = (np.array(shape, dtype=float) - 1) / 2
+    brain = sum(((grid[i] - centre[i]) / (0.45 * shape[i])) ** 2 for i in range(3)) <= 1
+
+    effect = np.zeros(shape, dtype=np.float32)
+    sigma = 6. / voxel_size
+    for c in range(n_clusters):
+        peak = [rng.randint(int(0.3 * s), int(0.7 * s)) for s in shape]
+        blob = np.exp(-sum((grid[i] - peak[i]) ** 2 for i in range(3)) / (2 * sigma ** 2))
+        effect += (1 if c % 2 == 0 else -1) * 0.8 * blob.astype(np.float32)
+
+    studies = ['study%03d' % (i + 1) for i in range(n_studies)]
+    for study in studies:
+        n = rng.randint(15, 60)
+        variance = np.where(brain, 2. / n + rng.uniform(0, 0.02), 0).astype(np.float32)
+        noise = rng.normal(0, 1, shape).astype(np.float32) * np.sqrt(variance)
+        study_effect = np.where(brain, effect * rng.uniform(0.3, 1.5) + noise, 0).astype(np.float32)
+        nibabel.Nifti1Image(study_effect, affine).to_filename(os.path.join(directory, 'pp_%s.nii.gz' % study))
+        nibabel.Nifti1Image(variance, affine).to_filename(os.path.join(directory, 'pp_%s_var.nii.gz' % study))
+
+    table = pd.DataFrame({'study': studies,
+                          'CombinedGroups': np.ones(n_studies, dtype=int),
+                          'Patient_age': rng.uniform(20, 60, n_studies).round(1),
+                          'Duration': rng.uniform(1, 20, n_studies).round(1)},
+                         columns=['study', 'CombinedGroups', 'Patient_age', 'Duration'])
+    table.to_csv(os.path.join(directory, 'sdm_table.txt'), sep='\t', index=False)
+
+    return studies
+
+
+def write_report(html_file, z_image):
+    """
+    Writes an SDM style html results file for a thresholded map, with one section per cluster
+
+    Arguments
+    ---------
+    html_file: File to write
+    z_image: Thresholded positive map (the _neg map next to it is included too, if there is one)
+    """
+    from scipy import ndimage
+
+    sections = []
+    for image in [z_image, z_image.replace('.nii.gz', '_neg.nii.gz')]:
+        if not os.path.exists(image):
+            continue
+        img = nibabel.load(image)
+        data = np.asarray(img.dataobj)
+        labeled_array, num_features = ndimage.label(data > 0, structure=np.ones((3, 3, 3)))
+        if not num_features:
+            continue
+        labels = np.arange(1, num_features + 1)
+        sizes = np.bincount(labeled_array.ravel())[1:]
+        peaks = ndimage.maximum_position(data, labeled_array, labels)
+        values = ndimage.maximum(data, labeled_array, labels)
+        sign = -1 if image.endswith('_neg.nii.gz') else 1
+        for size, peak, value in sorted(zip(sizes, peaks, values), reverse=True):
+            x, y, z = nibabel.affines.apply_affine(img.affine, peak).round().astype(int)
+            sections.append('</table><p>Peak %d,%d,%d, SDM-Z = %.3f, p = %.7f, %d voxels</p>\n'
+                            '<table><tr><td>Breakdown</td></tr>\n' % (x, y, z, sign * value,
+                                                                         _upper_p(value), size))
+
+    with open(html_file, 'w') as f:
+        f.write('<html><body>\n<table><tr><td>SDM results</td></tr>\n')
+        f.writelines(sections)
+        f.write('</table>\n</body></html>\n')
+
+
+def _upper_p(z):
+    from scipy.special import ndtr
+    return 1 - ndtr(z)
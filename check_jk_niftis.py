@@ -1,12 +1,146 @@
-import nibabel
-from scipy import ndimage
 import numpy as np
-import os
 import re
-import pandas as pd
+from cluster_index import ClusterIndex, build_cluster_index, load_cluster_index
+from result_stack import load_result_stack, SIGNS
+from results_catalog import load_catalog
+from sidecar_store import load_mapped
+from tracing import log, stage
+from volume_cache import get_sidecar_dir, use_sidecar_store
 
 
-def check_jk_niftis(mean_niftis, jk_dir, regex=r'(?<=[a-z,_]JK).+(?=_z_p)', csv_name='', metareg=False):
+def _read_map(path):
+    """
+    Reads a map without keeping it in the volume cache, so it's freed as soon as it's been used - as a memory map of
+    its uncompressed sidecar if a sidecar store is in use (see volume_cache.use_sidecar_store)
+    """
+    import nibabel
+
+    sidecar_dir = get_sidecar_dir()
+    if sidecar_dir:
+        data, affine, _ = load_mapped(path, sidecar_dir)
+        return data, affine
+    img = nibabel.load(path)
+    return np.asanyarray(img.dataobj), img.affine
+
+
+def index_statistics(original_index, overlap, peak_sig):
+    """
+    Summary statistics for every cluster of the original image, from its sparse cluster index and the number of voxels
+    of each cluster that are in the jack-knife image - missing voxels are count(original & ~jack-knife)
+
+    Arguments:
+    ----------
+    original_index = ClusterIndex of the original thresholded image
+    overlap = Number of voxels of each original cluster in the jack-knife image (from original_index.overlap or
+              ResultStack.cluster_overlaps)
+    peak_sig = Maximum significance within each original cluster (original_index.max_in_clusters(original_sig))
+
+    Returns:
+    --------
+    stats = A pandas dataframe indexed by cluster number (from 1, in ndimage.label order) with the number of missing
+            voxels, cluster size, peak value and peak significance in the original image, and the flat index of the
+            peak voxel (the first voxel with the peak value, in the same order as np.where)
+
+    """
+    import pandas as pd
+
+    columns = ['missing', 'size', 'peak', 'peak_sig', 'peak_index']
+    if not len(original_index):
+        return pd.DataFrame(columns=columns)
+
+    size = original_index.sizes().astype(float)
+    stats = pd.DataFrame({'missing': size - overlap,
+                          'size': size,
+                          'peak': original_index.peak_value,
+                          'peak_sig': peak_sig,
+                          'peak_index': original_index.peak_index},
+                         index=np.arange(1, len(original_index) + 1), columns=columns)
+
+    return stats
+
+
+def _map_values(path, slab_size=None):
+    """
+    A map's data, or a SlabMap reading it a slab of z-planes at a time if slab_size is given
+    """
+    if slab_size:
+        from slab_threshold import SlabMap
+        return SlabMap(path, slab_size)
+    return _read_map(path)[0]
+
+
+def _study_overlaps(original_index, files, slab_size=None):
+    """
+    Number of voxels of each original cluster that are in a study's positive and negative maps (a missing map counts
+    as empty)
+    """
+    overlaps = {}
+    for img in SIGNS:
+        path = files.get(img)
+        overlaps[img] = original_index[img].count_nonzero(_map_values(path, slab_size)) if path else 0
+    return overlaps
+
+
+# original cluster indexes for the worker processes, set up by _init_worker
+_worker_index = {}
+
+
+def _share(array):
+    """
+    Copies an array into shared memory, so worker processes read it rather than getting their own copy
+    """
+    import ctypes
+    from multiprocessing.sharedctypes import RawArray
+
+    c_type = ctypes.c_int32 if array.dtype == np.int32 else ctypes.c_int64
+    shared = RawArray(c_type, max(len(array), 1))
+    np.frombuffer(shared, dtype=array.dtype)[:len(array)] = array
+    return shared, len(array), array.dtype.str
+
+
+def _unshare(shared):
+    raw, length, dtype = shared
+    return np.frombuffer(raw, dtype=np.dtype(dtype))[:length]
+
+
+def _init_worker(shared_index, sidecar_dir):
+    if sidecar_dir:  # not inherited where workers are started afresh rather than forked
+        use_sidecar_store(sidecar_dir)
+    for img, (indices, offsets, peak_index, shape) in shared_index.items():
+        _worker_index[img] = ClusterIndex(_unshare(indices), _unshare(offsets), _unshare(peak_index), None, shape,
+                                          None)
+
+
+def _check_study(args):
+    study, files, slab_size = args
+    return study, _study_overlaps(_worker_index, files, slab_size)
+
+
+def _parallel_overlaps(original_index, files_by_study, studies, n_workers, slab_size=None):
+    """
+    Works out the overlaps of every study across a pool of processes, with the original cluster indexes (labelled
+    once, here) in shared memory - results come back in the order of studies whatever order they finish in
+    """
+    from multiprocessing import Pool
+
+    shared_index = {}
+    for img in SIGNS:
+        index = original_index[img]
+        shared_index[img] = (_share(index.indices.astype(np.int32)), _share(index.offsets.astype(np.int64)),
+                             _share(index.peak_index.astype(np.int32)), index.shape)
+
+    pool = Pool(n_workers, initializer=_init_worker, initargs=(shared_index, get_sidecar_dir()))
+    try:
+        results = pool.map(_check_study, [(study, files_by_study[study], slab_size) for study in studies])
+    finally:
+        pool.close()
+        pool.join()
+
+    return dict(results)
+
+
+def check_jk_niftis(mean_niftis, jk_dir, regex=r'(?<=[a-z,_]JK).+(?=_z_p)', csv_name='', metareg=False,
+                    use_index=False, use_stack=False, n_workers=1, slab_size=None, catalog=None):
     """
     Compares jack-knife nifti outputs with an original nifti file to check whether clusters disappear
 
@@ -17,6 +151,17 @@ def check_jk_niftis(mean_niftis, jk_dir, regex=r'(?<=[a-z,_]JK).+(?=_z_p)', csv_
     regex (Optional) = regex expression for identifying jack-knife outputs, can be changed to identify different outputs
     csv_name (Optional) = name for a csv file to save results to, doesn't save csv if not given
     metareg (Optional) = makes the function output clusters that overlap, rather than those that don't
+    use_index (Optional) = compare sparse cluster indexes of the maps (see cluster_index.py, saved next to each map as
+                           map.clusters.npz) rather than whole volumes - gives the same results, much faster when
+                           the indexes have already been made
+    use_stack (Optional) = stack the thresholded maps of every study into one file (see result_stack.py) and check
+                           every study at once - gives the same results, and is quickest for many studies
+    n_workers (Optional) = number of processes to check the studies with (without use_index or use_stack) - the
+                           output is the same whatever the number
+    slab_size (Optional) = number of z-planes to read at once (without use_index or use_stack) - for maps too big to
+                           load whole, gives the same results (see slab_threshold.py)
+    catalog (Optional) = ResultsCatalog of jk_dir to find the jack-knife outputs in, e.g. one shared by several checks
+                         (see results_catalog.py - otherwise it's loaded from jk_dir)
 
     Returns:
     --------
@@ -24,116 +169,123 @@ def check_jk_niftis(mean_niftis, jk_dir, regex=r'(?<=[a-z,_]JK).+(?=_z_p)', csv_
 
     Also prints out the results for each study including the percentage of voxels that are missing
 
+    Only the voxels of the original clusters are kept (as a sparse cluster index) - each jack-knife map is read, checked
+    at those voxels and dropped, so memory use stays at about one map whatever the number of studies
+
     """
+    import nibabel
+    import pandas as pd
+
+    # thresholded niftis, not significance maps
+    if catalog is None:
+        catalog = load_catalog(jk_dir)
+    jk_files = catalog.find(file_type='nii.gz', thresholded=True, statistic='z', significance=False)
+
+    with stage('check_jk_niftis.load'):
+        if use_index or use_stack:
+            original_index = {'p': load_cluster_index(mean_niftis[0]), 'n': load_cluster_index(mean_niftis[1])}
+        elif slab_size:
+            from slab_threshold import slab_cluster_index
+            original_index = {'p': slab_cluster_index(mean_niftis[0], slab_size),
+                              'n': slab_cluster_index(mean_niftis[1], slab_size)}
+        else:
+            original_index = {'p': build_cluster_index(*_read_map(mean_niftis[0])),
+                              'n': build_cluster_index(*_read_map(mean_niftis[1]))}
+        peak_sig = {}
+        for img, nifti in zip(SIGNS, mean_niftis):  # significance maps are only read if there are clusters
+            if len(original_index[img]):
+                peak_sig[img] = original_index[img].max_in_clusters(_map_values(nifti.replace('.nii', '_p.nii'),
+                                                                                slab_size))
+            else:
+                peak_sig[img] = np.zeros(0)
 
-    jk_files = os.listdir(jk_dir)
-
-    original_nifti_p = nibabel.load(mean_niftis[0]).get_data()
-    original_nifti_n = nibabel.load(mean_niftis[1]).get_data()
-    original_aff_p = nibabel.load(mean_niftis[0]).get_affine()
-    original_aff_n = nibabel.load(mean_niftis[1]).get_affine()
-    original_nifti_p_sig = nibabel.load(mean_niftis[0].replace('.nii', '_p.nii')).get_data()
-    original_nifti_n_sig = nibabel.load(mean_niftis[1].replace('.nii', '_p.nii')).get_data()
-
-    # structure for labeling - there's probably a better way to define this
-    s = [[[1, 1, 1],
-          [1, 1, 1],
-          [1, 1, 1]],
-         [[1, 1, 1],
-          [1, 1, 1],
-          [1, 1, 1]],
-         [[1, 1, 1],
-          [1, 1, 1],
-          [1, 1, 1]]]
-
-    studies = []
-    jk_niftis = []
+    files_by_study = {}
     for jk in jk_files:
-        if re.match(r'.+_z_p_.+(?<!p\.nii)\.gz', jk):  # only thresholded niftis
-            jk_niftis.append(jk)
-            print jk
-            study_name = re.search(regex, jk)  # get study name out of file name
-            if study_name:
-                studies.append(study_name.group())
+        log(jk)
+        study_name = re.search(regex, jk)  # get study name out of file name
+        if study_name:  # files go with the study named in them - not any study whose name is part of the file name
+            files_by_study.setdefault(study_name.group(), {})['n' if '_neg.nii' in jk else 'p'] = jk_dir + '/' + jk
 
-    studies = set(studies)  # make list values unique
-    studies = list(studies)
+    studies = sorted(files_by_study)
 
-    results_dict = {}
-
-    for study in studies:
-        jk_iter = []
-        for jk in jk_niftis:  # look for jk files that match the study name
-            if study in jk:
-                jk_iter.append(jk)
+    if use_stack:
+        with stage('check_jk_niftis.stack'):
+            stack = load_result_stack(files_by_study, jk_dir)
+            overlaps = dict((img, stack.cluster_overlaps(original_index[img], img)) for img in SIGNS)
 
-        for j in jk_iter:  # assign files to variables
-            if '_neg' in j:
-                jk_nifti_n = nibabel.load(jk_dir + '/' + j).get_data()
-            else:
-                jk_nifti_p = nibabel.load(jk_dir + '/' + j).get_data()
+    if n_workers > 1 and not (use_index or use_stack) and len(studies) > 1:
+        with stage('check_jk_niftis.parallel', n_workers=n_workers):
+            parallel_overlaps = _parallel_overlaps(original_index, files_by_study, studies, n_workers, slab_size)
+    else:
+        parallel_overlaps = None
 
-        jk_nifti_p[np.where(jk_nifti_p == 0)] = -999  # sets anything with 0 value in JK to -999
-        jk_nifti_n[np.where(jk_nifti_n == 0)] = -999  # sets anything with 0 value in JK to -999
-        jk_nifti_p[np.where(original_nifti_p == 0)] = 0  # mask with original image - anything 0 in original becomes 0
-        jk_nifti_n[np.where(original_nifti_n == 0)] = 0  # mask with original image - anything 0 in original becomes 0
+    results_dict = {}
 
-        print "*****************\nChecking " + study + '\n*****************'
+    for study in studies:  # in sorted order, so results don't depend on the order the files are listed or checked in
+        jk_iter = list(files_by_study[study].values())
+
+        if use_stack:
+            row = stack.studies.index(study)
+        elif use_index:
+            with stage('check_jk_niftis.load_index', study=study):
+                jk_index = {}
+                for j in jk_iter:
+                    jk_index['n' if '_neg.nii' in j else 'p'] = load_cluster_index(j)
+        elif parallel_overlaps is not None:
+            study_overlaps = parallel_overlaps[study]
+        else:
+            with stage('check_jk_niftis.load', study=study):
+                study_overlaps = _study_overlaps(original_index, files_by_study[study], slab_size)
+
+        log("*****************\nChecking " + study + '\n*****************')
         for img in ['p', 'n']:  # do this for both positive and negative results
 
             if img == 'p':
-                jk_img = jk_nifti_p
-                original_img = original_nifti_p
-                original_aff = original_aff_p
-                original_sig = original_nifti_p_sig
-                print "Positive Clusters\n*****************"
+                log("Positive Clusters\n*****************")
             else:
-                jk_img = jk_nifti_n
-                original_img = original_nifti_n
-                original_aff = original_aff_n
-                original_sig = original_nifti_n_sig
-                print "*****************\nNegative Clusters\n*****************"
-
-            labeled_array, num_features = ndimage.label(jk_img, structure=s)  # Label clusters in masked JK image
-
-
-            for i in np.unique(labeled_array):  # iterate over clusters
-                if i != 0:
-                    print "Cluster " + str(i)
-                    m = np.mean(jk_img[np.where(labeled_array == i)])  # calculate mean of the cluster in the jk img
-                    missing_vox = float(np.sum(jk_img[np.where(labeled_array == i)] == -999))  # number of missing vox
-                    total_vox = float(labeled_array[np.where(labeled_array == i)].shape[0])
-
-                    max = np.max(original_img[np.where(labeled_array == i)])  # get maximum value in cluster
-                    max_sig = np.max(original_sig[np.where(labeled_array == i)])
-                    max_coords = np.where((original_img == max) & (labeled_array == i))  # find where this max is
-                    max_coords_arr = np.zeros(3)  # np.where outputs as tuple of arrays- need to convert to array
-                    for i in range(0, len(max_coords)):
-                        max_coords_arr[i] = max_coords[i][0]
-                    max_coords_mni = nibabel.affines.apply_affine(original_aff, max_coords_arr)  # convert to MNI coords
-                    if not str(max_coords_mni) in results_dict:
-                        results_dict[str(max_coords_mni)] = [max_coords_mni, img, max, 1-max_sig, total_vox, []]  # create empty dictionary entry for coordinates
-                    print max_coords_mni
-                    print "Cluster size = " + str(int(total_vox)) + " voxels"
-                    print "Percent missing voxels = " + str(round(missing_vox/total_vox*100, 2)) + "%"
-                    if metareg:
-                        if m != -999:  # if mean = -999, indicates that the cluster is all missing
-                            print "Cluster overlaps"
-                            results_dict[str(max_coords_mni)][5].append(study+"_"+img)  # add study name to coordinate entry
-                    else:
-                        if m == -999:  # if mean = -999, indicates that the cluster is all missing
-                            print "Cluster not present"
-                            results_dict[str(max_coords_mni)][5].append(study+"_"+img)  # add study name to coordinate entry
-
-    output_df = pd.DataFrame(results_dict.values())
-    output_df.columns = ['Coordinates', 'Pos/neg', 'Peak Z', 'Significance', 'Size', 'Studies']
-    output_df = output_df.sort(['Pos/neg', 'Size'], ascending=[0, 0])
-    output_df['Peak Z'][output_df['Pos/neg'] == 'n'] = 0 - output_df['Peak Z']
+                log("*****************\nNegative Clusters\n*****************")
+
+            if use_stack:
+                stats = index_statistics(original_index[img], overlaps[img][row], peak_sig[img])
+            elif use_index:
+                with stage('check_jk_niftis.overlap', study=study, sign=img):
+                    overlap = original_index[img].overlap(jk_index[img])
+                    stats = index_statistics(original_index[img], overlap, peak_sig[img])
+            else:
+                stats = index_statistics(original_index[img], study_overlaps[img], peak_sig[img])
+
+            for i in stats.index:  # iterate over clusters
+                log("Cluster " + str(i))
+                missing_vox = stats['missing'][i]
+                total_vox = stats['size'][i]
+                max = stats['peak'][i]
+                max_sig = stats['peak_sig'][i]
+                max_coords_arr = np.array(np.unravel_index(stats['peak_index'][i], original_index[img].shape), dtype=float)
+                max_coords_mni = nibabel.affines.apply_affine(original_index[img].affine, max_coords_arr)  # convert to MNI coords
+                if not str(max_coords_mni) in results_dict:
+                    results_dict[str(max_coords_mni)] = [max_coords_mni, img, max, 1-max_sig, total_vox, []]  # create empty dictionary entry for coordinates
+                log(max_coords_mni)
+                log("Cluster size = " + str(int(total_vox)) + " voxels")
+                log("Percent missing voxels = " + str(round(missing_vox/total_vox*100, 2)) + "%")
+                if metareg:
+                    if missing_vox != total_vox:  # if every voxel is missing the cluster isn't there
+                        log("Cluster overlaps")
+                        results_dict[str(max_coords_mni)][5].append(study+"_"+img)  # add study name to coordinate entry
+                else:
+                    if missing_vox == total_vox:  # if every voxel is missing the cluster isn't there
+                        log("Cluster not present")
+                        results_dict[str(max_coords_mni)][5].append(study+"_"+img)  # add study name to coordinate entry
+
+    output_df = pd.DataFrame(list(results_dict.values()),
+                             columns=['Coordinates', 'Pos/neg', 'Peak Z', 'Significance', 'Size', 'Studies'])
+    output_df = output_df.sort_values(['Pos/neg', 'Size'], ascending=[0, 0])
+    output_df.loc[output_df['Pos/neg'] == 'n', 'Peak Z'] = 0 - output_df['Peak Z']
     output_df = output_df.reset_index(drop=True)
     if csv_name:
-        output_df.to_csv(csv_name)
+        with stage('check_jk_niftis.write_csv'):
+            output_df.to_csv(csv_name)
 
-    print "FINISHED"
+    log("FINISHED")
 
     return output_df
 
@@ -160,7 +312,6 @@ qh_niftis = ["C:/Users/k1327409/Documents/VBShare/24_03/23_03_BD_Mean_QH_z_p_0.0
                "C:/Users/k1327409/Documents/VBShare/24_03/23_03_BD_Mean_QH_z_p_0.00500_1.000_10.nii.gz"]
 metareg_dir = 'C:/Users/k1327409/Documents/VBShare/24_03'
 
-"""
 mean_niftis_p = ["C:/Users/k1327409/Documents/VBShare/fromNAN/Analysis_0901_A/0403_MDD_mean_z_p_0.00500_1.000_10.nii.gz",
                "C:/Users/k1327409/Documents/VBShare/fromNAN/Analysis_0901_A/0403_MDD_mean_z_p_0.00500_1.000_10.nii.gz"]
 mean_niftis_n = ["C:/Users/k1327409/Documents/VBShare/fromNAN/Analysis_0901_A/0403_MDD_mean_z_p_0.00500_1.000_10_neg.nii.gz",
@@ -171,4 +322,5 @@ metareg_dir = 'C:/Users/k1327409/Documents/VBShare/fromNAN/Analysis_0901_A/mr'
 
 os.chdir('C:/Users/k1327409/Documents/VBShare/fromNAN/Analysis_0901_A')
 
-check_jk_niftis(qh_niftis, metareg_dir, regex=r'^.+(?=_1m0)', csv_name='29_01_16_metaregs_qh.csv', metareg=True)
\ No newline at end of file
+check_jk_niftis(qh_niftis, metareg_dir, regex=r'^.+(?=_1m0)', csv_name='29_01_16_metaregs_qh.csv', metareg=True)
+"""
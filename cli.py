@@ -0,0 +1,180 @@
+import argparse
+import os
+import sys
+
+# ############################################################################################################
+# ## One command line for the scripts                                                                       ##
+# ## python cli.py threshold|combine|conjunction|check-jk|jackknife|run ... (<command> --help for more)     ##
+# ## Nothing heavy (numpy, pandas, nibabel, scipy) is imported until a command runs, and arguments are      ##
+# ## checked first, so --help and mistakes in the arguments come back straight away                         ##
+# ############################################################################################################
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+def existing_file(path):
+    if not os.path.isfile(path):
+        raise argparse.ArgumentTypeError('no such file: ' + path)
+    return path
+
+
+def existing_dir(path):
+    if not os.path.isdir(path):
+        raise argparse.ArgumentTypeError('no such directory: ' + path)
+    return os.path.join(path, '')  # the scripts expect directories to end in /
+
+
+def threshold(args):
+    from threshold import threshold_maps, sdm_map_pairs
+
+    pairs = [(z[:-len('_z.nii.gz')] + '_p.nii.gz', z) for z in args.z_maps]
+    if args.regex:
+        pairs += sdm_map_pairs(args.directory, args.regex)
+    missing = [p for p, _ in pairs if not os.path.isfile(p)]
+    if missing:
+        raise SystemExit('no p map for: ' + ', '.join(missing))
+    threshold_maps(pairs, args.p, args.z, args.extent, n_workers=args.workers, slab_size=args.slab_size)
+
+
+def combine(args):
+    from combine_subgroups import combine_subgroups
+
+    for out_file, status in combine_subgroups(args.csv, args.maps_dir, args.out_dir, workers=args.workers,
+                                              dry_run=args.dry_run, rebuild=args.rebuild):
+        print '%-12s %s' % (status, out_file)
+
+
+def conjunction(args):
+    from conjunction import conjunction_maps
+
+    clusters = conjunction_maps([tuple(m) for m in args.map], [tuple(c) for c in args.conjunction or []] or None,
+                                args.p, args.z, args.extent, method=args.method, out_dir=args.out_dir,
+                                write_maps=args.write_maps, csv_name=args.csv)
+    print clusters.to_string()
+
+
+def check_jk(args):
+    from check_jk_niftis import check_jk_niftis
+    from tracing import set_verbose
+
+    set_verbose(not args.quiet)
+    kwargs = {'regex': args.regex} if args.regex else {}
+    output = check_jk_niftis([args.positive, args.negative], args.jk_dir, csv_name=args.csv, metareg=args.metareg,
+                             use_index=args.index, use_stack=args.stack, n_workers=args.workers,
+                             slab_size=args.slab_size, **kwargs)
+    if args.quiet:
+        print output.to_string()
+
+
+def jackknife(args):
+    from native_jackknife import native_jackknife
+
+    native_jackknife(args.ma_dir, args.analysis_name, selection_column=args.filter, out_dir=args.out_dir)
+
+
+def run(args):
+    from whole_ma_script import run_entire_meta_analysis
+
+    run_entire_meta_analysis(args.ma_dir, args.sdm_path, args.analysis_name, args.metareg, filter_var=args.filter,
+                             n_workers=args.workers, sidecar_dir=args.sidecar_dir,
+                             threshold_engine=args.threshold_engine, jackknife_engine=args.jackknife_engine,
+                             rebuild=args.rebuild, trace_file=args.trace, verbose=not args.quiet,
+                             max_concurrent=args.max_concurrent, sdm_timeout=args.timeout, sdm_retries=args.retries,
+                             log_dir=args.log_dir, extract_store=args.extract_store)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description='Scripts for SDM meta-analyses')
+    commands = parser.add_subparsers(title='commands', dest='command')
+    commands.required = True
+
+    p = commands.add_parser('threshold', help='threshold z maps as SDM does (both tails, SDM file names)')
+    p.add_argument('z_maps', nargs='*', type=existing_file, help='z maps (name_z.nii.gz, with name_p.nii.gz)')
+    p.add_argument('--directory', type=existing_dir, default='.', help='directory to search with --regex')
+    p.add_argument('--regex', help=r"regex for z maps to threshold in --directory, e.g. '.+JK.+(?<!QH)_z\.nii\.gz$'")
+    p.add_argument('-p', type=float, default=0.005, help='p threshold (default 0.005)')
+    p.add_argument('-z', type=float, default=1, help='peak height threshold (default 1)')
+    p.add_argument('-k', '--extent', type=int, default=10, help='extent threshold in voxels (default 10)')
+    p.add_argument('--workers', type=int, help='number of processes (default one per core)')
+    p.add_argument('--slab-size', type=int, help='z-planes to read at once, for maps too big to load whole')
+    p.set_defaults(func=threshold)
+
+    p = commands.add_parser('combine', help='combine subgroup maps into one t-map per study')
+    p.add_argument('csv', type=existing_file, help='csv with a row per study')
+    p.add_argument('maps_dir', type=existing_dir, help='directory containing the pp_ maps')
+    p.add_argument('out_dir', type=existing_dir, help='directory to save the combined maps to')
+    p.add_argument('--workers', type=int, help='number of processes (default one per core)')
+    p.add_argument('--dry-run', action='store_true', help='only check the inputs and list what would be done')
+    p.add_argument('--rebuild', action='store_true', help='remake maps that are already up to date')
+    p.set_defaults(func=combine)
+
+    p = commands.add_parser('conjunction', help='conjunctions of several analyses, for every combination of signs')
+    p.add_argument('--map', nargs=3, action='append', required=True, metavar=('NAME', 'P_MAP', 'Z_MAP'),
+                   help='an analysis to combine (give --map for each)')
+    p.add_argument('--conjunction', nargs='+', action='append', metavar='NAME',
+                   help='names of the maps to combine (give --conjunction for each, default every pair)')
+    p.add_argument('-p', type=float, default=0.005, help='p threshold (default 0.005)')
+    p.add_argument('-z', type=float, default=1, help='peak height threshold (default 1)')
+    p.add_argument('-k', '--extent', type=int, default=10, help='extent threshold in voxels (default 10)')
+    p.add_argument('--method', choices=['min', 'intersection'], default='min',
+                   help='minimum statistic, or intersection of the thresholded maps (default min)')
+    p.add_argument('--out-dir', type=existing_dir, help='directory to save the maps to (default that of the first map)')
+    p.add_argument('--write-maps', action='store_true', help='also save the unthresholded conjunction maps')
+    p.add_argument('--csv', default='', help='csv file to save the cluster tables to')
+    p.set_defaults(func=conjunction)
+
+    p = commands.add_parser('check-jk', help='check which clusters disappear in jack-knife (or meta-regression) maps')
+    p.add_argument('positive', type=existing_file, help='thresholded positive map of the original analysis')
+    p.add_argument('negative', type=existing_file, help='thresholded negative map of the original analysis')
+    p.add_argument('jk_dir', type=existing_dir, help='directory containing the thresholded maps to check')
+    p.add_argument('--regex', help='regex getting the study name out of the file names')
+    p.add_argument('--csv', default='', help='csv file to save the results to')
+    p.add_argument('--metareg', action='store_true', help='list the clusters that overlap rather than disappear')
+    group = p.add_mutually_exclusive_group()
+    group.add_argument('--index', action='store_true', help='compare sparse cluster indexes (cluster_index.py)')
+    group.add_argument('--stack', action='store_true', help='check every study at once (result_stack.py)')
+    p.add_argument('--workers', type=int, default=1, help='number of processes to check the studies with')
+    p.add_argument('--slab-size', type=int, help='z-planes to read at once, for maps too big to load whole')
+    p.add_argument('--quiet', action='store_true', help='only print the results table')
+    p.set_defaults(func=check_jk)
+
+    p = commands.add_parser('jackknife', help='compute jack-knife maps from the preprocessed maps, without SDM')
+    p.add_argument('ma_dir', type=existing_dir, help='directory containing the meta-analysis files')
+    p.add_argument('analysis_name', help='outputs are named analysis_name_JK_study')
+    p.add_argument('--filter', help='SDM table column selecting the studies to include')
+    p.add_argument('--out-dir', type=existing_dir, help='directory to write the maps to (default ma_dir)')
+    p.set_defaults(func=jackknife)
+
+    p = commands.add_parser('run', help='run a whole meta-analysis (see whole_ma_script.py)')
+    p.add_argument('ma_dir', type=existing_dir, help='directory containing the meta-analysis files')
+    p.add_argument('sdm_path', type=existing_file, help='path to SDM')
+    p.add_argument('analysis_name', help='name of the analysis')
+    p.add_argument('--metareg', nargs='*', default=[], help='SDM table columns for meta-regressions')
+    p.add_argument('--filter', default='', help='SDM table column selecting the studies to include')
+    p.add_argument('--workers', type=int, default=4, help='jack-knife analyses to run at once (default 4)')
+    p.add_argument('--max-concurrent', type=int, help='stages to run at once (default --workers)')
+    p.add_argument('--timeout', type=float, help='seconds before an SDM command is killed')
+    p.add_argument('--retries', type=int, default=0, help='times to retry a failed SDM command')
+    p.add_argument('--log-dir', help='directory for the output of each SDM command (default ma_dir/sdm_logs)')
+    p.add_argument('--sidecar-dir', help='directory for memory-mapped copies of the result maps')
+    p.add_argument('--extract-store', help='Parquet store to add the extracted values to (needs pyarrow)')
+    p.add_argument('--threshold-engine', choices=['sdm', 'numpy'], default='sdm')
+    p.add_argument('--jackknife-engine', choices=['sdm', 'native'], default='sdm')
+    p.add_argument('--rebuild', action='store_true', help='run every stage, even the ones that are up to date')
+    p.add_argument('--trace', help='file to save timings to (.json Chrome trace or .jsonl)')
+    p.add_argument('--quiet', action='store_true', help='no progress messages')
+    p.set_defaults(func=run)
+
+    return parser
+
+
+def main(argv=None):
+    parser = make_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'threshold' and not args.z_maps and not args.regex:
+        parser.error('give z maps or --regex')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
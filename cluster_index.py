@@ -0,0 +1,180 @@
+import os
+import re
+
+import numpy as np
+from threshold import STRUCTURE
+
+# ############################################################################################################
+# ## Sparse cluster index for thresholded maps                                                            ##
+# ## A thresholded map is almost all zeros, so rather than keeping the whole volume this keeps, for each   ##
+# ## cluster, the sorted flat indices of its voxels plus its peak voxel and value                          ##
+# ## Indexes are saved next to the map as map.clusters.npz (a few KB) and remade if the map changes       ##
+# ## Overlap between maps is then just an intersection of sorted index arrays                              ##
+# ############################################################################################################
+
+class ClusterIndex(object):
+    """
+    Voxel indices of each cluster in a thresholded map
+
+    Attributes
+    ----------
+    indices: Flat voxel indices (int32) of every cluster, one cluster after another, sorted within each cluster
+    offsets: Where each cluster starts in indices (cluster i is indices[offsets[i]:offsets[i + 1]])
+    peak_index: Flat index of each cluster's peak (the first voxel with the peak value, in np.where order)
+    peak_value: Value at each cluster's peak
+    shape: Shape of the map
+    affine: Affine of the map
+    """
+
+    def __init__(self, indices, offsets, peak_index, peak_value, shape, affine):
+        self.indices = indices
+        self.offsets = offsets
+        self.peak_index = peak_index
+        self.peak_value = peak_value
+        self.shape = tuple(shape)
+        self.affine = affine
+
+    def __len__(self):
+        return len(self.peak_index)
+
+    def cluster(self, i):
+        """
+        Sorted flat voxel indices of cluster i (numbered from 0)
+        """
+        return self.indices[self.offsets[i]:self.offsets[i + 1]]
+
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    def all_indices(self):
+        """
+        Sorted flat indices of every voxel in any cluster
+        """
+        return np.sort(self.indices)
+
+    def overlap(self, other):
+        """
+        Number of voxels of each cluster that are also in a cluster of another map
+
+        Arguments
+        ---------
+        other: ClusterIndex of the other map (or a sorted array of its voxel indices)
+
+        Returns
+        -------
+        Array with the number of overlapping voxels for each cluster
+        """
+        other_indices = other.all_indices() if isinstance(other, ClusterIndex) else other
+        if not len(self.indices):
+            return np.zeros(0, dtype=int)
+        found = np.searchsorted(other_indices, self.indices)
+        found[found == len(other_indices)] = 0
+        present = (other_indices[found] == self.indices) if len(other_indices) else \
+            np.zeros(len(self.indices), dtype=bool)
+        return np.add.reduceat(present.astype(int), self.offsets[:-1])
+
+    def count_nonzero(self, data):
+        """
+        Number of voxels of each cluster where another image (e.g. a jack-knife map) is non-zero
+        The image can be an array or a slab_threshold.SlabMap
+        """
+        if not len(self.indices):
+            return np.zeros(0, dtype=int)
+        present = _values_at(data, self.indices) != 0
+        return np.add.reduceat(present.astype(int), self.offsets[:-1])
+
+    def max_in_clusters(self, data):
+        """
+        Maximum of another image (e.g. a significance map) within each cluster
+        """
+        if not len(self.indices):
+            return np.zeros(0)
+        return np.maximum.reduceat(_values_at(data, self.indices), self.offsets[:-1])
+
+
+def _values_at(data, indices):
+    """
+    Values of an image at flat indices - data can be an array or anything with a take_flat method that reads them from
+    disk (e.g. slab_threshold.SlabMap)
+    """
+    if hasattr(data, 'take_flat'):
+        return data.take_flat(indices)
+    return np.asarray(data).ravel()[indices]
+
+
+def build_cluster_index(data, affine):
+    """
+    Makes a cluster index from a thresholded image
+
+    Arguments
+    ---------
+    data: Thresholded image data (0 outside clusters)
+    affine: Image affine
+
+    Returns
+    -------
+    ClusterIndex, with clusters in the same order as ndimage.label numbers them
+    """
+    from scipy import ndimage
+
+    labeled_array, num_features = ndimage.label(data != 0, structure=STRUCTURE)
+    idx = np.flatnonzero(labeled_array)
+    labels = labeled_array.ravel()[idx]
+    values = np.asarray(data).ravel()[idx]
+
+    order = np.argsort(labels, kind='mergesort')  # stable, so indices stay sorted within each cluster
+    indices = idx[order].astype(np.int32)
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=num_features + 1)[1:])]).astype(np.int64)
+
+    # peak = highest value, first in np.where order on ties
+    peak_order = np.lexsort((idx, -values, labels))
+    first = peak_order[offsets[:-1]]
+
+    return ClusterIndex(indices, offsets, idx[first].astype(np.int32), values[first].astype(np.float32),
+                        labeled_array.shape, affine)
+
+
+def index_path(nifti):
+    """
+    Sidecar file for a map - map.nii.gz -> map.clusters.npz (not .nii.gz.*, so it isn't picked up as a nifti)
+    """
+    return re.sub(r'\.nii(\.gz)?$', '', nifti) + '.clusters.npz'
+
+
+def load_cluster_index(nifti):
+    """
+    Gets the cluster index of a thresholded map, from its sidecar file if it's up to date, otherwise making it
+
+    Arguments
+    ---------
+    nifti: Path to the thresholded map
+
+    Returns
+    -------
+    ClusterIndex
+    """
+    st = os.stat(nifti)
+    source = np.array([st.st_mtime, st.st_size])
+    path = index_path(nifti)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as saved:  # closes the file, the arrays are read in full
+                if np.array_equal(saved['source'], source):
+                    return ClusterIndex(saved['indices'], saved['offsets'], saved['peak_index'], saved['peak_value'],
+                                        saved['shape'], saved['affine'])
+        except (IOError, KeyError, ValueError):
+            pass  # remake it
+
+    import nibabel
+
+    img = nibabel.load(nifti)  # not through the volume cache - only the index is kept
+    index = build_cluster_index(np.asanyarray(img.dataobj), img.affine)
+    try:
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, indices=index.indices, offsets=index.offsets, peak_index=index.peak_index,
+                                peak_value=index.peak_value, shape=np.array(index.shape), affine=index.affine,
+                                source=source)
+    except IOError:
+        pass  # read-only results directory, still fine to use the index
+
+    return index
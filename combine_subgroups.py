@@ -1,84 +1,198 @@
 from __future__ import division
-import nibabel
-import numpy as np
-from numpy import genfromtxt
-import pandas as pd
-from math import gamma, sqrt
+from math import exp, lgamma, sqrt
+import os
 import re
 
-# CHANGE THIS TO YOUR INPUT CSV VILE
-studies = pd.read_csv('C:\Users\k1327409\Google Drive\PhD\MDD BD Meta-analysis\SDM MA Files\Combined groups\combined_studies_mdd.csv')
+# ############################################################################################################
+# ## Combines the subgroup maps of a study (e.g. two patient groups compared with the same controls) into   ##
+# ## one effect size map, weighted by subgroup size, and converts it to a t-map                            ##
+# ## The csv needs columns group_a, group_b, group_c (map names), na, nb, nc (subgroup sizes, nc = 0 if    ##
+# ## there's no third group) and c_n (number of controls)                                                   ##
+# ## Studies are combined in parallel, in float32, and maps that are newer than their inputs are skipped   ##
+# ## if they were made from the same row of the csv (each map has a .params stamp of its maps and sizes)   ##
+# ############################################################################################################
 
+COLUMNS = ['group_a', 'group_b', 'group_c', 'na', 'nb', 'nc', 'c_n']
 
-def to_t(d, n1, n2):
+
+def t_factor(n1, n2):
+    """
+    Factor converting a (Hedges') effect size to a t value for groups of n1 and n2
+    The ratio of gamma functions is worked out from log-gamma, so it doesn't overflow for large studies
+    """
     n = n1 + n2
-    k = gamma((n-3) / 2) / gamma((n-2) / 2) * sqrt((n-2) * n1 * n2 / (2*n))
-    t = d * k
-    return t
-
-
-for i in studies['study']:  # this is so messy
-    print 'Study ' + str(i+1) + ' of ' + str(len(studies['study']))
-    print 'Map 1 = ' + studies['group_a'][i]
-    print 'Map 2 = ' + studies['group_b'][i]
-    if studies['nc'][i] > 0:
-        print 'Map 3 = ' + studies['group_c'][i]
-    print 'N1 = ' + str(studies['na'][i]) + ', N2 = ' + str(studies['nb'][i]) + ', N3 = ' + str(studies['nc'][i])
-
-    # CHANGE THIS PATH TO WHEREVER YOUR MAPS ARE
-    maps_path = 'C:\Users\k1327409\Google Drive\PhD\MDD BD Meta-analysis\SDM MA Files\MDD sMRI/test3/'
-    group1_map = maps_path + 'pp_' + studies['group_a'][i] + '.nii.gz'
-    group2_map = maps_path + 'pp_' + studies['group_b'][i] + '.nii.gz'
-    if studies['nc'][i] > 0:
-        group3_map = maps_path + 'pp_' + studies['group_c'][i] + '.nii.gz'
-    n1 = float(studies['na'][i])
-    n2 = float(studies['nb'][i])
-    n3 = 0
-    control_n = float(studies['c_n'][i])
-    if studies['nc'][i] > 0:
-        n3 = float(studies['nc'][i])
-    n = n1 + n2 + n3
-    print n
-
-    # load group1 nifti/affine/header
-    group1 = nibabel.load(group1_map)
-    group1_data = group1.get_data()
-    group1_aff = group1.get_affine()
-    group1_hdr = group1.get_header()
-
-    # load group2 nifti/affine/header
-
-    group2 = nibabel.load(group2_map)
-    group2_data = group2.get_data()
-    group2_aff = group2.get_affine()
-
-    # load group 3 if it exists
-    if studies['nc'][i] > 0:
-        group3 = nibabel.load(group3_map)
-        group3_data = group3.get_data()
-        group3_aff = group3.get_affine()
-
-    # do magic stats stuff
-
-    # create combined effect size map
-    combined_data = (n1/n) * group1_data + (n2/n) * group2_data
-
-    if studies['nc'][i] > 0:
-        combined_data = (n1/n) * group1_data + (n2/n) * group2_data + (n3/n) * group3_data
-
-    print combined_data
-
-    # create t-map
-    combined_data = to_t(combined_data, n, control_n)
-
-    # save combined t-map
-
-    new_hdr = group1_hdr
-    new_hdr.set_intent('t test', (n-2,))
-
-    img = nibabel.Nifti1Image(combined_data, group1_aff, header=new_hdr)
-    # CHANGE THE BIT BELOW TO WHEREVER YOU WANT THE OUTPUT TO GO
-    out_path = 'C:\Users\k1327409\Google Drive\PhD\MDD BD Meta-analysis\SDM MA Files\Combined groups/'
-    filename = studies['group_a'][i]
-    filename = 'combined_t_' + filename.replace(re.findall('\d+.', filename)[0], re.findall('\d+', filename)[0]) + '_test.nii.gz'
-    img.to_filename(out_path + filename)
+    return exp(lgamma((n-3) / 2) - lgamma((n-2) / 2)) * sqrt((n-2) * n1 * n2 / (2*n))
+
+
+def to_t(d, n1, n2):
+    return d * t_factor(n1, n2)
+
+
+def output_name(group_a):
+    """
+    Name of the combined map of a study, from the name of its first subgroup map
+    """
+    digits = re.findall('\d+.', group_a)
+    if digits:
+        group_a = group_a.replace(digits[0], re.findall('\d+', group_a)[0])
+    return 'combined_t_' + group_a + '_test.nii.gz'
+
+
+def _jobs(csv_file, maps_dir, out_dir):
+    """
+    Reads the csv and checks every row, returning one job per study and a list of problems
+    """
+    import pandas as pd
+
+    studies = pd.read_csv(csv_file)
+    missing_columns = [c for c in COLUMNS if c not in studies.columns and c != 'group_c']
+    if missing_columns:
+        return [], ['%s is missing columns: %s' % (csv_file, ', '.join(missing_columns))]
+
+    jobs = []
+    problems = []
+    for i in range(len(studies)):
+        row = studies.iloc[i]
+        groups = [('group_a', 'na'), ('group_b', 'nb')]
+        if row['nc'] > 0:
+            groups.append(('group_c', 'nc'))
+        maps = []
+        for name_column, n_column in groups:
+            path = os.path.join(maps_dir, 'pp_%s.nii.gz' % row.get(name_column))
+            if not os.path.isfile(path):
+                problems.append('Row %d: no map %s' % (i + 1, path))
+            maps.append((path, float(row[n_column])))
+        n = sum(n_sub for _, n_sub in maps)
+        if n + row['c_n'] <= 3 or min(n_sub for _, n_sub in maps) <= 0 or row['c_n'] <= 0:
+            problems.append('Row %d: group sizes too small for the t conversion' % (i + 1))
+        jobs.append((maps, float(row['c_n']), os.path.join(out_dir, output_name(str(row['group_a'])))))
+
+    outputs = [out_file for _, _, out_file in jobs]
+    for out_file in set(f for f in outputs if outputs.count(f) > 1):
+        problems.append('More than one study would be saved as %s' % out_file)
+
+    return jobs, problems
+
+
+def _stamp_path(out_file):
+    return out_file[:-len('.nii.gz')] + '.params'
+
+
+def _stamp(job):
+    """
+    Hash of a study's input maps, subgroup sizes and number of controls
+    """
+    import hashlib
+
+    maps, control_n, _ = job
+    return hashlib.md5(repr((maps, control_n)).encode('utf-8')).hexdigest()
+
+
+def _up_to_date(job):
+    maps, _, out_file = job
+    if not os.path.exists(out_file):
+        return False
+    try:
+        with open(_stamp_path(out_file)) as f:
+            if f.read().strip() != _stamp(job):  # made from a different row of the csv
+                return False
+    except IOError:  # no stamp - made before stamps, or stopped before it was written
+        return False
+    out_time = os.path.getmtime(out_file)
+    return all(os.path.getmtime(path) <= out_time for path, _ in maps)
+
+
+def _combine_study(job):
+    """
+    Combines the subgroup maps of one study and saves the t-map
+    """
+    import nibabel
+    import numpy as np
+
+    maps, control_n, out_file = job
+    n = sum(n_sub for _, n_sub in maps)
+
+    combined_data = None
+    for path, n_sub in maps:
+        img = nibabel.load(path)  # not through the volume cache - each map is only read once
+        affine, header = img.affine, img.header
+        weighted = np.float32(n_sub / n) * np.asarray(np.asanyarray(img.dataobj), dtype=np.float32)
+        if combined_data is None:
+            combined_data, first_affine, first_header = weighted, affine, header
+        else:
+            combined_data += weighted
+
+    combined_data *= np.float32(t_factor(n, control_n))
+
+    first_header.set_data_dtype(np.float32)
+    first_header.set_intent('t test', (n-2,))
+    img = nibabel.Nifti1Image(combined_data, first_affine, header=first_header)
+    tmp = out_file + '.tmp.nii.gz'  # so a half-written map never looks up to date
+    img.to_filename(tmp)
+    if os.path.exists(out_file):
+        os.remove(out_file)
+    os.rename(tmp, out_file)
+    with open(_stamp_path(out_file), 'w') as f:  # written last, so a map without its stamp gets remade
+        f.write(_stamp(job) + '\n')
+
+    return out_file
+
+
+def combine_subgroups(csv_file, maps_dir, out_dir, workers=None, dry_run=False, rebuild=False):
+    """
+    Combines the subgroup maps of each study in a csv file and saves them as t-maps
+
+    Arguments
+    ---------
+    csv_file: csv file with a row per study (see above for the columns)
+    maps_dir: Directory containing the preprocessed maps (pp_<map name>.nii.gz)
+    out_dir: Directory to save the combined maps to (combined_t_<group_a name>_test.nii.gz)
+    workers: Number of processes to use (optional, defaults to the number of cores)
+    dry_run: Only check the csv and input maps and report what would be done (optional)
+    rebuild: Remake maps that are already up to date (optional)
+
+    Returns
+    -------
+    List of (output map, status) tuples - status is 'written', 'up to date' or, for a dry run, 'to write'
+
+    Raises ValueError listing every problem found (missing maps, group sizes) before anything is written
+    """
+    from tracing import log
+
+    jobs, problems = _jobs(csv_file, maps_dir, out_dir)
+    if problems:
+        raise ValueError('\n'.join(problems))
+
+    todo = [job for job in jobs if rebuild or not _up_to_date(job)]
+    results = dict((job[2], 'up to date') for job in jobs)
+    log('%d studies, %d up to date' % (len(jobs), len(jobs) - len(todo)))
+
+    if dry_run:
+        for job in todo:
+            results[job[2]] = 'to write'
+    elif todo:
+        if workers == 1 or len(todo) < 2:
+            written = [_combine_study(job) for job in todo]
+        else:
+            from multiprocessing import Pool
+
+            pool = Pool(workers)
+            try:
+                written = pool.map(_combine_study, todo)
+            finally:
+                pool.close()
+                pool.join()
+        for out_file in written:
+            log('Saved ' + out_file)
+            results[out_file] = 'written'
+
+    return [(job[2], results[job[2]]) for job in jobs]
+
+
+# Example
+"""
+combine_subgroups('C:/Users/k1327409/Google Drive/PhD/MDD BD Meta-analysis/SDM MA Files/Combined groups/combined_studies_mdd.csv',
+                  'C:/Users/k1327409/Google Drive/PhD/MDD BD Meta-analysis/SDM MA Files/MDD sMRI/test3/',
+                  'C:/Users/k1327409/Google Drive/PhD/MDD BD Meta-analysis/SDM MA Files/Combined groups/',
+                  workers=4)
+"""
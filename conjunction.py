@@ -0,0 +1,175 @@
+import itertools
+import os
+
+import numpy as np
+from threshold import extent_filter, _write_thresholded
+from volume_cache import load_volume
+
+# ############################################################################################################
+# ## Conjunctions of several analyses (e.g. MDD_neg_BD_neg) for every combination of signs at once          ##
+# ## The p and z maps of every analysis are stacked into one array, both tails are thresholded together,    ##
+# ## and each conjunction is a gather and a reduction over that stack - no map is written by hand first     ##
+# ## method='min': minimum statistic - a voxel passes if it passes the height thresholds in every map, and  ##
+# ##               its value is the smallest z (and significance) of the maps, then the extent threshold    ##
+# ## method='intersection': each map is thresholded on its own (height and extent), the surviving voxels    ##
+# ##               are intersected, and the extent threshold is applied again to what's left                ##
+# ## Each result goes through extent_filter, as in threshold_img, and all the cluster tables go in one csv  ##
+# ############################################################################################################
+
+SIGN_NAMES = ('pos', 'neg')
+
+
+def conjunction_name(members):
+    """
+    Name of a conjunction from (map name, sign) pairs - e.g. [('MDD', 'neg'), ('BD', 'neg')] -> MDD_neg_BD_neg
+    """
+    return '_'.join('%s_%s' % (name, sign) for name, sign in members)
+
+
+def _stack_maps(maps, p_threshold, z_threshold):
+    """
+    Loads the maps into stacks of tails x maps x voxels: z values with the sign of the tail (so higher is always more
+    significant), significance as 1 - p (the p map for the positive tail, 1 - the p map for the negative one) and
+    whether each voxel passes the height thresholds, as threshold.threshold_pair works them out
+    """
+    z_data = []
+    p_data = []
+    for name, p_image, z_image in maps:
+        z, affine, _ = load_volume(z_image)
+        z_data.append(np.asarray(z, dtype=np.float32))
+        p_data.append(np.asarray(load_volume(p_image)[0], dtype=np.float32))
+    z_data = np.stack(z_data)
+    p_data = np.stack(p_data)
+
+    values = np.stack([z_data, -z_data])
+    sig = np.stack([p_data, 1 - p_data])
+    passed = np.stack([(p_data >= 1 - p_threshold) & (z_data >= z_threshold) & (z_data != 0),
+                       (p_data <= p_threshold) & (z_data <= -z_threshold) & (z_data != 0)])
+
+    return values, sig, passed, affine
+
+
+def _cluster_table(labeled_array, num_features, values, sig, affine):
+    """
+    Size, peak value, significance and coordinates of each cluster of a labelled map - the peak is the first voxel
+    with the highest value, in np.where order, as in cluster_index.build_cluster_index
+    """
+    idx = np.flatnonzero(labeled_array)
+    labels = labeled_array.ravel()[idx]
+    peak_values = values.ravel()[idx]
+
+    sizes = np.bincount(labels, minlength=num_features + 1)[1:]
+    order = np.lexsort((idx, -peak_values, labels))
+    first = order[np.concatenate([[0], np.cumsum(sizes)[:-1]])] if num_features else np.zeros(0, dtype=int)
+    peak_index = idx[first]
+    voxels = np.column_stack(np.unravel_index(peak_index, labeled_array.shape) + (np.ones(len(peak_index)),))
+    coords = voxels.dot(affine.T)[:, :3] if len(peak_index) else np.zeros((0, 3))
+
+    return sizes, peak_values[first], sig.ravel()[peak_index], coords
+
+
+def conjunction_maps(maps, conjunctions=None, p_threshold=0.005, z_threshold=1, extent=10, method='min',
+                     out_dir=None, write_maps=False, csv_name=''):
+    """
+    Works out conjunctions of several analyses, for every combination of signs, and thresholds them
+
+    Arguments:
+    maps = list of (name, p image, z image) tuples, p images holding 1 - p as SDM writes them,
+           e.g. [('MDD', 'MDD_p.nii.gz', 'MDD_z.nii.gz'), ('BD', 'BD_p.nii.gz', 'BD_z.nii.gz')]
+    conjunctions (Optional) = list of tuples of map names to combine, e.g. [('MDD', 'BD'), ('MDD', 'BD', 'SZ')] -
+                              defaults to every pair of maps
+    p_threshold = p value threshold (e.g. 0.005)
+    z_threshold = z (peak height) threshold (e.g. 1)
+    extent = extent threshold in voxels (e.g. 10)
+    method (Optional) = 'min' (minimum statistic) or 'intersection' (of the thresholded maps), see above
+    out_dir (Optional) = directory to save the maps to, defaults to the directory of the first z image
+    write_maps (Optional) = also save the unthresholded conjunction maps, as name_z.nii.gz and name_p.nii.gz (the
+                            smallest z and significance of the maps, as positive values and 1 - p)
+    csv_name (Optional) = name for a csv file to save the cluster tables to, doesn't save csv if not given
+
+    Returns:
+    clusters = A pandas dataframe with a row for each cluster of each conjunction (named as conjunction_name, e.g.
+               MDD_neg_BD_neg): cluster number (in ndimage.label order), size, peak z (as a positive value), peak p and
+               peak coordinates in mm
+
+    Saves each thresholded conjunction as e.g. MDD_neg_BD_neg_z_thresholded_0.005_1_10.nii.gz, as threshold_img does
+
+    E.g.
+    conjunction_maps([('MDD', 'MDD_p.nii.gz', 'MDD_z.nii.gz'), ('BD', 'BD_p.nii.gz', 'BD_z.nii.gz')], extent=10,
+                     csv_name='conjunctions.csv')
+
+    """
+    import nibabel
+    import pandas as pd
+    from tracing import log
+
+    if method not in ('min', 'intersection'):
+        raise ValueError("method must be 'min' or 'intersection', not %r" % method)
+    names = [name for name, _, _ in maps]
+    if conjunctions is None:
+        conjunctions = list(itertools.combinations(names, 2))
+    unknown = sorted(set(name for conjunction in conjunctions for name in conjunction) - set(names))
+    if unknown:
+        raise ValueError('No maps called: ' + ', '.join(unknown))
+    if out_dir is None:
+        out_dir = os.path.dirname(maps[0][2])
+
+    values, sig, passed, affine = _stack_maps(maps, p_threshold, z_threshold)
+    if method == 'intersection':  # each map's own clusters first
+        for tail in range(2):
+            for k in range(len(maps)):
+                passed[tail, k] = extent_filter(passed[tail, k], extent)[0]
+
+    # every sign combination of every conjunction, as (tail, map) indices into the stacks
+    jobs = []
+    for conjunction in conjunctions:
+        for tails in itertools.product(range(2), repeat=len(conjunction)):
+            jobs.append(([(name, SIGN_NAMES[t]) for name, t in zip(conjunction, tails)],
+                         list(tails), [names.index(name) for name in conjunction]))
+
+    rows = []
+    for size in sorted(set(len(tails) for _, tails, _ in jobs)):  # one gather and reduction per conjunction size
+        group = [job for job in jobs if len(job[1]) == size]
+        tails = np.array([job[1] for job in group])
+        members = np.array([job[2] for job in group])
+        group_mask = passed[tails, members].all(axis=1)
+        member_values = values[tails, members]
+        group_values = member_values.min(axis=1)
+        group_nonzero = (member_values > 0).all(axis=1)  # every map has this sign here
+        del member_values
+        group_sig = sig[tails, members].min(axis=1)
+
+        for i, (conjunction, _, _) in enumerate(group):
+            name = conjunction_name(conjunction)
+            z_name = os.path.join(out_dir, name + '_z.nii.gz')
+            if write_maps:
+                nibabel.Nifti1Image(np.where(group_nonzero[i], group_values[i], 0).astype(np.float32),
+                                    affine).to_filename(z_name)
+                nibabel.Nifti1Image(np.where(group_nonzero[i], group_sig[i], 0).astype(np.float32),
+                                    affine).to_filename(os.path.join(out_dir, name + '_p.nii.gz'))
+
+            mask, labeled_array, num_features = extent_filter(group_mask[i], extent)
+            _write_thresholded(z_name, group_values[i], mask, affine, p_threshold, z_threshold, extent)
+            sizes, peaks, peak_sig, coords = _cluster_table(labeled_array, num_features, group_values[i],
+                                                            group_sig[i], affine)
+            log('%s: %d clusters' % (name, num_features))
+            for c in range(num_features):
+                rows.append([name, c + 1, sizes[c], peaks[c], 1 - peak_sig[c]] + list(coords[c]))
+
+    clusters = pd.DataFrame(rows, columns=['conjunction', 'cluster', 'size', 'peak_z', 'peak_p', 'x', 'y', 'z'])
+    if csv_name:
+        clusters.to_csv(csv_name, index=False)
+
+    return clusters
+
+
+# Example
+"""
+maps = [('MDD', 'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/MDD_praw.nii.gz',
+         'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/MDD_z.nii.gz'),
+        ('BD', 'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/BD_praw.nii.gz',
+         'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/BD_z.nii.gz')]
+
+clusters = conjunction_maps(maps, p_threshold=0.005, z_threshold=0.0638, extent=10, write_maps=True,
+                            csv_name='C:/Users/k1327409/Documents/VBShare/20_05_conjunction/conjunctions.csv')
+"""
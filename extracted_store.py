@@ -0,0 +1,129 @@
+import os
+import re
+import shutil
+
+# ############################################################################################################
+# ## Columnar store of the values extracted at each peak                                                    ##
+# ## extract_all_coordinate_values adds its table to one Parquet dataset when it's given one (store=,       ##
+# ## or extract_store= in run_entire_meta_analysis), partitioned by analysis, with a row per (analysis,     ##
+# ## cluster, study) holding the estimate and variance - re-extracting an analysis replaces its partition,  ##
+# ## so there's only ever one row per key                                                                   ##
+# ## load_extracted() reads only the partitions of the analyses asked for, picks studies by regex, and      ##
+# ## makes the study x cluster table (as add_extracted in meta_reg_plots.R does) in one pivot and one merge ##
+# ## Needs pyarrow, which nothing else here does - so the store is only used when it's asked for            ##
+# ############################################################################################################
+
+STORE_NAME = 'extracted_values.parquet'
+COLUMNS = ['analysis', 'cluster', 'coords', 'study', 'estimate', 'variance']
+
+
+def _partition(store, analysis):
+    return os.path.join(store, 'analysis=' + str(analysis))
+
+
+def append_extracted(values, store):
+    """
+    Adds extracted values to the store, replacing any values already there for the same analyses
+
+    Arguments
+    ---------
+    values: Table of extracted values (from extract_all_coordinate_values)
+    store: Path of the store (a directory, e.g. ma_dir + 'extracted_values.parquet')
+    """
+    if not len(values):
+        return
+    values = values[COLUMNS].copy()
+    values['cluster'] = values['cluster'].astype('int64')
+    values['coords'] = values['coords'].fillna('').astype(str)
+    values['study'] = values['study'].astype(str)
+    values['estimate'] = values['estimate'].astype('float64')
+    values['variance'] = values['variance'].astype('float64')
+    values = values.drop_duplicates(['analysis', 'cluster', 'study'], keep='last')
+
+    for analysis in values['analysis'].unique():
+        if os.path.isdir(_partition(store, analysis)):
+            shutil.rmtree(_partition(store, analysis))
+    values.to_parquet(store, engine='pyarrow', partition_cols=['analysis'], index=False)
+
+
+def stored_analyses(store):
+    """
+    Names of the analyses in the store, from its partition directories (nothing is read)
+    """
+    if not os.path.isdir(store):
+        return []
+    return sorted(d[len('analysis='):] for d in os.listdir(store) if d.startswith('analysis='))
+
+
+def load_extracted(store, analyses=None, study_regex=None, wide=True, sdm_table=None):
+    """
+    Loads extracted values from the store
+
+    Arguments
+    ---------
+    store: Path of the store
+    analyses: Analysis names (or a regex matching them) to load (optional, all of them by default) - only their
+              partitions are read
+    study_regex: Only keep studies whose names match this regex, e.g. 'et_al_.+[^ab]_sMRI' (optional)
+    wide: Return a table with a row per study and estimate and variance columns per cluster, named
+          extract_<analysis>_coords_<cluster>_estimate / _variance as in meta_reg_plots.R (optional, otherwise the
+          long table, as extract_all_coordinate_values returns it)
+    sdm_table: Path of an SDM table to join the wide table to, by study (optional, e.g. ma_dir + 'sdm_table.txt') -
+               only studies in both are kept, as with merge in R
+
+    Returns
+    -------
+    values: A pandas dataframe
+
+    E.g.
+    data = load_extracted(ma_dir + 'extracted_values.parquet', analyses='MDD_.+_1m0|MDD_age', study_regex='_sMRI$',
+                          sdm_table=ma_dir + 'sdm_table.txt')
+    """
+    import pandas as pd
+
+    if isinstance(analyses, basestring):
+        analyses = [a for a in stored_analyses(store) if re.match('(?:%s)$' % analyses, a)]
+    elif analyses is not None:
+        analyses = [a for a in stored_analyses(store) if a in analyses]
+    if not stored_analyses(store) or (analyses is not None and not len(analyses)):  # pyarrow fails on no partitions
+        values = pd.DataFrame(columns=COLUMNS)
+    else:
+        # a set, as older versions of pyarrow (0.16, the last for Python 2) cast the partition value to a list
+        filters = [('analysis', 'in', set(analyses))] if analyses is not None else None
+        values = pd.read_parquet(store, engine='pyarrow', filters=filters)
+        values['analysis'] = values['analysis'].astype(str)  # comes back as a categorical from the partitions
+        values = values[COLUMNS]
+
+    if study_regex:
+        studies = values['study'].unique()  # the regex only runs once per study, not per row
+        keep = [s for s in studies if re.search(study_regex, s)]
+        values = values[values['study'].isin(keep)]
+    values = values.sort_values(['analysis', 'cluster', 'study']).reset_index(drop=True)
+    if not wide:
+        return values
+
+    if len(values):
+        table = values.pivot_table(index='study', columns=['analysis', 'cluster'], values=['estimate', 'variance'],
+                                   aggfunc='first')
+        table = table[sorted(table.columns, key=lambda c: (c[1], c[2], c[0]))]  # estimate and variance together
+        table.columns = ['extract_%s_coords_%d_%s' % (analysis, cluster, value) for value, analysis, cluster in
+                         table.columns]
+        table = table.reset_index()
+    else:
+        table = pd.DataFrame(columns=['study'])
+
+    if sdm_table:
+        studies = pd.read_csv(sdm_table, delimiter='\t')
+        if study_regex:
+            studies = studies[studies['study'].astype(str).str.contains(study_regex)]
+        table = studies.merge(table, on='study')
+
+    return table
+
+
+# Example
+"""
+ma_dir = 'C:/Users/k1327409/Documents/VBShare/24_03/'
+data = load_extracted(ma_dir + 'extracted_values.parquet', analyses='MDD_medication_metareg', study_regex='_sMRI$',
+                      sdm_table=ma_dir + 'sdm_table.txt')
+"""
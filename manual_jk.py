@@ -1,37 +1,26 @@
 __author__ = 'k1327409'
 
-import numpy as np
-import pandas as pd
-import subprocess
-import os
+from sdm_functions import run_jackknife
 
 ######################################################################
 # Very poorly written script to manually run SDM jack-knife analyses #
 ######################################################################
 
-sdm_table = 'C:\Users\k1327409\Documents\VBShare/2602_analysis\Extract\sdm_table.txt'
+ma_dir = 'C:/Users/k1327409/Documents/VBShare/2602_analysis/Extract/'
+sdm_path = 'C:/Users/k1327409/Dropbox/PhD/Things/sdm_v4.12/sdm_v4.12/sdm.bat'
 
-table = pd.read_csv(sdm_table, delimiter='\t')
 
-num_studies = len(table)
+def main():
+    import pandas as pd
 
-selection_var = table['CombinedGroups']
+    table = pd.read_csv(ma_dir + 'sdm_table.txt', delimiter='\t')
 
-selection_var2 = np.ones(len(selection_var))
-selection_var2[10:] = 0
-selection_var2[0:3] = 0
-os.chdir('C:/Users/k1327409/Documents/VBShare/2602_analysis/Extract')
+    # only leave out studies 4-10 in this run
+    studies = list(table['study'][3:10])
+
+    # outputs keep this script's MDD_JackJK<study> names, so they match the results it has already made
+    run_jackknife(ma_dir, sdm_path, 'MDD_Jack', selection_column='CombinedGroups', studies=studies, separator='JK')
 
-sdm_path = 'C:/Users/k1327409/Dropbox/PhD/Things/sdm_v4.12/sdm_v4.12/sdm.bat'
 
-for i in range(1,num_studies):
-    if selection_var[i] == 1 and selection_var2[i] == 1:
-        thing = np.ones(num_studies)
-        thing[i] = 0
-        name = 'MDD_JackJK' + table['study'][thing == 0].values[0]
-        thing[np.where(selection_var == 0)] = 0  # set anything where selection variable is zero to zero in thing
-        table['JK_column'] = thing
-        print name
-        print thing
-        table.to_csv('sdm_table.txt', sep='\t', index=False)
-        subprocess.call([sdm_path, name, ' = ', 'mean', 'JK_column'])
+if __name__ == '__main__':
+    main()
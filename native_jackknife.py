@@ -0,0 +1,145 @@
+import os
+
+import numpy as np
+from study_maps import study_map_paths, selected_studies
+from tracing import log
+
+# ############################################################################################################
+# ## Jack-knife computed directly from the preprocessed study maps, instead of an SDM mean per study        ##
+# ## Each study's effect size and variance maps are read once, and the inverse-variance sums over all       ##
+# ## studies are calculated once - leaving a study out subtracts its terms from these sums, which gives     ##
+# ## the DerSimonian-Laird tau^2 for that iteration at each voxel                                           ##
+# ## The random-effects weights depend on that tau^2, so the pooled estimate is recalculated from the       ##
+# ## maps already in memory                                                                                 ##
+# ## Outputs are written as analysis_JK_study_z.nii.gz and analysis_JK_study_p.nii.gz (p maps hold 1 - p,    ##
+# ## one-tailed) so they can go straight into threshold.threshold_maps                                      ##
+# ## Note these are normal z values, not SDM's permutation-based ones                                       ##
+# ############################################################################################################
+
+
+def load_study_maps(ma_dir, studies):
+    """
+    Loads the effect size and variance maps of each study, keeping only voxels with data in at least one study
+
+    Arguments
+    ---------
+    ma_dir: Directory containing the preprocessed study maps
+    studies: List of study names
+
+    Returns
+    -------
+    effects: Array of effect sizes (studies x voxels)
+    variances: Array of variances (studies x voxels)
+    voxels: Flat indices of the voxels kept
+    affine: Affine of the maps
+    shape: Shape of the maps
+    """
+    import nibabel
+
+    effects = []
+    variances = []
+    for study in studies:
+        effect_map, variance_map = study_map_paths(ma_dir, study)
+        img = nibabel.load(effect_map)
+        # asanyarray first - older nibabel's proxies can't take a dtype
+        effects.append(np.asarray(np.asanyarray(img.dataobj), dtype=np.float32).ravel())
+        variances.append(np.asarray(np.asanyarray(nibabel.load(variance_map).dataobj), dtype=np.float32).ravel())
+        affine, shape = img.affine, img.shape
+
+    effects = np.array(effects)
+    variances = np.array(variances)
+    voxels = np.flatnonzero(np.any(np.isfinite(variances) & (variances > 0), axis=0))
+
+    return effects[:, voxels], variances[:, voxels], voxels, affine, shape
+
+
+def leave_one_out(effects, variances):
+    """
+    Random-effects (DerSimonian-Laird) pooled z values leaving out each study in turn
+
+    Arguments
+    ---------
+    effects: Array of effect sizes (studies x voxels)
+    variances: Array of variances (studies x voxels)
+
+    Yields
+    ------
+    Index of the study left out and an array of z values for each voxel (0 where fewer than 2 studies are left)
+    """
+    valid = np.isfinite(effects) & np.isfinite(variances) & (variances > 0)
+    v = np.where(valid, variances, 1).astype(np.float64)
+    y = np.where(valid, effects, 0).astype(np.float64)
+    w = np.where(valid, 1 / v, 0)
+
+    # fixed-effect sums over all studies
+    sum_w = w.sum(0)
+    sum_w2 = (w ** 2).sum(0)
+    sum_wy = (w * y).sum(0)
+    sum_wy2 = (w * y ** 2).sum(0)
+    k_all = valid.sum(0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for j in range(len(effects)):
+            # take study j out of the sums
+            s_w = sum_w - w[j]
+            s_w2 = sum_w2 - w[j] ** 2
+            s_wy = sum_wy - w[j] * y[j]
+            s_wy2 = sum_wy2 - w[j] * y[j] ** 2
+            k = k_all - valid[j]
+
+            q = s_wy2 - s_wy ** 2 / s_w
+            c = s_w - s_w2 / s_w
+            tau2 = np.maximum(0, (q - (k - 1)) / c)
+            tau2[~np.isfinite(tau2)] = 0
+
+            w_re = np.where(valid, 1 / (v + tau2), 0)
+            w_re[j] = 0
+            sum_w_re = w_re.sum(0)
+            z = (w_re * y).sum(0) / np.sqrt(sum_w_re)  # estimate / standard error
+            z[(k < 2) | ~np.isfinite(z)] = 0
+
+            yield j, z
+
+
+def native_jackknife(ma_dir, analysis_name, selection_column=None, out_dir=None):
+    """
+    Runs a jack-knife analysis from the preprocessed study maps, without running SDM
+
+    Arguments
+    ---------
+    ma_dir: Directory containing the meta-analysis files
+    analysis_name: Name of the analysis, outputs are named analysis_name_JK_study_z/_p.nii.gz
+    selection_column: Column in the SDM table selecting the studies to include (optional)
+    out_dir: Directory to write the maps to (optional, defaults to ma_dir)
+
+    Returns
+    -------
+    outputs: List of (p map, z map) tuples written, one per study
+    """
+    import nibabel
+    from scipy.special import ndtr
+
+    out_dir = out_dir or ma_dir
+    studies = selected_studies(ma_dir, selection_column)
+    effects, variances, voxels, affine, shape = load_study_maps(ma_dir, studies)
+
+    outputs = []
+    for j, z in leave_one_out(effects, variances):
+        name = os.path.join(out_dir, analysis_name + '_JK_' + studies[j])
+        z_map = np.zeros(int(np.prod(shape)), dtype=np.float32)
+        z_map[voxels] = z
+        p_map = np.zeros_like(z_map)
+        p_map[voxels] = ndtr(z)
+        nibabel.Nifti1Image(z_map.reshape(shape), affine).to_filename(name + '_z.nii.gz')
+        nibabel.Nifti1Image(p_map.reshape(shape), affine).to_filename(name + '_p.nii.gz')
+        log("Written " + name)
+        outputs.append((name + '_p.nii.gz', name + '_z.nii.gz'))
+
+    return outputs
+
+
+# Example
+"""
+pairs = native_jackknife('C:/Users/k1327409/Documents/VBShare/MDD_sMRI/Analysis_0901/', '0403_MDD', 'CombinedGroups')
+threshold_maps(pairs, 0.005, 1, 10)
+"""
@@ -0,0 +1,201 @@
+import os
+import re
+
+import numpy as np
+
+# ############################################################################################################
+# ## Random-effects meta-analyses and Egger's tests of the values extracted at each peak, in Python        ##
+# ## Does what load_extracted_data.R does with metafor, for every cluster at once - the extracted values    ##
+# ## go into clusters x studies matrices of estimates and variances (NaN where a study is missing), and     ##
+# ## the DerSimonian-Laird model and Egger's regression are sums along the study axis                      ##
+# ## Egger's test is the classic regression of y / se on 1 / se (regtest(ma, model='lm') in metafor)       ##
+# ############################################################################################################
+
+COLUMNS = ['analysis', 'cluster', 'coords', 'study', 'estimate', 'variance']
+
+
+def read_extract_files(ma_dir, regex=r'^extract_(.+)\.txt$'):
+    """
+    Reads every extract_*.txt file SDM has written in a directory into one table
+
+    Arguments
+    ---------
+    ma_dir: Directory containing the extract files
+    regex: Regex matching the extract files, its first group being the name of the mask (optional)
+
+    Returns
+    -------
+    values: A pandas dataframe with a row per study per file, in the same form as
+            sdm_functions.extract_all_coordinate_values - files named prefix_coords_# (as that function names them)
+            get analysis prefix and cluster #, others the mask name and cluster 0, and coords are left empty
+    """
+    import pandas as pd
+
+    tables = []
+    for f in sorted(os.listdir(ma_dir)):
+        match = re.match(regex, f)
+        if not match:
+            continue
+        data = pd.read_csv(os.path.join(ma_dir, f), sep=r'\s+').iloc[:, :3]  # study, estimate, variance
+        data.columns = ['study', 'estimate', 'variance']
+        name = re.match(r'^(.+)_coords_(\d+)$', match.group(1))
+        data.insert(0, 'coords', '')
+        data.insert(0, 'cluster', int(name.group(2)) if name else 0)
+        data.insert(0, 'analysis', name.group(1) if name else match.group(1))
+        tables.append(data)
+
+    return pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=COLUMNS)
+
+
+def study_matrices(values, study_regex=None):
+    """
+    Puts extracted values into clusters x studies matrices
+
+    Arguments
+    ---------
+    values: Table of extracted values (from extract_all_coordinate_values or read_extract_files)
+    study_regex: Only use studies whose names match this regex, e.g. 'et_al_.+[^ab]_sMRI' (optional)
+
+    Returns
+    -------
+    clusters: A pandas dataframe with the analysis, cluster and coords of each row of the matrices
+    estimates: Array of clusters x studies, NaN where a study has no value
+    variances: Array of clusters x studies, NaN where a study has no value (or a variance that isn't above 0)
+    """
+    if study_regex:
+        values = values[values['study'].astype(str).str.contains(study_regex)]
+    values = values.assign(coords=values['coords'].fillna(''))
+    keys = ['analysis', 'cluster', 'coords']
+    estimates = values.pivot_table(index=keys, columns='study', values='estimate', aggfunc='first')
+    variances = values.pivot_table(index=keys, columns='study', values='variance', aggfunc='first')
+    variances = variances.reindex(index=estimates.index, columns=estimates.columns)
+
+    y = estimates.values.astype(float)
+    v = variances.values.astype(float)
+    missing = np.isnan(y) | ~(v > 0)
+    y[missing] = np.nan
+    v[missing] = np.nan
+
+    return estimates.index.to_frame(index=False), y, v
+
+
+def dersimonian_laird(y, v):
+    """
+    DerSimonian-Laird random-effects meta-analysis of each row of a matrix of estimates
+
+    Arguments
+    ---------
+    y: Array of clusters x studies of estimates, NaN for missing studies
+    v: Array of clusters x studies of variances, NaN for missing studies
+
+    Returns
+    -------
+    Dictionary of arrays with a value per cluster - k (number of studies), estimate, se, z, p, ci_lower, ci_upper,
+    tau2, Q, Q_p and I2 (%)
+    """
+    from scipy import stats
+
+    valid = ~(np.isnan(y) | np.isnan(v))
+    y0 = np.where(valid, y, 0)
+    w = np.where(valid, 1 / np.where(valid, v, 1), 0)
+    k = valid.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sum_w = w.sum(axis=1)
+        fixed = (w * y0).sum(axis=1) / sum_w
+        q = (w * (y0 - fixed[:, None]) ** 2).sum(axis=1)
+        c = sum_w - (w ** 2).sum(axis=1) / sum_w
+        tau2 = np.where(k > 1, np.maximum(0, (q - (k - 1)) / c), 0)
+        tau2[np.isnan(tau2)] = 0  # one study, or all with the same weight and estimate
+
+        w_random = np.where(valid, 1 / (np.where(valid, v, 1) + tau2[:, None]), 0)
+        sum_w_random = w_random.sum(axis=1)
+        estimate = (w_random * y0).sum(axis=1) / sum_w_random
+        se = np.sqrt(1 / sum_w_random)
+        z = estimate / se
+        i2 = np.where(q > 0, np.maximum(0, (q - (k - 1)) / q), 0) * 100
+
+    q = np.where(k > 1, q, np.nan)
+    return {'k': k, 'estimate': estimate, 'se': se, 'z': z, 'p': 2 * stats.norm.sf(np.abs(z)),
+            'ci_lower': estimate - stats.norm.ppf(0.975) * se, 'ci_upper': estimate + stats.norm.ppf(0.975) * se,
+            'tau2': tau2, 'Q': q, 'Q_p': stats.chi2.sf(q, k - 1), 'I2': np.where(k > 1, i2, np.nan)}
+
+
+def egger_test(y, v):
+    """
+    Egger's regression test for funnel plot asymmetry of each row of a matrix of estimates - the intercept of an
+    ordinary least squares regression of y / se on 1 / se, with a t test on k - 2 degrees of freedom
+
+    Arguments
+    ---------
+    y: Array of clusters x studies of estimates, NaN for missing studies
+    v: Array of clusters x studies of variances, NaN for missing studies
+
+    Returns
+    -------
+    Dictionary of arrays with a value per cluster - egger_intercept, egger_se, egger_t, egger_p (NaN for clusters
+    with fewer than 3 studies)
+    """
+    from scipy import stats
+
+    valid = ~(np.isnan(y) | np.isnan(v))
+    se = np.sqrt(np.where(valid, v, 1))
+    x = np.where(valid, 1 / se, 0)  # precision
+    t = np.where(valid, y / se, 0)  # standardised effect
+    n = valid.sum(axis=1).astype(float)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sum_x, sum_t = x.sum(axis=1), t.sum(axis=1)
+        sum_xx, sum_xt = (x * x).sum(axis=1), (x * t).sum(axis=1)
+        det = n * sum_xx - sum_x ** 2
+        slope = (n * sum_xt - sum_x * sum_t) / det
+        intercept = (sum_t - slope * sum_x) / n
+        residuals = np.where(valid, t - intercept[:, None] - slope[:, None] * x, 0)
+        s2 = (residuals ** 2).sum(axis=1) / (n - 2)
+        intercept_se = np.sqrt(s2 * sum_xx / det)
+        t_value = intercept / intercept_se
+
+    enough = n > 2
+    return {'egger_intercept': np.where(enough, intercept, np.nan), 'egger_se': np.where(enough, intercept_se, np.nan),
+            'egger_t': np.where(enough, t_value, np.nan),
+            'egger_p': np.where(enough, 2 * stats.t.sf(np.abs(t_value), np.maximum(n - 2, 1)), np.nan)}
+
+
+def cluster_meta_analyses(values, study_regex=None, csv_name=''):
+    """
+    Random-effects meta-analysis and Egger's test of the extracted values of every cluster
+
+    Arguments
+    ---------
+    values: Table of extracted values (from extract_all_coordinate_values or read_extract_files), or a csv of one
+    study_regex: Only use studies whose names match this regex, e.g. 'et_al_.+[^ab]_sMRI' (optional)
+    csv_name: Name for a csv file to save the results to (optional, doesn't save csv if not given)
+
+    Returns
+    -------
+    results: A pandas dataframe with a row per cluster - analysis, cluster, coords, then the columns of
+             dersimonian_laird and egger_test
+    """
+    import pandas as pd
+
+    if isinstance(values, basestring):
+        values = pd.read_csv(values)
+    clusters, y, v = study_matrices(values, study_regex)
+
+    results = clusters
+    for name, column in sorted(dersimonian_laird(y, v).items()) + sorted(egger_test(y, v).items()):
+        results[name] = column
+    results = results[['analysis', 'cluster', 'coords', 'k', 'estimate', 'se', 'z', 'p', 'ci_lower', 'ci_upper',
+                       'tau2', 'Q', 'Q_p', 'I2', 'egger_intercept', 'egger_se', 'egger_t', 'egger_p']]
+    if csv_name:
+        results.to_csv(csv_name, index=False)
+
+    return results
+
+
+# Example
+"""
+values = read_extract_files('C:/Users/k1327409/Documents/VBShare/24_03/')
+results = cluster_meta_analyses(values, study_regex='et_al_.+[^ab]_sMRI',
+                                csv_name='C:/Users/k1327409/Documents/VBShare/24_03/random_effects.csv')
+"""
@@ -0,0 +1,152 @@
+import hashlib
+import os
+
+import numpy as np
+
+# ############################################################################################################
+# ## Thresholded jack-knife (or meta-regression) maps of every study stacked into one file                 ##
+# ## Each map is kept as a bitmask of its significant voxels, in an array of studies x sign x voxels, with  ##
+# ## the study names as an index - so a whole analysis is a few MB and one file read                       ##
+# ## Whether each original cluster is present for each study is then one reduction over all the studies    ##
+# ############################################################################################################
+
+SIGNS = ('p', 'n')  # positive and negative maps
+
+
+class ResultStack(object):
+    """
+    Significant voxels of the positive and negative thresholded maps of a set of studies
+
+    Attributes
+    ----------
+    studies: Study names, in the order they're stacked
+    bits: uint8 array of studies x 2 (positive, negative) x packed voxels (np.packbits of the flattened map != 0)
+    shape: Shape of the maps
+    affine: Affine of the maps
+    """
+
+    def __init__(self, studies, bits, shape, affine):
+        self.studies = list(studies)
+        self.bits = bits
+        self.shape = tuple(shape)
+        self.affine = affine
+
+    def presence(self, study, sign='p'):
+        """
+        Boolean map of the significant voxels of a study's positive ('p') or negative ('n') map
+        """
+        bits = self.bits[self.studies.index(study), SIGNS.index(sign)]
+        return np.unpackbits(bits)[:int(np.prod(self.shape))].astype(bool).reshape(self.shape)
+
+    def cluster_overlaps(self, original_index, sign='p'):
+        """
+        Number of voxels of each original cluster that are significant in each study's map
+
+        Arguments
+        ---------
+        original_index: ClusterIndex of the original thresholded map (see cluster_index.py)
+        sign: 'p' for the positive maps, 'n' for the negative ones
+
+        Returns
+        -------
+        Array of studies x clusters
+        """
+        if not len(original_index):
+            return np.zeros((len(self.studies), 0), dtype=int)
+        idx = original_index.indices
+        packed = self.bits[:, SIGNS.index(sign), idx >> 3]  # byte holding each cluster voxel, for every study
+        present = (packed >> (7 - (idx & 7)).astype(np.uint8)) & 1
+        return np.add.reduceat(present.astype(int), original_index.offsets[:-1], axis=1)
+
+
+def _sources(files_by_study):
+    sources = []
+    for study in sorted(files_by_study):
+        for sign in SIGNS:
+            path = files_by_study[study].get(sign)
+            if path:
+                st = os.stat(path)
+                sources.append('%s %s %s %r %d' % (study, sign, os.path.basename(path), st.st_mtime, st.st_size))
+    return sources
+
+
+def stack_path(directory, files_by_study):
+    """
+    Stack file for a set of maps - named after the maps, so JK and meta-regression stacks can share a directory
+    """
+    names = sorted(os.path.basename(path) for files in files_by_study.values() for path in files.values())
+    return os.path.join(directory, 'result_stack_' + hashlib.md5('\n'.join(names).encode('utf-8')).hexdigest()[:8] +
+                        '.npz')
+
+
+def build_result_stack(files_by_study):
+    """
+    Stacks the thresholded maps of a set of studies
+
+    Arguments
+    ---------
+    files_by_study: Dictionary of study name: {'p': positive map, 'n': negative map} - a missing map counts as empty
+
+    Returns
+    -------
+    ResultStack, with studies in sorted order
+    """
+    import nibabel
+
+    studies = sorted(files_by_study)
+    bits = None
+    shape = affine = None
+    for i, study in enumerate(studies):
+        for j, sign in enumerate(SIGNS):
+            path = files_by_study[study].get(sign)
+            if not path:
+                continue
+            img = nibabel.load(path)  # not through the volume cache - only the bits are kept
+            data, map_affine = np.asanyarray(img.dataobj), img.affine
+            if bits is None:
+                shape, affine = data.shape, map_affine
+                bits = np.zeros((len(studies), len(SIGNS), (data.size + 7) // 8), dtype=np.uint8)
+            bits[i, j] = np.packbits(np.asarray(data).ravel() != 0)
+
+    if bits is None:
+        bits = np.zeros((len(studies), len(SIGNS), 0), dtype=np.uint8)
+        shape, affine = (0, 0, 0), np.eye(4)
+
+    return ResultStack(studies, bits, shape, affine)
+
+
+def load_result_stack(files_by_study, directory=None):
+    """
+    Gets the stack of a set of thresholded maps, from its file if none of the maps have changed, otherwise making it
+
+    Arguments
+    ---------
+    files_by_study: Dictionary of study name: {'p': positive map, 'n': negative map}
+    directory: Directory to keep the stack file in (optional, defaults to the directory of the maps)
+
+    Returns
+    -------
+    ResultStack
+    """
+    sources = np.array(_sources(files_by_study))
+    if directory is None:
+        paths = [path for files in files_by_study.values() for path in files.values()]
+        directory = os.path.dirname(paths[0]) if paths else '.'
+    path = stack_path(directory, files_by_study)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as saved:  # closes the file, the arrays are read in full
+                if np.array_equal(saved['sources'], sources):
+                    return ResultStack(saved['studies'], saved['bits'], saved['shape'], saved['affine'])
+        except (IOError, KeyError, ValueError):
+            pass  # remake it
+
+    stack = build_result_stack(files_by_study)
+    try:
+        with open(path, 'wb') as f:
+            np.savez_compressed(f, studies=np.array(stack.studies), bits=stack.bits, shape=np.array(stack.shape),
+                                affine=stack.affine, sources=sources)
+    except IOError:
+        pass  # read-only directory, still fine to use the stack
+
+    return stack
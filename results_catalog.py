@@ -0,0 +1,216 @@
+import json
+import os
+import re
+import threading
+import time
+
+# ############################################################################################################
+# ## Catalog of the SDM outputs in an analysis directory                                                  ##
+# ## Every output file name is parsed once into a record - analysis, kind (mean, JK, lm or other),          ##
+# ## left-out study, whether it's a heterogeneity (QH) map, statistic, threshold settings, sign and file    ##
+# ## type - and kept in .results_catalog.json in the directory. The directory is only listed again when its ##
+# ## modification time changes, and then only new file names are parsed                                     ##
+# ## Names are matched as loosely as the regexes they replace - JK anywhere in the name, mean in any case,  ##
+# ## and thresholds written with or without the _ after _z_p                                                ##
+# ## Records are grouped by kind and file type, so finding e.g. the thresholded jack-knife reports is one   ##
+# ## dictionary lookup and a filter of that group, rather than a regex over every file in the directory    ##
+# ############################################################################################################
+
+CATALOG_NAME = '.results_catalog.json'
+CATALOG_VERSION = 2  # saved catalogs of other versions are parsed again
+
+# e.g. MDD_JK_smith_z.htm, MDD_mean_QH_p.nii.gz, MDD_age_1m0_z_p_0.00050_1.000_10_neg_p.nii.gz,
+# MDD_Mean_z_p0.00500_1.000_10.htm
+OUTPUT_REGEX = re.compile(r'^(?P<stem>.+?)_(?P<statistic>z|p)'
+                          r'(?:_p_?(?P<p>\d+\.\d+)_(?P<z>\d+\.\d+)_(?P<extent>\d+)(?P<neg>_neg)?(?P<sig>_p)?)?'
+                          r'\.(?P<file_type>nii\.gz|nii|htm)$')
+
+_lock = threading.Lock()
+
+
+def parse_output_name(name):
+    """
+    Parses the name of an SDM output file
+
+    Arguments
+    ---------
+    name: File name (without the directory)
+
+    Returns
+    -------
+    Dictionary with the fields below, or None if it isn't an SDM output
+    analysis: Analysis name (for meta-regressions, the name before _1m0 until the catalog works out which analysis
+              it belongs to - see ResultsCatalog, for other outputs the whole name before the statistic)
+    kind: 'mean', 'JK', 'lm' or 'other' (e.g. a jack-knife folder's own copy of the mean, renamed)
+    qh: Whether it's a heterogeneity (QH) map
+    study: Left-out study of a jack-knife map (None for the others)
+    model: Meta-regression name, e.g. MDD_age for MDD_age_1m0_z.nii.gz (None for the others)
+    statistic: 'z' or 'p'
+    p_threshold, z_threshold, extent: Threshold settings of a thresholded output (None for unthresholded maps)
+    sign: 'pos' or 'neg' for thresholded outputs (None for unthresholded maps)
+    significance: Whether it's the significance (_p) map of a thresholded output
+    file_type: 'nii.gz', 'nii' or 'htm'
+    """
+    match = OUTPUT_REGEX.match(name)
+    if not match:
+        return None
+    stem = match.group('stem')
+    qh = stem.endswith('_QH')
+    if qh:
+        stem = stem[:-len('_QH')]
+
+    study = model = None
+    jackknife = re.match(r'^(.+?)_JK_(.+)$', stem) or re.match(r'^(.+?)_?JK_?(.+)$', stem)  # e.g. MDD_JackJKsmith
+    if jackknife:
+        kind, analysis, study = 'JK', jackknife.group(1), jackknife.group(2)
+    elif stem.lower().endswith('_mean'):
+        kind, analysis = 'mean', stem[:-len('_mean')]
+    elif stem.endswith('_1m0'):
+        kind, analysis = 'lm', stem[:-len('_1m0')]
+        model = analysis
+    else:
+        kind, analysis = 'other', stem
+
+    thresholded = match.group('p') is not None
+    return {'analysis': analysis, 'kind': kind, 'qh': qh, 'study': study, 'model': model,
+            'statistic': match.group('statistic'),
+            'p_threshold': float(match.group('p')) if thresholded else None,
+            'z_threshold': float(match.group('z')) if thresholded else None,
+            'extent': int(match.group('extent')) if thresholded else None,
+            'sign': ('neg' if match.group('neg') else 'pos') if thresholded else None,
+            'significance': bool(match.group('sig')), 'file_type': match.group('file_type')}
+
+
+class ResultsCatalog(object):
+    """
+    Parsed SDM outputs of a directory
+
+    Arguments
+    ---------
+    directory: Analysis directory
+    records: Dictionary of file name: record (see parse_output_name)
+    """
+
+    def __init__(self, directory, records):
+        self.directory = directory
+        self.records = records
+        self._groups = {}  # (kind, file type): sorted file names
+        for name in sorted(records):
+            record = records[name]
+            self._groups.setdefault((record['kind'], record['file_type']), []).append(name)
+        self._resolve_models()
+
+    def _resolve_models(self):
+        """
+        Splits meta-regression names into analysis and column, using the analyses with mean or jack-knife outputs -
+        e.g. MDD_age_1m0 is analysis MDD if there's an MDD_mean, otherwise it stays as MDD_age
+        """
+        analyses = set(r['analysis'] for r in self.records.values() if r['kind'] in ('mean', 'JK'))
+        for record in self.records.values():
+            if record['kind'] == 'lm':
+                prefixes = [a for a in analyses if record['model'].startswith(a + '_')]
+                record['analysis'] = max(prefixes, key=len) if prefixes else record['model']
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, name):
+        return name in self.records
+
+    def get(self, name):
+        """
+        Record of a file, or None if it isn't an SDM output in the directory
+        """
+        return self.records.get(name)
+
+    def find(self, kind=None, file_type=None, thresholded=None, **fields):
+        """
+        Names of the outputs matching every field given, in sorted order
+
+        Arguments
+        ---------
+        kind: 'mean', 'JK', 'lm' or 'other' (optional)
+        file_type: 'nii.gz', 'nii' or 'htm' (optional)
+        thresholded: True for thresholded outputs only, False for unthresholded maps only (optional)
+        fields: Any other record fields to match, e.g. qh=False, sign='neg', analysis='MDD'
+
+        E.g.
+        catalog.find('JK', 'htm', thresholded=False, qh=False, statistic='z')  # jack-knife reports to threshold
+        """
+        names = []
+        for (group_kind, group_type), group in sorted(self._groups.items()):
+            if (kind is None or kind == group_kind) and (file_type is None or file_type == group_type):
+                names += group
+        if thresholded is not None:
+            names = [n for n in names if (self.records[n]['p_threshold'] is not None) == thresholded]
+        for field, value in fields.items():
+            names = [n for n in names if self.records[n][field] == value]
+        return sorted(names)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+def load_catalog(directory, save=True):
+    """
+    Gets the catalog of a directory's SDM outputs, from its catalog file if the directory hasn't changed, otherwise
+    listing the directory and parsing any new file names
+
+    Arguments
+    ---------
+    directory: Analysis directory
+    save: Save the catalog to directory/.results_catalog.json (optional)
+
+    Returns
+    -------
+    ResultsCatalog
+    """
+    path = os.path.join(directory, CATALOG_NAME)
+    saved = {}
+    if os.path.exists(path):
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except ValueError:  # being written by another process, or damaged
+            saved = {}
+        if saved.get('version') != CATALOG_VERSION:
+            saved = {}
+
+    mtime = os.stat(directory).st_mtime
+    if saved.get('mtime') == mtime and saved.get('scanned', 0) - mtime > 1:  # changes within a second of the scan
+        return ResultsCatalog(directory, saved['records'])                  # may not have moved the mtime
+
+    records = saved.get('records', {})
+    names = set(os.listdir(directory))
+    records = dict((name, record) for name, record in records.items() if name in names)
+    for name in names - set(records):
+        record = parse_output_name(name)
+        if record is not None:
+            records[name] = record
+    catalog = ResultsCatalog(directory, records)
+
+    if save:
+        with _lock:
+            try:
+                created = not os.path.exists(path)
+                _write(path, mtime, records)
+                if created:  # making the file changed the directory, so save again with its new mtime
+                    _write(path, os.stat(directory).st_mtime, records)
+            except (IOError, OSError):
+                pass  # read-only directory, still fine to use the catalog
+
+    return catalog
+
+
+def _write(path, mtime, records):
+    with open(path, 'w') as f:  # written in place - making a new file would change the directory's mtime
+        json.dump({'version': CATALOG_VERSION, 'mtime': mtime, 'scanned': time.time(), 'records': records}, f,
+                  sort_keys=True)
+
+
+# Example
+"""
+catalog = load_catalog('C:/Users/k1327409/Documents/VBShare/MDD_sMRI/')
+jk_reports = catalog.find('JK', 'htm', thresholded=True)
+negative_mean = catalog.find('mean', 'nii.gz', qh=False, sign='neg', significance=False)
+"""
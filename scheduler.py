@@ -0,0 +1,195 @@
+import os
+import threading
+import time
+import traceback
+
+from tracing import log, sdm_call
+
+# ############################################################################################################
+# ## Running SDM commands as a graph of tasks rather than one after another                               ##
+# ## Each task declares the tasks it depends on, and is started as soon as they have all finished, with    ##
+# ## at most max_workers tasks running at once - so meta-regressions and thresholds overlap                ##
+# ## run_command() runs one SDM command with a timeout and retries, saving its output to log files, and     ##
+# ## raises CommandError if it fails - the graph stops starting tasks after the first failure               ##
+# ############################################################################################################
+
+
+class CommandError(Exception):
+    """
+    Raised when a command exits with a non-zero status (or is killed after its timeout)
+    """
+
+    def __init__(self, name, return_code, timed_out=False, output=''):
+        self.name = name
+        self.return_code = return_code
+        self.timed_out = timed_out
+        self.output = output
+        if timed_out:
+            message = '%s timed out' % name
+        else:
+            message = '%s failed with exit status %s' % (name, return_code)
+        if output:
+            message += '\n' + output
+        Exception.__init__(self, message)
+
+
+class TaskFailed(Exception):
+    """
+    Raised by TaskGraph.run if any task failed - failed holds (task, error message) for each failed task and
+    skipped the tasks that weren't run
+    """
+
+    def __init__(self, failed, skipped):
+        self.failed = failed
+        self.skipped = skipped
+        message = '\n'.join('%s: %s' % (name, error) for name, error in failed)
+        if skipped:
+            message += '\nNot run: ' + ', '.join(skipped)
+        Exception.__init__(self, message)
+
+
+def _tail(path, n_lines=20):
+    try:
+        with open(path) as f:
+            return ''.join(f.readlines()[-n_lines:])
+    except IOError:
+        return ''
+
+
+def run_command(args, name, cwd=None, timeout=None, retries=0, log_dir=None):
+    """
+    Runs a command, retrying it if it fails, and raises CommandError if it never succeeds
+
+    Arguments
+    ---------
+    args: Command as a list of arguments
+    name: Name of the task, used for the log files
+    cwd: Directory to run it in (optional)
+    timeout: Seconds to let each attempt run before killing it (optional)
+    retries: Number of times to try again after a failure (optional)
+    log_dir: Directory to save stdout and stderr to, as name.out and name.err (optional, otherwise they aren't
+             captured)
+    """
+    if log_dir and not os.path.isdir(log_dir):
+        try:
+            os.makedirs(log_dir)
+        except OSError:  # made by another task in the meantime
+            pass
+
+    for attempt in range(retries + 1):
+        if attempt:
+            log("Retrying " + name)
+        stdout = stderr = None
+        if log_dir:
+            stdout = open(os.path.join(log_dir, name + '.out'), 'w')
+            stderr = open(os.path.join(log_dir, name + '.err'), 'w')
+        start = time.time()
+        try:
+            return_code = sdm_call(args, cwd=cwd, name=name, stdout=stdout, stderr=stderr, timeout=timeout)
+        finally:
+            if log_dir:
+                stdout.close()
+                stderr.close()
+        if return_code == 0:
+            return
+        timed_out = bool(timeout) and time.time() - start >= timeout
+
+    output = ''
+    if log_dir:
+        output = _tail(os.path.join(log_dir, name + '.err')) or _tail(os.path.join(log_dir, name + '.out'))
+    raise CommandError(name, return_code, timed_out, output)
+
+
+class TaskGraph(object):
+    """
+    Tasks with dependencies between them, run in as many threads as are allowed
+
+    E.g.
+    graph = TaskGraph()
+    graph.add('mean', lambda: run_command(mean_args, 'mean'))
+    graph.add('lm_age', lambda: run_command(lm_args, 'lm_age'))  # no dependencies, runs alongside the mean
+    graph.add('threshold_mean', lambda: run_command(threshold_args, 'threshold_mean'), depends=['mean'])
+    graph.run(max_workers=4)
+    """
+
+    def __init__(self):
+        self.tasks = []  # in the order they were added, which is the order ready tasks are started in
+        self.funcs = {}
+        self.depends = {}
+
+    def add(self, name, func, depends=()):
+        """
+        Adds a task
+
+        Arguments
+        ---------
+        name: Name of the task
+        func: Function that runs the task, called with no arguments - it fails by raising an exception
+        depends: Names of tasks (already added) that have to finish before this one starts
+        """
+        if name in self.funcs:
+            raise ValueError('Task %s has already been added' % name)
+        unknown = [d for d in depends if d not in self.funcs]
+        if unknown:  # also means there can't be any cycles
+            raise ValueError('Task %s depends on unknown tasks: %s' % (name, ', '.join(unknown)))
+        self.tasks.append(name)
+        self.funcs[name] = func
+        self.depends[name] = list(depends)
+
+    def _run_task(self, name):
+        try:
+            self.funcs[name]()
+            return name, None
+        except Exception as e:
+            log(traceback.format_exc())
+            return name, str(e)
+
+    def run(self, max_workers=4):
+        """
+        Runs every task, each one as soon as the tasks it depends on have finished
+        Stops starting tasks after the first failure, waits for the running ones and raises TaskFailed
+
+        Arguments
+        ---------
+        max_workers: Maximum number of tasks to run at once
+        """
+        import Queue
+        from multiprocessing.pool import ThreadPool
+
+        max_workers = max(1, max_workers)
+        done = Queue.Queue()
+        finished = set()
+        running = set()
+        failed = []
+        pool = ThreadPool(max_workers)
+        try:
+            while True:
+                if not failed:
+                    for name in self.tasks:
+                        if len(running) >= max_workers:
+                            break
+                        if name not in finished and name not in running and \
+                                all(d in finished for d in self.depends[name]):
+                            running.add(name)
+                            pool.apply_async(self._run_task, (name,), callback=done.put)
+                if not running:
+                    break
+                while True:  # a get with a timeout can be interrupted with ctrl-c
+                    try:
+                        name, error = done.get(True, 1)
+                        break
+                    except Queue.Empty:
+                        pass
+                running.discard(name)
+                if error is None:
+                    finished.add(name)
+                else:
+                    log("Task " + name + " failed")
+                    failed.append((name, error))
+        finally:
+            pool.close()
+            pool.join()
+
+        if failed:
+            raise TaskFailed(failed, [name for name in self.tasks
+                                      if name not in finished and name not in dict(failed)])
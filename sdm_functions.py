@@ -1,5 +1,4 @@
 # -*- coding: utf-8 -*-
-from bs4 import BeautifulSoup
 import re
 import subprocess
 import os
@@ -8,11 +7,143 @@ import shlex
 # ############################################################################################################
 # ## These functions take SDM cluster results in HTML format and extracts values for the peak coordinates   ##
 # ## get_coords: produces a list of coordinates from the HTML file                                          ##
+# ## read_report/read_reports: give a table of the clusters in one or more HTML files                      ##
 # ## extract_coordinate_values: takes a list of coordinates and extracts values at these points             ##
 # ## SDM will use results in the current working directory - make sure to set this before running           ##
 # ## Extracted files are numbered - need to make a note of which number corresponds to each cluster         ##
 # ############################################################################################################
 
+# all main coordinates seem to come after a </table> bit - </TABLE> in some versions, and not always on the same line
+# each coordinate goes with the nearest </table> before it
+PEAK_RE = re.compile(r'/table>(?:(?!/table>).)*?(-?\d+),(-?\d+),(-?\d+)', re.IGNORECASE | re.DOTALL)
+TABLE_RE = re.compile(r'<table|/table>', re.IGNORECASE)
+PEAK_Z_RE = re.compile(r'z\s*[=:]\s*(-?\d+(?:\.\d+)?)', re.IGNORECASE)
+PEAK_P_RE = re.compile(r'\bp\s*[=<:]\s*(\d*\.?\d+(?:e-?\d+)?)', re.IGNORECASE)
+VOXELS_RE = re.compile(r'(\d+)\s*voxels', re.IGNORECASE)
+
+REPORT_COLUMNS = ['cluster', 'coords', 'x', 'y', 'z', 'voxels', 'peak_z', 'p']
+
+_report_cache = {}  # html file: ((mtime, size), rows)
+
+
+def _add_peak_details(row, text):
+    """
+    Fills in the cluster size, peak Z and p of a cluster from the text after its peak coordinate
+    """
+    end = TABLE_RE.search(text)
+    if end:
+        text = text[:end.start()]
+    text = re.sub(r'<[^>]*>', ' ', text).replace('&lt;', '<').replace('&gt;', '>')
+    for key, regex, convert in [('peak_z', PEAK_Z_RE, float), ('p', PEAK_P_RE, float), ('voxels', VOXELS_RE, int)]:
+        match = regex.search(text)
+        if match:
+            row[key] = convert(match.group(1))
+
+
+def read_report(html_file):
+    """
+    Reads the clusters from SDM's html results file with one pass of a regex over its text, without parsing the
+    whole document
+
+    Arguments
+    ---------
+    html_file: The html file to read
+
+    Returns
+    -------
+    rows: List of dictionaries, one per cluster in the order they're reported, with the cluster number, peak
+          coordinates (as an "x,y,z" string and as numbers), and the cluster size, peak Z and p where the report
+          gives them (None otherwise)
+    """
+    with open(html_file, 'r') as f:
+        text = f.read()
+
+    rows = []
+    matches = list(PEAK_RE.finditer(text))
+    for i, match in enumerate(matches):
+        x, y, z = [int(c) for c in match.groups()]
+        row = {'cluster': i + 1, 'coords': text[match.start(1):match.end(3)],
+               'x': x, 'y': y, 'z': z, 'voxels': None, 'peak_z': None, 'p': None}
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        _add_peak_details(row, text[match.end():min(end, match.end() + 4096)])  # details are always close to the peak
+        rows.append(row)
+
+    return rows
+
+
+def _cached_report(html_file):
+    """
+    Reads a report, reusing the last result if the file hasn't changed
+    """
+    st = os.stat(html_file)
+    key = (st.st_mtime, st.st_size)
+    cached = _report_cache.get(html_file)
+    if cached is None or cached[0] != key:
+        cached = (key, read_report(html_file))
+        _report_cache[html_file] = cached
+    return cached[1]
+
+
+def _read_report_with_key(html_file):
+    st = os.stat(html_file)
+    return html_file, ((st.st_mtime, st.st_size), read_report(html_file))
+
+
+def read_reports(html_files, n_workers=4, cache_file=None):
+    """
+    Reads the clusters from a list of SDM html results files, in parallel
+    Reports that haven't changed since they were last read are taken from the cache
+
+    Arguments
+    ---------
+    html_files: List of html files, or a directory to read every .htm file in
+    n_workers: Number of processes to read the reports with
+    cache_file: File to keep the cache in between runs (optional, otherwise it only lasts as long as the process)
+
+    Returns
+    -------
+    clusters: A pandas dataframe with a row per cluster per report (see read_report), plus the report it came from
+    """
+    import cPickle
+    import pandas as pd
+
+    if isinstance(html_files, basestring):
+        html_files = [os.path.join(html_files, f) for f in sorted(os.listdir(html_files)) if f.endswith('.htm')]
+
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            for html_file, cached in cPickle.load(f).items():
+                _report_cache.setdefault(html_file, cached)
+
+    stale = []
+    for html_file in html_files:
+        st = os.stat(html_file)
+        cached = _report_cache.get(html_file)
+        if cached is None or cached[0] != (st.st_mtime, st.st_size):
+            stale.append(html_file)
+
+    if len(stale) > 1 and n_workers > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(n_workers, len(stale)))
+        try:
+            _report_cache.update(pool.map(_read_report_with_key, stale))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _report_cache.update([_read_report_with_key(html_file) for html_file in stale])
+
+    if cache_file and stale:
+        with open(cache_file, 'wb') as f:
+            cPickle.dump(dict((html_file, _report_cache[html_file]) for html_file in html_files), f, -1)
+
+    clusters = []
+    for html_file in html_files:
+        for row in _report_cache[html_file][1]:
+            clusters.append(dict(row, report=html_file))
+
+    return pd.DataFrame(clusters, columns=['report'] + REPORT_COLUMNS)
+
 
 def get_coords(html_file):
     """
@@ -26,18 +157,7 @@ def get_coords(html_file):
     -------
     coords_list: List of extracted coordinates
     """
-    from bs4 import BeautifulSoup
-    import re
-    output = BeautifulSoup(open(html_file, 'r'))  # opens the html and makes it look nice
-    # use regular expressions to find the main cluster coordinates
-    coords = re.findall(r'/table>.*?-?\d+,-?\d+,-?\d+', str(output))
-    # all main coordinates seem to come after a </table> bit
-
-    coords_list = []
-    for i in range(len(coords)):
-        match = re.search(r'-?\d+,-?\d+,-?\d+', coords[i])  # get the actual coordinates out of the text
-        coords_list.append(match.group())  # add these coordinates to a new list
-    return coords_list
+    return [row['coords'] for row in _cached_report(html_file)]
 
 
 def extract_coordinate_values(coordinates, prefix, sdm_path):
@@ -56,29 +176,137 @@ def extract_coordinate_values(coordinates, prefix, sdm_path):
     SDM's outputs from these functions are saved
     Prints each cluster name and coordinates when run
     """
-    import subprocess
-    import shlex
-    sdm_path += " "
     for i in range(len(coordinates)):
         name = prefix + "_coords_" + str(i+1)  # format = prefix_coords_#
-        mask_arg = name + " = mask coordinate, " + coordinates[i].replace(',', ', ')  # arguments for masking function
-        extract_arg = "extract " + name  # arguments for extraction function
-        print mask_arg  # prints mask arguments to make sure they're correct
-        print shlex.split(sdm_path + mask_arg)
-        mask_arg = shlex.split(sdm_path + mask_arg)
-        extract_arg = shlex.split(sdm_path + extract_arg)
-        #if " " in sdm_path:
-          #  mask_arg[0] = '"' + mask_arg[0] + '"'
-          #  extract_arg[0] = '"' + extract_arg[0] + '"'
-        #print mask_arg
-        subprocess.call(mask_arg)
-        subprocess.call(extract_arg)
+        _mask_and_extract((sdm_path, name, coordinates[i], None))
+
+
+def _run_sdm(args, name, cwd=None, timeout=None, retries=0, log_dir=None):
+    """
+    Runs an SDM command with scheduler.run_command, returning its exit status rather than raising CommandError
+    """
+    from scheduler import CommandError, run_command
+    from tracing import log
+
+    try:
+        run_command(args, name, cwd=cwd, timeout=timeout, retries=retries, log_dir=log_dir)
+        return 0
+    except CommandError as e:
+        log(str(e), error=True)
+        return e.return_code or 1
+
+
+def _mask_and_extract(args, timeout=None, retries=0, log_dir=None):
+    """
+    Makes an SDM mask at a coordinate and extracts the study values in it
+    """
+    import shlex
+    from tracing import log
+
+    sdm_path, name, coordinate, cwd = args
+    mask_arg = name + " = mask coordinate, " + coordinate.replace(',', ', ')  # arguments for masking function
+    extract_arg = "extract " + name  # arguments for extraction function
+    log(mask_arg)  # prints mask arguments to make sure they're correct
+    mask_arg = shlex.split(sdm_path + " " + mask_arg)
+    extract_arg = shlex.split(sdm_path + " " + extract_arg)
+    return_code = _run_sdm(mask_arg, 'mask_' + name, cwd, timeout, retries, log_dir)
+    if return_code == 0:
+        return_code = _run_sdm(extract_arg, 'extract_' + name, cwd, timeout, retries, log_dir)
+    return return_code
+
+
+def extract_all_coordinate_values(coordinates, ma_dir, sdm_path=None, method='sdm', n_workers=4,
+                                  selection_column=None, out_file='extracted_values.csv', store=None, timeout=None,
+                                  retries=0, log_dir=None):
+    """
+    Extracts study values at the peak coordinates of several analyses in one go, and puts them in one table
+
+    Arguments
+    ---------
+    coordinates: Dictionary of prefix: list of coordinates, e.g. {'BD_mean': get_coords('BD_mean_z_p...htm')}
+    ma_dir: Directory containing the meta-analysis files
+    sdm_path: Path to SDM (must be to the SDM.bat file, only needed for the sdm method)
+    method: 'sdm' runs SDM's mask and extract commands, several coordinates at a time, and reads the extract_*.txt
+            files they make
+            'maps' skips SDM and reads the values straight from the preprocessed study maps at the nearest voxel
+            (see study_maps.py)
+    n_workers: Number of coordinates to run through SDM at the same time
+    selection_column: Column in the SDM table selecting the studies to include (optional, maps method only)
+    out_file: File to save the table to (optional, set to '' to not save it)
+    store: Columnar store to add the values to, replacing earlier values of the same analyses (optional, e.g.
+           ma_dir + 'extracted_values.parquet' - see extracted_store.py)
+    timeout: Seconds to let each SDM command run before killing it (optional, sdm method only)
+    retries: Number of times to retry an SDM command that fails (optional, sdm method only)
+    log_dir: Directory for the output of each SDM command, as mask_<name> and extract_<name> (optional, sdm method
+             only - see scheduler.run_command)
+
+    Returns
+    -------
+    values: A pandas dataframe with a row per study per coordinate, with the prefix, cluster number (as in the
+            prefix_coords_# names), coordinates, study, estimate and variance
+    """
+    import pandas as pd
+
+    clusters = [(prefix, i + 1, coordinate) for prefix in sorted(coordinates)
+                for i, coordinate in enumerate(coordinates[prefix])]
+    columns = ['analysis', 'cluster', 'coords', 'study', 'estimate', 'variance']
+
+    tables = []
+    if method == 'maps':
+        import numpy as np
+        from study_maps import study_map_paths, selected_studies, sample_map
+
+        mni = np.array([[float(c) for c in coordinate.split(',')] for _, _, coordinate in clusters]).reshape(-1, 3)
+        for study in selected_studies(ma_dir, selection_column):
+            effect_map, variance_map = study_map_paths(ma_dir, study)
+            tables.append(pd.DataFrame({'analysis': [c[0] for c in clusters], 'cluster': [c[1] for c in clusters],
+                                        'coords': [c[2] for c in clusters], 'study': study,
+                                        'estimate': sample_map(effect_map, mni),
+                                        'variance': sample_map(variance_map, mni)}, columns=columns))
+    else:
+        from functools import partial
+        from multiprocessing.pool import ThreadPool
+        from tracing import log
+
+        names = [prefix + "_coords_" + str(cluster) for prefix, cluster, _ in clusters]
+        pool = ThreadPool(max(1, min(n_workers, len(clusters))))
+        try:
+            return_codes = pool.map(partial(_mask_and_extract, timeout=timeout, retries=retries, log_dir=log_dir),
+                                    [(sdm_path, name, coordinate, ma_dir)
+                                     for name, (_, _, coordinate) in zip(names, clusters)])
+        finally:
+            pool.close()
+            pool.join()
+
+        for name, (prefix, cluster, coordinate), return_code in zip(names, clusters, return_codes):
+            if return_code != 0:
+                log("Extraction failed for " + name, error=True)
+                continue
+            data = pd.read_csv(os.path.join(ma_dir, 'extract_' + name + '.txt'), sep=r'\s+')
+            data = data.iloc[:, :3]  # study, estimate, variance
+            data.columns = ['study', 'estimate', 'variance']
+            data.insert(0, 'coords', coordinate)
+            data.insert(0, 'cluster', cluster)
+            data.insert(0, 'analysis', prefix)
+            tables.append(data)
+
+    values = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame(columns=columns)
+    if out_file:
+        values.to_csv(os.path.join(ma_dir, out_file), index=False)
+    if store:
+        from extracted_store import append_extracted
+        append_extracted(values, store)
+
+    return values
 
 
 # Example usage
 """
 result_coords = get_coords('C:/Users/k1327409/Dropbox/PhD/DTI/dti_ma/MDD Only/14_03_14_MDD_Meds_1m0_z_p0.00050_1.000_10.htm')
 extract_coordinate_values(result_coords, "BD_mean", "C:/Users/k1327409/Dropbox/PhD/Things/sdm_v4.12/sdm_v4.12/sdm.bat")
+
+values = extract_all_coordinate_values({'BD_mean': result_coords}, 'C:/Users/k1327409/Dropbox/PhD/DTI/dti_ma/MDD Only/',
+                                       method='maps')
 """
 
 # ############################################################################################################
@@ -86,7 +314,7 @@ extract_coordinate_values(result_coords, "BD_mean", "C:/Users/k1327409/Dropbox/P
 # ############################################################################################################
 
 
-def threshold_jackknife(directory, sdm_path):
+def threshold_jackknife(directory, sdm_path, timeout=None, retries=0, log_dir=None):
     """
     Looks for jackknife results in a given directory and thresholds them all
     Uses default settings (p < .005, peak height = 1, extent = 10)
@@ -95,23 +323,32 @@ def threshold_jackknife(directory, sdm_path):
     ---------
     directory: Directory where the jackknife results are
     sdm_path: Path to SDM (must be to the SDM.bat file)
+    timeout: Seconds to let each SDM command run before killing it (optional)
+    retries: Number of times to retry an SDM command that fails (optional)
+    log_dir: Directory for the output of each SDM command, as threshold_<result> (optional - see
+             scheduler.run_command)
+
+    Returns
+    -------
+    failed: List of results where SDM returned a non-zero exit code
     """
-    import re
-    import subprocess
-    import os
     import shlex
+    from results_catalog import load_catalog
+    from tracing import log
     sdm_path += " "
-    files = os.listdir(directory)
     results = []
-    for file in files:
-        if re.match(r'.+JK.+(?<!QH)_z.htm', file):
-            print file
-            results.append(file.replace('.htm', ''))
+    for file in load_catalog(directory).find('JK', 'htm', thresholded=False, qh=False, statistic='z'):
+        log(file)
+        results.append(file.replace('.htm', ''))
 
+    failed = []
     for result in results:
         arg = 'threshold ' + result + ', p, 0.005, 1, 10'
-        print shlex.split(sdm_path + arg)
-        subprocess.call(shlex.split(sdm_path + arg))
+        log(shlex.split(sdm_path + arg))
+        if _run_sdm(shlex.split(sdm_path + arg), 'threshold_' + result, directory, timeout, retries, log_dir) != 0:
+            failed.append(result)
+
+    return failed
 
 # Example usage
 """
@@ -119,13 +356,195 @@ threshold_jackknife('C:/Users/k1327409/Documents/MA stuff', 'C:/Users/k1327409/D
 """
 
 
+# ############################################################################################################
+# ## These functions run the jack-knife analyses in parallel                                               ##
+# ## SDM has no command-line jack-knife, so each iteration is a mean analysis on a leave-one-out column     ##
+# ## All of the leave-one-out columns are written to the SDM table in one go, and each iteration runs in    ##
+# ## its own copy of the preprocessed files so several SDM processes can run at the same time               ##
+# ############################################################################################################
+
+
+def write_jackknife_columns(sdm_table, selection_column=None, studies=None):
+    """
+    Adds a leave-one-out selection column to the SDM table for each selected study, in a single write
+
+    Arguments
+    ---------
+    sdm_table: Path to the sdm_table.txt file
+    selection_column: Column in the SDM table selecting the studies to include (optional, default uses all studies)
+    studies: List of study names to make jack-knife columns for (optional, default uses all selected studies)
+
+    Returns
+    -------
+    jk_columns: List of (study name, column name) tuples, one per jack-knife iteration
+    """
+    import os
+    import numpy as np
+    import pandas as pd
+
+    table = pd.read_csv(sdm_table, delimiter='\t')
+    if selection_column:
+        selection_var = (table[selection_column].values == 1).astype(int)
+    else:
+        selection_var = np.ones(len(table), dtype=int)
+
+    jk_columns = []
+    for i in range(len(table)):
+        study = table['study'][i]
+        if selection_var[i] == 1 and (studies is None or study in studies):
+            column = 'JK_' + str(i + 1)
+            jk_selection = selection_var.copy()
+            jk_selection[i] = 0  # leave this study out of this iteration
+            table[column] = jk_selection
+            jk_columns.append((study, column))
+
+    # written to a temporary file and renamed, so SDM analyses running at the same time never see half a table
+    tmp = sdm_table + '.tmp'
+    table.to_csv(tmp, sep='\t', index=False)
+    try:
+        os.rename(tmp, sdm_table)
+    except OSError:  # Windows won't rename over an existing file
+        os.remove(sdm_table)
+        os.rename(tmp, sdm_table)
+
+    return jk_columns
+
+
+def _make_jackknife_workspace(ma_dir, analysis_name, separator='_JK_'):
+    """
+    Creates a temporary copy of the meta-analysis directory for a single jack-knife iteration
+    Images are hard-linked where possible as SDM only reads them, everything else is copied
+    Previous outputs of this analysis are left out
+    """
+    import os
+    import shutil
+    import tempfile
+
+    workspace = tempfile.mkdtemp(prefix='jk_workspace_', dir=ma_dir)  # same drive as ma_dir so links/moves work
+    for f in os.listdir(ma_dir):
+        src = os.path.join(ma_dir, f)
+        if not os.path.isfile(src) or f.startswith(analysis_name + '_') or f.startswith(analysis_name + separator):
+            continue
+        dst = os.path.join(workspace, f)
+        if '.nii' in f and hasattr(os, 'link'):
+            try:
+                os.link(src, dst)
+                continue
+            except OSError:
+                pass
+        try:
+            shutil.copy2(src, dst)
+        except (IOError, OSError):  # removed since listing the directory, e.g. a temporary file of another analysis
+            pass
+
+    return workspace
+
+
+def _run_jackknife_iteration(args, timeout=None, retries=0, log_dir=None):
+    """
+    Runs one jack-knife mean analysis in its own workspace and moves the outputs back to ma_dir
+    """
+    import os
+    import shutil
+    from tracing import log
+
+    ma_dir, sdm_path, analysis_name, separator, study, column = args
+    name = analysis_name + separator + study
+    workspace = _make_jackknife_workspace(ma_dir, analysis_name, separator)
+    try:
+        inputs = set(os.listdir(workspace))
+        log(name + ' (' + column + ')')
+        return_code = _run_sdm([sdm_path, name, ' = ', 'mean', column], name, workspace, timeout, retries, log_dir)
+        for f in os.listdir(workspace):
+            if f not in inputs:
+                dst = os.path.join(ma_dir, f)
+                if os.path.exists(dst):
+                    os.remove(dst)
+                shutil.move(os.path.join(workspace, f), dst)
+    finally:
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    return name, return_code
+
+
+def run_jackknife(ma_dir, sdm_path, analysis_name, selection_column=None, studies=None, n_workers=4, timeout=None,
+                  retries=0, log_dir=None, separator='_JK_'):
+    """
+    Runs a jack-knife analysis, leaving out each selected study in turn, with several SDM processes at once
+
+    Arguments
+    ---------
+    ma_dir: Directory containing the meta-analysis files (must contain sdm_table.txt and the preprocessed files)
+    sdm_path: Path to SDM (must be to the SDM.bat file)
+    analysis_name: Name of the analysis, outputs are named analysis_name_JK_study
+    selection_column: Column in the SDM table selecting the studies to include (optional)
+    studies: List of study names to leave out (optional, default leaves out every selected study)
+    n_workers: Maximum number of SDM processes to run at the same time
+    timeout: Seconds to let each SDM process run before killing it (optional)
+    retries: Number of times to retry an iteration that fails (optional)
+    log_dir: Directory for the output of each iteration, as analysis_name_JK_study (optional - see
+             scheduler.run_command)
+    separator: What goes between the analysis name and the study in the output names (optional, e.g. 'JK' for
+               the analysis_nameJKstudy names of older results)
+
+    Returns
+    -------
+    failed: List of jack-knife analyses where SDM returned a non-zero exit code
+    """
+    import os
+    from functools import partial
+    from multiprocessing.pool import ThreadPool
+    from tracing import log
+
+    jk_columns = write_jackknife_columns(os.path.join(ma_dir, 'sdm_table.txt'), selection_column, studies)
+
+    # threads are enough here - each one just waits on its own SDM process
+    pool = ThreadPool(max(1, min(n_workers, len(jk_columns))))
+    try:
+        results = pool.map(partial(_run_jackknife_iteration, timeout=timeout, retries=retries, log_dir=log_dir),
+                           [(ma_dir, sdm_path, analysis_name, separator, study, column)
+                            for study, column in jk_columns])
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [name for name, return_code in results if return_code != 0]
+    for name in failed:
+        log(name + " failed", error=True)
+
+    return failed
+
+# Example usage
+"""
+run_jackknife('C:/Users/k1327409/Documents/VBShare/MDD_sMRI/Analysis_0901/',
+              'C:/Users/k1327409/Dropbox/PhD/Things/sdm_v4.22/sdm/sdm.bat', '0403_MDD', 'CombinedGroups', n_workers=6)
+"""
+
+
 # ############################################################################################################
 # ## This function checks jackknife output files for any results that differ from the original analysis     ##
-# ## ...It's a bit of a mess                                                                                ##
+# ## It gives a table of which clusters are present when each study is left out                            ##
 # ############################################################################################################
 
 
-def check_jackknife(mean_results, jk_directory, save_results=True):
+def _match_peaks(peaks, targets, tolerance):
+    """
+    For each peak, whether there's a target peak at the same coordinates (or within tolerance mm of it)
+    """
+    import numpy as np
+
+    if not len(peaks) or not len(targets):
+        return np.zeros(len(peaks), dtype=bool)
+    if not tolerance:
+        target_set = set(map(tuple, targets))
+        return np.array([tuple(peak) in target_set for peak in peaks])
+    from scipy.spatial import cKDTree
+    distances, _ = cKDTree(targets).query(peaks, distance_upper_bound=tolerance)
+    return np.isfinite(distances)
+
+
+def check_jackknife(mean_results, jk_directory, save_results=True, tolerance=0, out_file='Jackknife_check.csv',
+                    regex=r'(?<=_JK_).+?(?=_z_)'):
     """
     Checks jackknife results against original results and reports any changes
 
@@ -133,45 +552,65 @@ def check_jackknife(mean_results, jk_directory, save_results=True):
     ---------
     mean_results: The original HTML results file
     jk_directory: Directory where the jackknife results HTML files are located
-    save_results: Save outputs to a text file (optional)
+    save_results: Save the table to out_file (optional)
+    tolerance: Distance in mm within which a jack-knife peak counts as the same as an original peak (optional, default
+               needs the exact same coordinates - peaks can move by a voxel between iterations)
+    out_file: File to save the table to, as csv or, if it ends in .parquet, parquet (optional)
+    regex: regex for getting the left-out study out of the jack-knife file names (optional)
 
     Returns
     -------
-    Prints/writes to text original coordinates, each jackknife iteration and
-    coordinates that differ (new additions, original ones missing)
+    presence: A pandas dataframe with a row for each original cluster and each new cluster that turns up in a
+              jackknife iteration, and a column for each left-out study - 1 if the cluster is there in that
+              iteration, 0 if it isn't. The 'original' column says whether the cluster is in the original results.
+    Prints clusters that differ (new additions, original ones missing) for each iteration
     """
     import re
     import os
+    import numpy as np
+    import pandas as pd
+    from results_catalog import load_catalog
+    from tracing import log
 
-    files = os.listdir(jk_directory)
-    real_coords = get_coords(mean_results)
-    results = []
-    for file in files:
-        if re.match(r'.+JK.+_z_.+.htm', file):
-            results.append(jk_directory + '/' + file)
-    print real_coords
-    print results
+    results = [jk_directory + '/' + file for file in load_catalog(jk_directory).find('JK', 'htm', thresholded=True)]
 
-    if save_results:
-        out = open("Jackknife_check.txt", 'w')
+    real = read_reports([mean_results], n_workers=1)
+    jk = read_reports(results)
+
+    real_peaks = real[['x', 'y', 'z']].values
+    coords = list(real['coords'])
+    columns = {}
+    new = {}  # coordinates of new clusters: studies where they turn up
 
     for result in results:
-        print result
-        jk_coords = get_coords(result)
-        print jk_coords
-        if save_results:
-            out.write("Original coordinates = " + str(real_coords) + "\n")
-            out.write(result + " - coordinates = " + str(jk_coords) + "\n")
-        for coord in jk_coords:
-            if coord not in real_coords:
-                print coord + " = new cluster"
-                if save_results:
-                    out.write(coord + " = new cluster" + "\n")
-        for real_coord in real_coords:
-            if real_coord not in jk_coords:
-                print real_coord + " missing from this iteration"
-                if save_results:
-                    out.write(real_coord + " missing from this iteration" + "\n")
+        study_name = re.search(regex, os.path.basename(result))
+        study = study_name.group() if study_name else os.path.basename(result)
+        jk_clusters = jk[jk['report'] == result]
+        jk_peaks = jk_clusters[['x', 'y', 'z']].values
+        present = _match_peaks(real_peaks, jk_peaks, tolerance)
+        columns[study] = present.astype(int)
+        for coord in real['coords'][~present]:
+            log(study + ": " + coord + " missing from this iteration")
+        for coord in jk_clusters['coords'][~_match_peaks(jk_peaks, real_peaks, tolerance)]:
+            log(study + ": " + coord + " = new cluster")
+            new.setdefault(coord, []).append(study)
+
+    presence = pd.DataFrame(columns, index=coords, columns=sorted(columns))
+    if new:
+        new_rows = pd.DataFrame(0, index=sorted(new), columns=presence.columns)
+        for coord, studies in new.items():
+            new_rows.loc[coord, studies] = 1
+        presence = pd.concat([presence, new_rows])
+    presence.insert(0, 'original', np.arange(len(presence)) < len(coords))
+    presence.index.name = 'coords'
+
+    if save_results:
+        if out_file.endswith('.parquet'):
+            presence.to_parquet(out_file)
+        else:
+            presence.to_csv(out_file)
+
+    return presence
 
 # Example usage
 """
@@ -0,0 +1,134 @@
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+# ############################################################################################################
+# ## Uncompressed sidecar copies of .nii.gz results                                                       ##
+# ## nibabel has to decompress a whole .nii.gz every time it's read and can't memory-map it, so these      ##
+# ## functions decompress each file once into a cache directory and then memory-map the uncompressed copy  ##
+# ## A sidecar is given the same modification time as its source, so it's remade if the source changes    ##
+# ## Several processes can share the same sidecars (and the same pages in memory)                          ##
+# ############################################################################################################
+
+TEMP_SUFFIX = '.nii.part'  # half written sidecars
+
+
+def sidecar_path(path, cache_dir):
+    """
+    Gets the path of the uncompressed sidecar for a .nii.gz file
+
+    Arguments
+    ---------
+    path: Path to the .nii.gz file
+    cache_dir: Directory holding the sidecars
+
+    Returns
+    -------
+    Path to the sidecar .nii file (the name includes a hash of the source directory so files with the same name in
+    different directories don't clash)
+    """
+    path = os.path.abspath(path)
+    directory, name = os.path.split(path)
+    directory_hash = hashlib.md5(directory.encode('utf-8')).hexdigest()[:8]
+    return os.path.join(cache_dir, directory_hash + '_' + name[:-len('.gz')])
+
+
+def make_sidecar(path, cache_dir):
+    """
+    Decompresses a .nii.gz file into the cache directory, unless an up to date sidecar is already there
+
+    Arguments
+    ---------
+    path: Path to the .nii.gz file
+    cache_dir: Directory holding the sidecars
+
+    Returns
+    -------
+    sidecar: Path to the uncompressed sidecar
+    """
+    sidecar = sidecar_path(path, cache_dir)
+    source_mtime = os.stat(path).st_mtime
+    if os.path.exists(sidecar) and os.stat(sidecar).st_mtime == source_mtime:
+        return sidecar
+
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:  # another process made it first
+            pass
+
+    # decompress to a temporary file then rename, so other processes never see a half written sidecar
+    # (not named .nii, so clear_sidecars leaves it alone)
+    fd, tmp = tempfile.mkstemp(suffix=TEMP_SUFFIX, dir=cache_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            src = gzip.open(path, 'rb')
+            try:
+                shutil.copyfileobj(src, out, 1024 * 1024)
+            finally:
+                src.close()
+        os.utime(tmp, (source_mtime, source_mtime))
+        if os.path.exists(sidecar):
+            os.remove(sidecar)
+        os.rename(tmp, sidecar)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if not os.path.exists(sidecar):  # only fine if another process got there first
+            raise
+
+    return sidecar
+
+
+def load_mapped(path, cache_dir):
+    """
+    Loads a NIfTI image as a read-only memory map, going through an uncompressed sidecar for .nii.gz files
+
+    Arguments
+    ---------
+    path: Path to the image
+    cache_dir: Directory holding the sidecars
+
+    Returns
+    -------
+    data: Read-only array of the image data (memory-mapped unless the image has scaling factors)
+    affine: Image affine
+    header: Image header
+    """
+    import nibabel
+
+    if path.endswith('.gz'):
+        path = make_sidecar(path, cache_dir)
+    img = nibabel.load(path, mmap='r')
+    data = np.asanyarray(img.dataobj)
+    if data.flags.writeable:  # scaled images get read into memory
+        data.flags.writeable = False
+
+    return data, img.affine, img.header
+
+
+def is_mapped(data):
+    """
+    Checks whether an array is backed by a memory-mapped file
+    """
+    while data is not None:
+        if isinstance(data, np.memmap):
+            return True
+        data = getattr(data, 'base', None)
+        if not isinstance(data, np.ndarray):
+            return False
+    return False
+
+
+def clear_sidecars(cache_dir):
+    """
+    Deletes every sidecar in the cache directory (sidecars still being written are left alone)
+    """
+    if os.path.isdir(cache_dir):
+        for f in os.listdir(cache_dir):
+            if f.endswith('.nii'):
+                os.remove(os.path.join(cache_dir, f))
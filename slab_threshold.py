@@ -0,0 +1,348 @@
+import numpy as np
+from threshold import STRUCTURE
+
+# ############################################################################################################
+# ## Thresholding and cluster labelling a slab of z-planes at a time, for maps too big to load whole        ##
+# ## (1 mm or finer templates, with several jobs on a node)                                                 ##
+# ## Each slab is labelled on its own, and clusters that touch across the boundary between two slabs are    ##
+# ## joined with a union-find - with 26-connectivity a voxel touches the 9 voxels next to it in the next    ##
+# ## plane. Cluster sizes and peaks are added up slab by slab, and clusters are numbered by their first     ##
+# ## voxel, as ndimage.label numbers them, so the results are the same as labelling the whole volume        ##
+# ## Maps are read and written a slab at a time, so memory use depends on the slab size, not the map size   ##
+# ############################################################################################################
+
+
+def iter_slabs(path, slab_size=16):
+    """
+    Reads a 3D NIfTI image a slab of z-planes at a time, without loading the rest of it
+
+    Arguments
+    ---------
+    path: Path to the image (.nii or .nii.gz)
+    slab_size: Number of z-planes in each slab
+
+    Yields
+    ------
+    (first z-plane of the slab, array of x * y * planes)
+    """
+    import nibabel
+    from nibabel.openers import ImageOpener
+    from nibabel.volumeutils import apply_read_scaling
+
+    img = nibabel.load(path)
+    proxy = img.dataobj
+    nx, ny, nz = img.shape[:3]
+    plane_bytes = nx * ny * proxy.dtype.itemsize
+    with ImageOpener(path) as f:  # NIfTI data are stored x fastest, so each slab is one contiguous block
+        f.seek(proxy.offset)
+        for z0 in range(0, nz, slab_size):
+            dz = min(slab_size, nz - z0)
+            slab = np.frombuffer(f.read(plane_bytes * dz), dtype=proxy.dtype).reshape((nx, ny, dz), order='F')
+            yield z0, apply_read_scaling(slab, proxy.slope, proxy.inter)
+
+
+class SlabWriter(object):
+    """
+    Writes a NIfTI image a slab of z-planes at a time (slabs must be written in order)
+
+    Arguments
+    ---------
+    path: Path to write to (.nii or .nii.gz)
+    shape: Shape of the image
+    affine: Image affine
+    dtype: Data type to save
+    """
+
+    def __init__(self, path, shape, affine, dtype=np.float32):
+        import nibabel
+        from nibabel.openers import Opener
+
+        img = nibabel.Nifti1Image(np.zeros((1, 1, 1), dtype=dtype), affine)  # same header as saving a whole array
+        header = img.header
+        header.set_data_shape(shape)
+        header.set_data_offset(352)
+        self.dtype = np.dtype(dtype)
+        self.file = Opener(path, 'wb')
+        block = header.binaryblock
+        self.file.write(block + b'\x00' * (352 - len(block)))  # no extensions, data from byte 352
+
+    def write(self, slab):
+        self.file.write(np.asarray(slab, dtype=self.dtype).tobytes(order='F'))
+
+    def close(self):
+        self.file.close()
+
+
+class _UnionFind(object):
+    """
+    Union-find over slab labels, numbered from 1 across all slabs (0 is background)
+    """
+
+    def __init__(self):
+        self.parent = np.zeros(1, dtype=np.int64)
+
+    def add(self, n):
+        start = len(self.parent)
+        self.parent = np.concatenate([self.parent, np.arange(start, start + n)])
+        return start - 1  # offset for the slab's own labels, which start at 1
+
+    def find(self, a):
+        root = a
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[a] != root:  # path compression
+            self.parent[a], a = root, self.parent[a]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a != root_b:
+            self.parent[max(root_a, root_b)] = min(root_a, root_b)
+
+    def roots(self):
+        parent = self.parent.copy()
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                return parent
+            parent = grandparent
+
+
+def _join_planes(union_find, previous, current):
+    """
+    Joins labels in the last plane of one slab to the labels they touch in the first plane of the next
+    """
+    nx, ny = previous.shape
+    pairs = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            a = previous[max(0, -dx):nx - max(0, dx), max(0, -dy):ny - max(0, dy)]
+            b = current[max(0, dx):nx - max(0, -dx), max(0, dy):ny - max(0, -dy)]
+            touching = (a > 0) & (b > 0)
+            if touching.any():
+                pairs.append(np.column_stack([a[touching], b[touching]]))
+    if pairs:
+        for a, b in np.unique(np.concatenate(pairs), axis=0):
+            union_find.union(a, b)
+
+
+class SlabClusters(object):
+    """
+    Cluster labels of a mask made a slab at a time
+
+    Arguments
+    ---------
+    shape: Shape of the whole volume
+    keep_voxels: Keep the flat index, label and value of every voxel in a cluster (for a ClusterIndex)
+
+    Call add() with each slab in order, then finish()
+    """
+
+    def __init__(self, shape, keep_voxels=False):
+        from scipy import ndimage
+
+        self.label = ndimage.label
+        self.shape = tuple(shape[:3])
+        self.keep_voxels = keep_voxels
+        self.union_find = _UnionFind()
+        self.offsets = []  # label offset of each slab, for labelling the slabs again
+        self.stats = []  # (size, first voxel, peak value, peak voxel) of each slab label
+        self.voxels = []
+        self.last_plane = None
+
+    def add(self, z0, mask, values):
+        """
+        Labels one slab
+
+        Arguments
+        ---------
+        z0: First z-plane of the slab
+        mask: Boolean mask of the slab
+        values: Values of the slab (for cluster peaks)
+        """
+        local, n = self.label(mask, structure=STRUCTURE)
+        offset = self.union_find.add(n)
+        self.offsets.append(offset)
+        labels = np.where(local > 0, local + offset, 0)
+        if self.last_plane is not None and n:
+            _join_planes(self.union_find, self.last_plane, labels[:, :, 0])
+        self.last_plane = labels[:, :, -1]
+
+        if n:
+            x, y, z = np.nonzero(local)
+            flat = (x.astype(np.int64) * self.shape[1] + y) * self.shape[2] + z + z0  # C order in the whole volume
+            slab_labels = local[x, y, z] - 1
+            slab_values = values[x, y, z]
+            size = np.bincount(slab_labels, minlength=n)
+            first = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+            np.minimum.at(first, slab_labels, flat)
+            order = np.lexsort((flat, -slab_values, slab_labels))
+            peak = order[np.searchsorted(slab_labels[order], np.arange(n))]
+            self.stats.append((size, first, slab_values[peak], flat[peak]))
+            if self.keep_voxels:
+                self.voxels.append((flat, slab_labels + offset + 1, slab_values))
+
+        return labels
+
+    def finish(self, extent=0):
+        """
+        Joins the slab labels into clusters and drops clusters smaller than extent
+
+        Returns
+        -------
+        cluster_of: Array giving the cluster number (from 1, in ndimage.label order, 0 if dropped) of each slab label
+        clusters: Dictionary of arrays of the size, first voxel, peak value and peak voxel (flat indices in C order) of
+                  each cluster
+        """
+        n_labels = len(self.union_find.parent) - 1
+        if not n_labels:
+            empty = np.zeros(0, dtype=np.int64)
+            return np.zeros(1, dtype=np.int64), {'size': empty, 'first': empty, 'peak': np.zeros(0),
+                                                 'peak_index': empty}
+        size, first, peak, peak_index = [np.concatenate(s) for s in zip(*self.stats)]
+        roots = self.union_find.roots()[1:]
+
+        # add up each cluster's slab labels
+        root_ids, cluster = np.unique(roots, return_inverse=True)
+        n = len(root_ids)
+        cluster_size = np.bincount(cluster, weights=size, minlength=n).astype(np.int64)
+        cluster_first = np.full(n, np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(cluster_first, cluster, first)
+        order = np.lexsort((peak_index, -peak, cluster))
+        best = order[np.searchsorted(cluster[order], np.arange(n))]
+
+        # number clusters by their first voxel, as ndimage.label does, and drop the small ones
+        by_first = np.argsort(cluster_first)
+        keep = cluster_size[by_first] >= extent
+        number = np.zeros(n, dtype=np.int64)
+        number[by_first[keep]] = np.arange(1, np.sum(keep) + 1)
+
+        kept = by_first[keep]
+        clusters = {'size': cluster_size[kept], 'first': cluster_first[kept], 'peak': peak[best][kept],
+                    'peak_index': peak_index[best][kept]}
+        return np.concatenate([[0], number[cluster]]), clusters
+
+
+def _slab_masks(p_slab, z_slab, p_threshold, z_threshold):
+    """
+    Positive and negative tail masks and values of a slab, as threshold.threshold_pair makes them
+    """
+    return [((p_slab >= 1 - p_threshold) & (z_slab >= z_threshold) & (z_slab != 0), z_slab, p_slab),
+            ((p_slab <= p_threshold) & (z_slab <= -z_threshold) & (z_slab != 0), -z_slab, 1 - p_slab)]
+
+
+def threshold_pair_slabs(p_image, z_image, p_threshold=0.005, z_threshold=1, extent=10, slab_size=16):
+    """
+    Same as threshold.threshold_pair, but reading, labelling and writing the maps a slab of z-planes at a time
+
+    Arguments
+    ---------
+    p_image: Image of 1 - p values
+    z_image: z value image
+    p_threshold: p value threshold (e.g. 0.005)
+    z_threshold: z (peak height) threshold (e.g. 1)
+    extent: Extent threshold in voxels (e.g. 10)
+    slab_size: Number of z-planes read at once
+
+    Returns
+    -------
+    List of the files written, and the number of positive and negative clusters
+    """
+    import nibabel
+    from threshold import threshold_output_name
+
+    img = nibabel.load(z_image)
+    shape, affine = img.shape[:3], img.affine
+
+    # first pass - label each slab and join them up
+    tails = [SlabClusters(shape), SlabClusters(shape)]
+    for (z0, p_slab), (_, z_slab) in zip(iter_slabs(p_image, slab_size), iter_slabs(z_image, slab_size)):
+        for clusters, (mask, values, _) in zip(tails, _slab_masks(p_slab, z_slab, p_threshold, z_threshold)):
+            clusters.add(z0, mask, values)
+    results = [clusters.finish(extent) for clusters in tails]
+
+    # second pass - label the slabs again and write out the voxels in the clusters that are kept
+    pos_name = threshold_output_name(z_image, p_threshold, z_threshold, extent)
+    neg_name = pos_name.replace('.nii.gz', '_neg.nii.gz')
+    written = [pos_name, pos_name.replace('.nii.gz', '_p.nii.gz'), neg_name, neg_name.replace('.nii.gz', '_p.nii.gz')]
+    writers = [SlabWriter(name, shape, affine) for name in written]
+    try:
+        slabs = zip(iter_slabs(p_image, slab_size), iter_slabs(z_image, slab_size))
+        for i, ((z0, p_slab), (_, z_slab)) in enumerate(slabs):
+            masks = _slab_masks(p_slab, z_slab, p_threshold, z_threshold)
+            for t, (clusters, (cluster_of, _), (mask, values, sig)) in enumerate(zip(tails, results, masks)):
+                local, _ = clusters.label(mask, structure=STRUCTURE)
+                keep = cluster_of[np.where(local > 0, local + clusters.offsets[i], 0)] > 0
+                writers[2 * t].write(np.where(keep, values, 0))
+                writers[2 * t + 1].write(np.where(keep, sig, 0))
+    finally:
+        for writer in writers:
+            writer.close()
+
+    return written, len(results[0][1]['size']), len(results[1][1]['size'])
+
+
+def slab_cluster_index(path, slab_size=16):
+    """
+    Same as cluster_index.build_cluster_index for a thresholded map, reading it a slab at a time
+
+    Arguments
+    ---------
+    path: Path to the thresholded map
+    slab_size: Number of z-planes read at once
+
+    Returns
+    -------
+    ClusterIndex
+    """
+    import nibabel
+    from cluster_index import ClusterIndex
+
+    img = nibabel.load(path)
+    clusters = SlabClusters(img.shape, keep_voxels=True)
+    for z0, slab in iter_slabs(path, slab_size):
+        clusters.add(z0, slab != 0, slab)
+    cluster_of, table = clusters.finish()
+
+    if clusters.voxels:
+        flat, labels, values = [np.concatenate(v) for v in zip(*clusters.voxels)]
+    else:
+        flat, labels, values = np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+    labels = cluster_of[labels]
+    order = np.lexsort((flat, labels))
+    offsets = np.concatenate([[0], np.cumsum(table['size'])]).astype(np.int64)
+
+    return ClusterIndex(flat[order].astype(np.int32), offsets, table['peak_index'].astype(np.int32),
+                        table['peak'].astype(np.float32), img.shape[:3], img.affine)
+
+
+class SlabMap(object):
+    """
+    A map on disk whose values are read a slab at a time - can be given to ClusterIndex.count_nonzero and
+    max_in_clusters in place of an array
+    """
+
+    def __init__(self, path, slab_size=16):
+        import nibabel
+
+        self.path = path
+        self.slab_size = slab_size
+        self.shape = nibabel.load(path).shape[:3]
+
+    def take_flat(self, indices):
+        """
+        Values at flat indices (C order), reading only the slabs they're in
+        """
+        nx, ny, nz = self.shape
+        indices = np.asarray(indices, dtype=np.int64)
+        x, y, z = indices // (ny * nz), (indices // nz) % ny, indices % nz
+        values = None
+        last = z.max() if len(indices) else -1
+        for z0, slab in iter_slabs(self.path, self.slab_size):
+            if values is None:
+                values = np.zeros(len(indices), dtype=slab.dtype)
+            if z0 > last:
+                break
+            inside = (z >= z0) & (z < z0 + slab.shape[2])
+            values[inside] = slab[x[inside], y[inside], z[inside] - z0]
+        return values
@@ -0,0 +1,167 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from results_catalog import CATALOG_NAME
+from tracing import log, stage as trace_stage
+
+# ############################################################################################################
+# ## Incremental rebuilds for run_entire_meta_analysis                                                     ##
+# ## Each stage records a hash of its inputs (SDM command, the SDM table columns it uses, input files and  ##
+# ## the outputs of the stages it depends on) along with the files it made                                 ##
+# ## A stage is skipped if its inputs hash the same and its outputs are still there                        ##
+# ## The manifest is saved after every stage, so a crashed run picks up from the last finished stage        ##
+# ## Stages can run at the same time in different threads - give each one its outputs so they aren't mixed ##
+# ############################################################################################################
+
+
+class StageManifest(object):
+    """
+    Keeps track of pipeline stages run in a directory
+
+    Arguments
+    ---------
+    directory: Directory the stages write their outputs to
+    manifest_file: Name of the manifest file in the directory (optional)
+    rebuild: Run every stage, even if it's up to date (optional)
+    """
+
+    def __init__(self, directory, manifest_file='.ma_manifest.json', rebuild=False):
+        self.directory = directory
+        self.path = os.path.join(directory, manifest_file)
+        self.rebuild = rebuild
+        self.timings = []  # (stage, 'ran' or 'reused', seconds)
+        self.stages = {}
+        self.digests = {}  # file: [size, mtime, md5] - saves hashing unchanged files again
+        self._lock = threading.RLock()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.stages = saved.get('stages', {})
+            self.digests = saved.get('digests', {})
+
+    def file_digest(self, path):
+        """
+        md5 of a file's contents, only recalculated if its size or modification time has changed
+        """
+        st = os.stat(path)
+        cached = self.digests.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                md5.update(chunk)
+        with self._lock:
+            self.digests[path] = [st.st_size, st.st_mtime, md5.hexdigest()]
+        return md5.hexdigest()
+
+    def table_digest(self, columns=None):
+        """
+        md5 of some of the columns of the SDM table - by default every column except the jack-knife ones
+        """
+        import pandas as pd
+
+        table = pd.read_csv(os.path.join(self.directory, 'sdm_table.txt'), delimiter='\t')
+        if columns is None:
+            columns = [c for c in table.columns if not c.startswith('JK_')]
+        return hashlib.md5(table[list(columns)].to_csv(index=False).encode('utf-8')).hexdigest()
+
+    def run(self, stage, func, command='', files=(), table_columns=(), depends=(), outputs=None):
+        """
+        Runs a stage unless it's already been run with the same inputs and its outputs are unchanged
+
+        Arguments
+        ---------
+        stage: Name of the stage
+        func: Function that runs the stage, called with no arguments
+        command: SDM command (or any other description of the settings) for the stage
+        files: Input files
+        table_columns: SDM table columns the stage uses, None for all of them (except jack-knife columns)
+        depends: Names of the stages whose outputs this stage uses
+        outputs: Start of the names of the files the stage makes (optional, by default any file made or changed
+                 while it runs counts as one of its outputs - give this when stages run at the same time)
+
+        Returns
+        -------
+        True if the stage was run, False if it was reused
+        """
+        md5 = hashlib.md5(command.encode('utf-8'))
+        if table_columns is None or table_columns:
+            md5.update(self.table_digest(table_columns).encode('utf-8'))
+        for f in sorted(files):
+            md5.update((f + self.file_digest(f)).encode('utf-8'))
+        for dependency in depends:
+            md5.update(self.stages.get(dependency, {}).get('outputs_digest', 'missing').encode('utf-8'))
+        inputs_digest = md5.hexdigest()
+
+        start = time.time()
+        previous = self.stages.get(stage)
+        if not self.rebuild and previous and previous['inputs_digest'] == inputs_digest and \
+                self._outputs_unchanged(previous['outputs']):
+            log("Reusing " + stage)
+            self.timings.append((stage, 'reused', time.time() - start))
+            return False
+
+        before = self._snapshot()
+        with trace_stage(stage):
+            func()
+        after = self._snapshot()
+        made = {}
+        for f, state in after.items():
+            if before.get(f) != state and (outputs is None or f.startswith(tuple(outputs))):
+                try:
+                    made[f] = [state[0], state[1], self.file_digest(os.path.join(self.directory, f))]
+                except (IOError, OSError):  # a temporary file that has gone again
+                    pass
+        outputs_md5 = hashlib.md5()
+        for f in sorted(made):
+            outputs_md5.update((f + made[f][2]).encode('utf-8'))
+
+        with self._lock:
+            self.stages[stage] = {'inputs_digest': inputs_digest, 'outputs': made,
+                                  'outputs_digest': outputs_md5.hexdigest() if made else inputs_digest}
+            self.timings.append((stage, 'ran', time.time() - start))
+            self.save()
+        return True
+
+    def save(self):
+        with self._lock:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'stages': self.stages, 'digests': self.digests}, f, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    def report(self):
+        """
+        Prints which stages were run and which were reused, and how long each took
+        """
+        for stage, status, seconds in self.timings:
+            print "%-40s %-7s %8.1f s" % (stage, status, seconds)
+
+    def _snapshot(self):
+        snapshot = {}
+        for f in os.listdir(self.directory):
+            path = os.path.join(self.directory, f)
+            if f in ('sdm_table.txt', os.path.basename(self.path), CATALOG_NAME) or not os.path.isfile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:  # removed since listing the directory, e.g. a temporary file of another stage
+                continue
+            snapshot[f] = (st.st_size, st.st_mtime)
+        return snapshot
+
+    def _outputs_unchanged(self, outputs):
+        for f, state in outputs.items():
+            path = os.path.join(self.directory, f)
+            if not os.path.exists(path):
+                return False
+            st = os.stat(path)
+            if [st.st_size, st.st_mtime] != state[:2] and self.file_digest(path) != state[2]:
+                return False
+        return True
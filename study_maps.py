@@ -0,0 +1,90 @@
+import os
+
+import numpy as np
+from volume_cache import load_volume
+
+# ############################################################################################################
+# ## Helpers for reading SDM's preprocessed study maps directly                                            ##
+# ## SDM's preprocessing writes an effect size map and a variance map for each study in the analysis        ##
+# ## directory - change the patterns below if your version of SDM names them differently                   ##
+# ############################################################################################################
+
+EFFECT_MAP = 'pp_%s.nii.gz'
+VARIANCE_MAP = 'pp_%s_var.nii.gz'
+
+
+def study_map_paths(ma_dir, study):
+    """
+    Gets the paths of a study's preprocessed effect size and variance maps
+
+    Arguments
+    ---------
+    ma_dir: Directory containing the meta-analysis files
+    study: Study name, as in the SDM table
+
+    Returns
+    -------
+    Paths to the effect size map and the variance map
+    """
+    return os.path.join(ma_dir, EFFECT_MAP % study), os.path.join(ma_dir, VARIANCE_MAP % study)
+
+
+def selected_studies(ma_dir, selection_column=None):
+    """
+    Gets the names of the studies in the SDM table, optionally only those selected by a filter column
+
+    Arguments
+    ---------
+    ma_dir: Directory containing sdm_table.txt
+    selection_column: Column in the SDM table selecting the studies to include (optional)
+
+    Returns
+    -------
+    List of study names
+    """
+    import pandas as pd
+
+    table = pd.read_csv(os.path.join(ma_dir, 'sdm_table.txt'), delimiter='\t')
+    if selection_column:
+        table = table[table[selection_column] == 1]
+    return list(table['study'])
+
+
+def mni_to_voxel(mni_coords, affine):
+    """
+    Converts MNI coordinates to the nearest voxel indices using the inverse of the image affine
+
+    Arguments
+    ---------
+    mni_coords: Array of MNI coordinates (n x 3)
+    affine: Image affine
+
+    Returns
+    -------
+    Array of voxel indices (n x 3)
+    """
+    mni_coords = np.atleast_2d(np.asarray(mni_coords, dtype=float))
+    inverse = np.linalg.inv(affine)
+    return np.round(mni_coords.dot(inverse[:3, :3].T) + inverse[:3, 3]).astype(int)
+
+
+def sample_map(path, mni_coords):
+    """
+    Gets the values of an image at a set of MNI coordinates, NaN for coordinates outside the image
+
+    Arguments
+    ---------
+    path: Path to the image
+    mni_coords: Array of MNI coordinates (n x 3)
+
+    Returns
+    -------
+    Array of n values
+    """
+    data, affine, _ = load_volume(path)
+    voxels = mni_to_voxel(mni_coords, affine)
+    inside = np.all((voxels >= 0) & (voxels < data.shape[:3]), axis=1)
+    values = np.empty(len(voxels))
+    values.fill(np.nan)
+    values[inside] = data[voxels[inside, 0], voxels[inside, 1], voxels[inside, 2]]
+    return values
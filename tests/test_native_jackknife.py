@@ -0,0 +1,77 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from native_jackknife import native_jackknife
+from random_effects import dersimonian_laird
+from study_maps import EFFECT_MAP, VARIANCE_MAP
+
+# ############################################################################################################
+# ## Runs native_jackknife on a few small study maps written to a temporary directory, and checks each      ##
+# ## leave-one-out z map against a random-effects model fitted to the remaining studies at every voxel      ##
+# ## python -m unittest discover tests (or pytest tests)                                                    ##
+# ############################################################################################################
+
+SHAPE = (4, 5, 3)
+STUDIES = ['smith', 'jones', 'brown', 'green', 'white']
+
+
+class NativeJackknifeTest(unittest.TestCase):
+
+    def setUp(self):
+        import nibabel
+
+        rng = np.random.RandomState(0)
+        self.ma_dir = tempfile.mkdtemp()
+        self.effects = rng.normal(0.5, 1, (len(STUDIES),) + SHAPE).astype(np.float32)
+        self.variances = rng.uniform(0.1, 1, (len(STUDIES),) + SHAPE).astype(np.float32)
+        self.variances[:, 0, 0, 0] = 0  # no data in any study
+        self.variances[1, 1, 1, 1] = 0  # missing in one study
+
+        with open(os.path.join(self.ma_dir, 'sdm_table.txt'), 'w') as f:
+            f.write('study\tgroup\n')
+            for i, study in enumerate(STUDIES):
+                f.write('%s\t%d\n' % (study, i != 4))  # white isn't selected
+        for i, study in enumerate(STUDIES):
+            nibabel.Nifti1Image(self.effects[i], np.eye(4)).to_filename(os.path.join(self.ma_dir, EFFECT_MAP % study))
+            nibabel.Nifti1Image(self.variances[i], np.eye(4)).to_filename(
+                os.path.join(self.ma_dir, VARIANCE_MAP % study))
+
+    def tearDown(self):
+        shutil.rmtree(self.ma_dir)
+
+    def test_maps_match_random_effects_model(self):
+        import nibabel
+        from scipy.special import ndtr
+
+        outputs = native_jackknife(self.ma_dir, 'TEST', selection_column='group')
+        self.assertEqual([os.path.basename(z) for _, z in outputs],
+                         ['TEST_JK_%s_z.nii.gz' % study for study in STUDIES[:4]])
+
+        for j, (p_map, z_map) in enumerate(outputs):
+            z = np.asanyarray(nibabel.load(z_map).dataobj)
+            p = np.asanyarray(nibabel.load(p_map).dataobj)
+            self.assertEqual(z.shape, SHAPE)
+
+            kept = [i for i in range(4) if i != j]
+            y = self.effects[kept].reshape(len(kept), -1).T.astype(np.float64)
+            v = self.variances[kept].reshape(len(kept), -1).T.astype(np.float64)
+            missing = ~(v > 0)
+            y[missing] = np.nan
+            v[missing] = np.nan
+            expected = dersimonian_laird(y, v)['z'].reshape(SHAPE)
+            expected[~np.isfinite(expected)] = 0
+
+            self.assertEqual(z[0, 0, 0], 0)
+            np.testing.assert_allclose(z, expected, rtol=1e-4, atol=1e-5)
+            np.testing.assert_allclose(p[z != 0], ndtr(z[z != 0]), rtol=1e-4)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,33 @@
-import nibabel
 import numpy as np
-from scipy import ndimage, stats
+from tracing import log
+from volume_cache import load_volume
+
+# structure for labeling - 26-connectivity, as SDM uses
+STRUCTURE = np.ones((3, 3, 3), dtype=int)
+
+
+def extent_filter(mask, extent):
+    """
+    Removes clusters smaller than the extent threshold from a boolean mask
+
+    Arguments:
+    mask = boolean array of voxels passing the height threshold
+    extent = extent threshold in voxels
+
+    Returns:
+    mask with small clusters removed, cluster labels (after removal) and the number of clusters left
+    """
+    from scipy import ndimage
+
+    labeled_array, num_features = ndimage.label(mask, structure=STRUCTURE)
+    sizes = np.bincount(labeled_array.ravel(), minlength=num_features + 1)
+    keep = sizes >= extent
+    keep[0] = False  # background
+    new_labels = np.zeros(num_features + 1, dtype=np.int32)  # relabel the surviving clusters 1..n
+    new_labels[keep] = np.arange(1, np.sum(keep) + 1)
+    labeled_array = new_labels[labeled_array]
+
+    return labeled_array > 0, labeled_array, int(np.sum(keep))
 
 
 def threshold_img(p_image, z_image, p_threshold, z_threshold, extent):
@@ -24,35 +51,227 @@ def threshold_img(p_image, z_image, p_threshold, z_threshold, extent):
     threshold_img(p, z, 0.005, 0.0638, 10)
 
     """
-    p_data = nibabel.load(p_image).get_data()
-    z_data = nibabel.load(z_image).get_data()
-    affine = nibabel.load(p_image).get_affine()
+    p_data, affine, _ = load_volume(p_image)
+    z_data = load_volume(z_image)[0]
 
-    p_data[np.where(p_data < (1-p_threshold))] = 0
+    mask, _, _ = extent_filter(_height_mask(p_data, z_data, p_threshold, z_threshold), extent)
+    _write_thresholded(z_image, z_data, mask, affine, p_threshold, z_threshold, extent)
 
-    z_data[np.where(p_data == 0)] = 0
-    z_data[np.where(z_data < z_threshold)] = 0
+    log("Thresholded %s at %s, %s, %s" % (z_image, p_threshold, z_threshold, extent))
 
-    # structure for labeling - there's probably a better way to define this
-    s = [[[1, 1, 1], [1, 1, 1], [1, 1, 1]], [[1, 1, 1], [1, 1, 1], [1, 1, 1]], [[1, 1, 1], [1, 1, 1], [1, 1, 1]]]
 
-    labeled_array, num_features = ndimage.label(z_data, structure=s)  # Label clusters in z image
+def _height_mask(p_data, z_data, p_threshold, z_threshold):
+    """
+    Voxels passing the p and z thresholds (p images hold 1 - p)
+    """
+    return (p_data >= 1 - p_threshold) & (p_data != 0) & (z_data >= z_threshold) & (z_data != 0)
 
-    sizes = stats.itemfreq(labeled_array)
 
-    for i in range(1, np.max(labeled_array)+1):
-        if sizes[i][1] < extent:
-            z_data[np.where(labeled_array == i)] = 0
+def _write_thresholded(z_image, z_data, mask, affine, p_threshold, z_threshold, extent):
+    """
+    Saves the z values inside the mask as z_image_thresholded_p_z_extent.nii.gz
+    """
+    import nibabel
 
-    z_img = nibabel.Nifti1Image(z_data, affine)
+    z_img = nibabel.Nifti1Image(np.where(mask, z_data, 0).astype(z_data.dtype), affine)
     z_filename = z_image.replace('.nii.gz', '_thresholded_%s_%s_%s.nii.gz' % (p_threshold, z_threshold, extent))
     z_img.to_filename(z_filename)
 
-    print "Thresholded %s at %s, %s, %s" % (z_image, p_threshold, z_threshold, extent)
+    return z_filename
+
 
+def threshold_sweep(p_image, z_image, p_thresholds, z_thresholds, extents, write_maps=False, csv_name=''):
+    """
+    Thresholds a nifti image at every combination of p, z and extent thresholds, for sensitivity analyses
+    Clusters are only labelled once for each p/z combination, the extent thresholds just use the cluster sizes
+
+    Arguments:
+    p_image = raw p value image to be thresholded (in .nii.gz format)
+    z_image = z value image to be thresholded (in .nii.gz format)
+    p_thresholds = list of p value thresholds (e.g. [0.005, 0.001])
+    z_thresholds = list of z value thresholds (e.g. [0, 0.638, 1])
+    extents = list of extent thresholds in voxels (e.g. [1, 10, 50])
+    write_maps (Optional) = saves a thresholded image for every combination, named as in threshold_img
+    csv_name (Optional) = name for a csv file to save the summary to, doesn't save csv if not given
 
+    Returns:
+    summary = A pandas dataframe with the number of clusters, number of voxels and the largest, smallest and mean
+              cluster size for each combination
+
+    E.g.
+    threshold_sweep(p, z, [0.005, 0.001], [0, 1], [1, 10, 20])
+
+    """
+    import pandas as pd
+    from scipy import ndimage
+
+    p_data, affine, _ = load_volume(p_image)
+    z_data = load_volume(z_image)[0]
+
+    rows = []
+    for p_threshold in p_thresholds:
+        for z_threshold in z_thresholds:
+            labeled_array, num_features = ndimage.label(_height_mask(p_data, z_data, p_threshold, z_threshold),
+                                                        structure=STRUCTURE)
+            sizes = np.bincount(labeled_array.ravel(), minlength=num_features + 1)
+            sizes[0] = 0  # background
+            for extent in extents:
+                keep = sizes >= max(extent, 1)
+                cluster_sizes = sizes[keep]
+                rows.append([p_threshold, z_threshold, extent, len(cluster_sizes), int(np.sum(cluster_sizes)),
+                             int(np.max(cluster_sizes)) if len(cluster_sizes) else 0,
+                             int(np.min(cluster_sizes)) if len(cluster_sizes) else 0,
+                             float(np.mean(cluster_sizes)) if len(cluster_sizes) else 0.])
+                if write_maps:
+                    _write_thresholded(z_image, z_data, keep[labeled_array], affine, p_threshold, z_threshold, extent)
+
+    summary = pd.DataFrame(rows, columns=['p', 'z', 'extent', 'Clusters', 'Voxels', 'Largest', 'Smallest',
+                                          'Mean size'])
+    if csv_name:
+        summary.to_csv(csv_name, index=False)
+
+    return summary
+
+
+# Example
+"""
 p = 'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/MDD_neg_BD_neg_praw.nii.gz'
 z = 'C:/Users/k1327409/Documents/VBShare/20_05_conjunction/MDD_neg_BD_neg_z.nii.gz'
 
 threshold_img(p, z, 0.005, 0.0638, 10)
 
+sweep = threshold_sweep(p, z, [0.005, 0.001, 0.0005], [0, 0.0638, 1], [1, 10, 50])
+"""
+
+
+# ############################################################################################################
+# ## Batch thresholding in numpy, instead of starting an SDM process for every map                         ##
+# ## Writes the same files as SDM's threshold command - e.g. thresholding MDD_JK_study_z at p = 0.005,      ##
+# ## peak height = 1, extent = 10 gives MDD_JK_study_z_p_0.00500_1.000_10.nii.gz and ..._10_neg.nii.gz      ##
+# ## along with _p.nii.gz significance maps for each of them                                                ##
+# ## p images hold 1 - p, as in threshold_img                                                               ##
+# ############################################################################################################
+
+def threshold_output_name(z_image, p_threshold, z_threshold, extent):
+    """
+    Gets the name SDM gives a thresholded positive map, e.g. MDD_mean_z_p_0.00500_1.000_10.nii.gz
+    """
+    return z_image.replace('.nii.gz', '_p_%.5f_%.3f_%d.nii.gz' % (p_threshold, z_threshold, extent))
+
+
+def threshold_pair(p_image, z_image, p_threshold=0.005, z_threshold=1, extent=10, slab_size=None):
+    """
+    Thresholds the positive and negative tails of a z image and writes SDM style outputs
+
+    Arguments:
+    p_image = image of 1 - p values (in .nii.gz format)
+    z_image = z value image (in .nii.gz format)
+    p_threshold = p value threshold (e.g. 0.005)
+    z_threshold = z (peak height) threshold (e.g. 1)
+    extent = extent threshold in voxels (e.g. 10)
+    slab_size = number of z-planes to read at once (optional, reads the whole maps if not given) - for maps too big to
+                hold in memory, gives the same results (see slab_threshold.py)
+
+    Returns:
+    List of the files written, and the number of positive and negative clusters
+    """
+    import nibabel
+
+    if slab_size:
+        from slab_threshold import threshold_pair_slabs
+        return threshold_pair_slabs(p_image, z_image, p_threshold, z_threshold, extent, slab_size)
+
+    # not through the volume cache - each map is only thresholded once, and workers would keep every map they read
+    p_data = np.asanyarray(nibabel.load(p_image).dataobj)
+    z_img = nibabel.load(z_image)
+    z_data, affine = np.asanyarray(z_img.dataobj), z_img.affine
+
+    pos_name = threshold_output_name(z_image, p_threshold, z_threshold, extent)
+    neg_name = pos_name.replace('.nii.gz', '_neg.nii.gz')
+
+    # both tails from the same arrays - negative results are saved as positive values, as SDM does
+    tails = [(pos_name, (p_data >= 1 - p_threshold) & (z_data >= z_threshold) & (z_data != 0), z_data, p_data),
+             (neg_name, (p_data <= p_threshold) & (z_data <= -z_threshold) & (z_data != 0), -z_data, 1 - p_data)]
+
+    written = []
+    n_clusters = []
+    for name, mask, values, sig in tails:
+        mask, labeled_array, num_features = extent_filter(mask, extent)
+        out = np.where(mask, values, 0).astype(np.float32)
+        out_sig = np.where(mask, sig, 0).astype(np.float32)
+        nibabel.Nifti1Image(out, affine).to_filename(name)
+        nibabel.Nifti1Image(out_sig, affine).to_filename(name.replace('.nii.gz', '_p.nii.gz'))
+        written += [name, name.replace('.nii.gz', '_p.nii.gz')]
+        n_clusters.append(num_features)
+
+    return written, n_clusters[0], n_clusters[1]
+
+
+def _threshold_pair(args):
+    return threshold_pair(*args)
+
+
+def threshold_maps(pairs, p_threshold=0.005, z_threshold=1, extent=10, n_workers=None, slab_size=None):
+    """
+    Thresholds a batch of maps across several processes
+
+    Arguments:
+    pairs = list of (p image, z image) tuples
+    p_threshold = p value threshold (e.g. 0.005)
+    z_threshold = z (peak height) threshold (e.g. 1)
+    extent = extent threshold in voxels (e.g. 10)
+    n_workers = number of processes to use (optional, defaults to the number of cores)
+    slab_size = number of z-planes to read at once (optional, see threshold_pair)
+
+    Returns:
+    List of (z image, number of positive clusters, number of negative clusters) tuples, in the same order as pairs
+
+    E.g.
+    threshold_maps(sdm_map_pairs('path/to/analysis', r'.+JK.+(?<!QH)_z\.nii\.gz$'))
+
+    """
+    from multiprocessing import Pool
+
+    jobs = [(p, z, p_threshold, z_threshold, extent, slab_size) for p, z in pairs]
+    if n_workers == 1 or len(jobs) < 2:
+        results = [_threshold_pair(job) for job in jobs]
+    else:
+        pool = Pool(n_workers)
+        try:
+            results = pool.map(_threshold_pair, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    summary = []
+    for (p, z), (written, n_pos, n_neg) in zip(pairs, results):
+        log("Thresholded %s at %s, %s, %s - %d positive, %d negative clusters" % (z, p_threshold, z_threshold,
+                                                                                  extent, n_pos, n_neg))
+        summary.append((z, n_pos, n_neg))
+
+    return summary
+
+
+def sdm_map_pairs(directory, regex, p_suffix='_p'):
+    """
+    Finds SDM z maps in a directory and pairs each one with its p map
+
+    Arguments:
+    directory = directory containing the SDM outputs
+    regex = regex matching the z map file names, e.g. r'.+JK.+(?<!QH)_z\.nii\.gz$'
+    p_suffix = what replaces _z in the name of the p map (optional, default MDD_mean_z -> MDD_mean_p)
+
+    Returns:
+    List of (p image, z image) tuples
+    """
+    import os
+    import re
+
+    pairs = []
+    for f in sorted(os.listdir(directory)):
+        if re.match(regex, f):
+            z = os.path.join(directory, f)
+            p = os.path.join(directory, f[:-len('_z.nii.gz')] + p_suffix + '.nii.gz')
+            pairs.append((p, z))
+
+    return pairs
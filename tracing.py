@@ -0,0 +1,205 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# ############################################################################################################
+# ## Timing and resource use of pipeline stages and SDM calls                                              ##
+# ## stage(): context manager recording start/end, duration, peak memory and bytes read for a block        ##
+# ## sdm_call(): runs a command (usually SDM) and records its exit status, run time and peak memory        ##
+# ## log(): progress messages, which can be switched off with set_verbose(False) on big runs - failures    ##
+# ## (log(message, error=True)) always go to stderr                                                        ##
+# ## write_trace(): saves everything recorded as a Chrome trace (.json, open in chrome://tracing) or as     ##
+# ## JSON lines (.jsonl)                                                                                    ##
+# ############################################################################################################
+
+_events = []
+_lock = threading.Lock()
+_start = time.time()
+_verbose = True
+
+
+def set_verbose(verbose):
+    """
+    Switches progress messages from log() on or off
+    """
+    global _verbose
+    _verbose = verbose
+
+
+def log(message, error=False):
+    """
+    Prints a progress message, unless verbose output has been switched off
+    Errors are printed to stderr whether verbose output is on or not
+    """
+    if error:
+        print >> sys.stderr, message
+    elif _verbose:
+        print message
+
+
+def peak_rss_mb():
+    """
+    Peak memory use of this process so far in MB (None where it can't be measured, e.g. on Windows)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024. ** 2 if sys.platform == 'darwin' else rss / 1024.  # bytes on mac, KB on linux
+
+
+def bytes_read():
+    """
+    Bytes this process has read so far, from /proc (None where it isn't available)
+    """
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('rchar:'):
+                    return int(line.split()[1])
+    except IOError:
+        return None
+
+
+def _record(event):
+    with _lock:
+        _events.append(event)
+
+
+@contextmanager
+def stage(name, **info):
+    """
+    Records the run time, peak memory and bytes read of a block of code
+
+    Arguments
+    ---------
+    name: Name of the stage
+    info: Anything else to save with the stage, e.g. study='Smith_2010'
+
+    E.g.
+    with stage('label', study=study):
+        labeled_array, num_features = ndimage.label(img, structure=s)
+    """
+    start = time.time()
+    read_start = bytes_read()
+    status = 'ok'
+    try:
+        yield
+    except BaseException:
+        status = 'error'
+        raise
+    finally:
+        read_end = bytes_read()
+        event = {'name': name, 'type': 'stage', 'start': start - _start, 'duration': time.time() - start,
+                 'peak_rss_mb': peak_rss_mb(), 'status': status, 'thread': threading.current_thread().name,
+                 'bytes_read': read_end - read_start if read_start is not None and read_end is not None else None}
+        event.update(info)
+        _record(event)
+
+
+def sdm_call(args, cwd=None, name=None, stdout=None, stderr=None, timeout=None):
+    """
+    Runs a command, as subprocess.call does, and records its exit status, run time and peak memory
+
+    Arguments
+    ---------
+    args: Command as a list of arguments
+    cwd: Directory to run it in (optional)
+    name: Name to record it under (optional, defaults to the command)
+    stdout, stderr: Files to send the command's output to (optional, as for subprocess.call)
+    timeout: Seconds to let the command run before killing it (optional)
+
+    Returns
+    -------
+    return_code: Exit status of the command (negative if it was killed)
+    """
+    start = time.time()
+    process = subprocess.Popen(args, cwd=cwd, stdout=stdout, stderr=stderr)
+    timer = None
+    if timeout:
+        timer = threading.Timer(timeout, process.kill)
+        timer.start()
+    peak_rss = None
+    try:
+        if hasattr(os, 'wait4'):  # gets the resource use of this process alone
+            _, status, usage = os.wait4(process.pid, 0)
+            process.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            peak_rss = usage.ru_maxrss / 1024. ** 2 if sys.platform == 'darwin' else usage.ru_maxrss / 1024.
+        else:
+            process.wait()
+    finally:
+        if timer:
+            timer.cancel()
+
+    duration = time.time() - start
+    _record({'name': name or ' '.join(args[1:]), 'type': 'subprocess', 'start': start - _start,
+             'duration': duration, 'peak_rss_mb': peak_rss, 'exit_status': process.returncode,
+             'timed_out': bool(timeout) and process.returncode != 0 and duration >= timeout,
+             'command': args, 'thread': threading.current_thread().name})
+
+    return process.returncode
+
+
+def events():
+    """
+    Returns a copy of everything recorded so far
+    """
+    with _lock:
+        return list(_events)
+
+
+def clear():
+    """
+    Forgets everything recorded so far
+    """
+    global _start
+    with _lock:
+        del _events[:]
+        _start = time.time()
+
+
+def write_trace(path):
+    """
+    Saves everything recorded so far - as JSON lines if the file ends in .jsonl, otherwise as a Chrome trace
+
+    Arguments
+    ---------
+    path: File to write to
+    """
+    recorded = events()
+    with open(path, 'w') as f:
+        if path.endswith('.jsonl'):
+            for event in recorded:
+                f.write(json.dumps(event) + '\n')
+        else:
+            threads = {}
+            trace = []
+            for event in recorded:
+                tid = threads.setdefault(event['thread'], len(threads))
+                args = dict((k, v) for k, v in event.items() if k not in ('name', 'start', 'duration', 'thread'))
+                trace.append({'name': event['name'], 'cat': event['type'], 'ph': 'X', 'pid': os.getpid(),
+                              'tid': tid, 'ts': int(event['start'] * 1e6), 'dur': int(event['duration'] * 1e6),
+                              'args': args})
+            for thread, tid in threads.items():
+                trace.append({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': tid,
+                              'args': {'name': thread}})
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+
+
+def summary():
+    """
+    Prints the total time and number of calls for each stage and for SDM
+    """
+    totals = {}
+    for event in events():
+        key = 'SDM' if event['type'] == 'subprocess' else event['name']
+        total = totals.setdefault(key, [0, 0.])
+        total[0] += 1
+        total[1] += event['duration']
+    for key in sorted(totals, key=lambda k: -totals[k][1]):
+        print "%-40s %6d calls %10.1f s" % (key, totals[key][0], totals[key][1])
@@ -0,0 +1,187 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from sidecar_store import load_mapped, is_mapped
+
+# ############################################################################################################
+# ## Process-wide cache of decoded NIfTI volumes                                                          ##
+# ## The same thresholded maps get loaded by several checks in a run, so keep the decoded arrays around    ##
+# ## Entries are keyed by path, modification time and size so a rewritten file is always reloaded         ##
+# ## Cached arrays are read-only - take a copy before changing them                                        ##
+# ## With a sidecar directory set, .nii.gz files are served as memory maps of uncompressed copies           ##
+# ############################################################################################################
+
+
+class VolumeCache(object):
+    """
+    Least recently used cache of NIfTI data arrays, affines and headers with a memory budget
+
+    Arguments
+    ---------
+    max_bytes: Maximum total size of the cached data arrays in bytes (memory-mapped arrays don't count)
+    sidecar_dir: Directory for uncompressed, memory-mapped copies of .nii.gz files (optional, off by default)
+    """
+
+    def __init__(self, max_bytes=1024 ** 3, sidecar_dir=None):
+        self.max_bytes = max_bytes
+        self.sidecar_dir = sidecar_dir
+        self.hits = 0
+        self.misses = 0
+        self.current_bytes = 0
+        self._entries = OrderedDict()  # path: (key, data, affine, header, size in memory)
+        self._lock = threading.Lock()
+
+    def load(self, path):
+        """
+        Loads a NIfTI image, using the cached copy if the file hasn't changed
+
+        Arguments
+        ---------
+        path: Path to the image
+
+        Returns
+        -------
+        data: Read-only array of the image data
+        affine: Copy of the image affine
+        header: Copy of the image header
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_mtime, st.st_size)
+
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry[0] == key:
+                self._entries[path] = entry  # move to the most recently used end
+                self.hits += 1
+                return entry[1], entry[2].copy(), entry[3].copy()
+            if entry is not None:  # file has changed since it was cached
+                self.current_bytes -= entry[4]
+            self.misses += 1
+
+        if self.sidecar_dir:
+            data, affine, header = load_mapped(path, self.sidecar_dir)
+        else:
+            import nibabel
+            img = nibabel.load(path)
+            data = np.asarray(img.dataobj)
+            data.flags.writeable = False
+            affine = img.affine
+            header = img.header
+        size = 0 if is_mapped(data) else data.nbytes
+
+        with self._lock:
+            if size <= self.max_bytes:
+                old = self._entries.pop(path, None)
+                if old is not None:
+                    self.current_bytes -= old[4]
+                self._entries[path] = (key, data, affine, header, size)
+                self.current_bytes += size
+                self._evict()
+
+        return data, affine.copy(), header.copy()
+
+    def resize(self, max_bytes):
+        """
+        Changes the memory budget, dropping the least recently used volumes if needed
+        """
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        """
+        Empties the cache and resets the hit/miss counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Returns a dictionary of cache statistics
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'volumes': len(self._entries),
+                    'bytes': self.current_bytes, 'max_bytes': self.max_bytes}
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            path, entry = self._entries.popitem(last=False)
+            self.current_bytes -= entry[4]
+
+
+_cache = VolumeCache()
+
+
+def load_volume(path):
+    """
+    Loads a NIfTI image through the shared volume cache
+
+    Arguments
+    ---------
+    path: Path to the image
+
+    Returns
+    -------
+    data: Read-only array of the image data
+    affine: Image affine
+    header: Image header
+    """
+    return _cache.load(path)
+
+
+def use_sidecar_store(sidecar_dir):
+    """
+    Turns on (or off, with None) memory-mapped sidecar copies of .nii.gz files for the shared volume cache
+    The setting is for the whole process - pass the directory this returns back in when done to restore it, e.g.
+    previous = use_sidecar_store(sidecar_dir)
+    try:
+        ...
+    finally:
+        use_sidecar_store(previous)
+
+    Arguments
+    ---------
+    sidecar_dir: Directory to keep the uncompressed sidecars in, e.g. ma_dir + 'sidecars'
+
+    Returns
+    -------
+    previous: The sidecar directory used until now (None if sidecars were off)
+    """
+    previous = _cache.sidecar_dir
+    _cache.clear()
+    _cache.sidecar_dir = sidecar_dir
+    return previous
+
+
+def get_sidecar_dir():
+    """
+    Returns the sidecar directory of the shared volume cache, or None if sidecars are off
+    """
+    return _cache.sidecar_dir
+
+
+def set_cache_size(max_bytes):
+    """
+    Sets the memory budget of the shared volume cache, in bytes
+    """
+    _cache.resize(max_bytes)
+
+
+def cache_info():
+    """
+    Returns hit/miss counts and memory use of the shared volume cache
+    """
+    return _cache.info()
+
+
+def clear_cache():
+    """
+    Empties the shared volume cache
+    """
+    _cache.clear()
@@ -2,111 +2,197 @@
 # script to run an entire meta-analysis
 
 
-def run_entire_meta_analysis(ma_dir, sdm_path, analysis_name, metareg_columns, filter_var=''):
+def run_entire_meta_analysis(ma_dir, sdm_path, analysis_name, metareg_columns, filter_var='', n_workers=4,
+                             sidecar_dir=None, threshold_engine='sdm', jackknife_engine='sdm', rebuild=False,
+                             trace_file=None, verbose=True, max_concurrent=None, sdm_timeout=None, sdm_retries=0,
+                             log_dir=None, extract_store=None):
     """
     Runs an entire meta-analysis with jack-knife and meta-regression analyses.
-    Extracts peak coordinate information for mean and meta-regression analyses.
+    Extracts peak coordinate information for mean and meta-regression analyses, and fits a random-effects model and
+    Egger's test to the values at each peak (see random_effects.py).
     Checks jack-knife and meta-regression results against mean and heterogeneity results.
+    Stages whose inputs haven't changed since the last run are skipped (see stage_manifest.py), so adding a
+    meta-regression only runs that meta-regression, and a crashed run carries on from the last finished stage.
+    Stages run as a task graph (see scheduler.py) - each starts as soon as the stages it depends on have finished, so
+    the mean, jack-knife and meta-regressions run side by side. The run stops at the first SDM command that fails.
 
     :param ma_dir: Directory containing the meta-analysis files (must end in /)
     :param sdm_path: Path to SDM
     :param analysis_name: What you want the name of the analysis to be
     :param metareg_columns: Column names for meta-regressions
     :param filter_var (optional): A filter variable in the SDM table
+    :param n_workers (optional): Number of jack-knife analyses to run at the same time
+    :param sidecar_dir (optional): Directory for uncompressed, memory-mapped copies of the result niftis
+    :param threshold_engine (optional): 'numpy' thresholds the jack-knife maps in this process rather than with one
+                                        SDM call per map ('sdm', the default)
+    :param jackknife_engine (optional): 'native' computes the jack-knife maps from the preprocessed study maps (see
+                                        native_jackknife.py) rather than with an SDM mean per study ('sdm', the
+                                        default) - these are always thresholded with the numpy engine
+    :param rebuild (optional): Run every stage, even the ones that are up to date
+    :param trace_file (optional): File to save the timing, memory use and exit status of every stage and SDM call to
+                                  (.json for a Chrome trace, .jsonl for JSON lines - see tracing.py)
+    :param verbose (optional): Print progress messages - switch off for big runs
+    :param max_concurrent (optional): Number of stages to run at the same time (defaults to n_workers, 1 runs them
+                                      one after another)
+    :param sdm_timeout (optional): Seconds to let each SDM command run before killing it
+    :param sdm_retries (optional): Number of times to retry an SDM command that fails
+    :param log_dir (optional): Directory for the output of each SDM command (defaults to ma_dir/sdm_logs)
+    :param extract_store (optional): Parquet store to add the extracted values to as well, e.g.
+                                     ma_dir + 'extracted_values.parquet' (see extracted_store.py - needs pyarrow)
     :return: A WHOLE META-ANALYSIS
     """
 
     import os
-    import subprocess
     import shlex
-    import pandas as pd
-    import numpy as np
-    from sdm_functions import threshold_jackknife, get_coords, extract_coordinate_values
+    from sdm_functions import threshold_jackknife, get_coords, extract_all_coordinate_values, run_jackknife
     from check_jk_niftis import check_jk_niftis
+    from volume_cache import use_sidecar_store
+    from threshold import threshold_maps, sdm_map_pairs
+    from stage_manifest import StageManifest
+    from study_maps import selected_studies
+    from native_jackknife import native_jackknife
+    from random_effects import cluster_meta_analyses
+    from scheduler import TaskGraph, CommandError, run_command
+    from tracing import log, set_verbose, write_trace, summary
 
     os.chdir(ma_dir)
-    files = os.listdir(ma_dir)
-    for f in files:
-        if re.match(r'sdm_table.txt$', f):
-            sdm_table = ma_dir + f
-
-    #  preprocess
-    print "Preprocessing"
-    print shlex.split(sdm_path + ' pp gray_matter, 1.0, 20, gray_matter, 2')
-    subprocess.call(shlex.split(sdm_path + ' pp gray_matter, 1.0, 20, gray_matter, 2'))
+    set_verbose(verbose)
+    manifest = StageManifest(ma_dir, rebuild=rebuild)
+    selection = ['study', filter_var] if filter_var else ['study']
+    log_dir = log_dir or os.path.join(ma_dir, 'sdm_logs')
+    graph = TaskGraph()
+
+    def sdm(arg, name):
+        log(shlex.split(sdm_path + ' ' + arg))
+        run_command(shlex.split(sdm_path + ' ' + arg), name, timeout=sdm_timeout, retries=sdm_retries,
+                    log_dir=log_dir)
+
+    def add_stage(name, message, func, depends=(), after=(), **kwargs):
+        def run_stage():
+            log(message)
+            manifest.run(name, func, depends=depends, **kwargs)
+        graph.add(name, run_stage, depends=list(depends) + list(after))  # after only orders stages, it's not an input
+
+    #  preprocess - uses the raw study files (named after each study) and the whole table
+    pp_arg = 'pp gray_matter, 1.0, 20, gray_matter, 2'
+    study_files = [ma_dir + f for f in os.listdir(ma_dir) if os.path.isfile(ma_dir + f) and
+                   any(f.startswith(study + '.') for study in selected_studies(ma_dir))]
+    add_stage('pp', "Preprocessing", lambda: sdm(pp_arg, 'pp'), command=pp_arg, files=study_files,
+              table_columns=None)
 
     #  mean
-    print "Running mean analysis"
-    subprocess.call(shlex.split(sdm_path + ' ' + analysis_name + '_mean' + ' = mean ' + filter_var))
+    mean_arg = analysis_name + '_mean' + ' = mean ' + filter_var
+    add_stage('mean', "Running mean analysis", lambda: sdm(mean_arg, 'mean'), command=mean_arg,
+              table_columns=selection, depends=['pp'], outputs=[analysis_name + '_mean'])
 
     #  threshold mean & heterogeneity
-    print "Thresholding mean and heterogeneity"
-    subprocess.call(shlex.split(sdm_path + ' threshold ' + analysis_name + '_mean_z' + ', p, 0.005, 1, 10'))
-    subprocess.call(shlex.split(sdm_path + ' threshold ' + analysis_name + '_mean_QH_z' + ', p, 0.005, 1, 10'))
+    threshold_args = ['threshold ' + analysis_name + '_mean_z' + ', p, 0.005, 1, 10',
+                      'threshold ' + analysis_name + '_mean_QH_z' + ', p, 0.005, 1, 10']
+    add_stage('threshold_mean', "Thresholding mean and heterogeneity",
+              lambda: [sdm(arg, 'threshold_mean_%d' % i) for i, arg in enumerate(threshold_args)],
+              command=str(threshold_args), depends=['mean'],
+              outputs=[analysis_name + '_mean_z_p_', analysis_name + '_mean_QH_z_p_'])
 
     #  jack-knife - no way to call from command line so have to do manually :(
-    print "Running jack-knife"
-    table = pd.read_csv(sdm_table, delimiter='\t')
-
-    num_studies = len(table)
-
-    selection_var = table['CombinedGroups']
-
-    for i in range(0,num_studies):
-        if selection_var[i] == 1:  # only go through this if study is selected
-            thing = np.ones(num_studies)  # generate an array of ones the length of the table
-            thing[i] = 0  # set the current study to 0 (we want to leave this study out of this iteration)
-            name = analysis_name + '_JK_' + table['study'][thing == 0].values[0]  # name of the analysis
-            thing[np.where(selection_var == 0)] = 0  # set anything where selection variable is zero to zero in thing
-            table['JK_column'] = thing  # add this array to the table in a new column
-            print name  # print stuff because I like printing stuff
-            print thing
-            table.to_csv('sdm_table.txt', sep='\t', index=False)  # save the table with this new column
-            subprocess.call([sdm_path, name, ' = ', 'mean', 'JK_column'])  # run a mean analysis using this JK column
-
-    #  run and threshold meta-regressions
-    print "Running meta-regressions"
+    #  each iteration runs in its own copy of the preprocessed files so they can run side by side
+    if jackknife_engine == 'native':
+        threshold_engine = 'numpy'  # there are no SDM results to threshold
+        jackknife = lambda: native_jackknife(ma_dir, analysis_name, selection_column=filter_var)
+    else:
+        def jackknife():
+            failed = run_jackknife(ma_dir, sdm_path, analysis_name, selection_column=filter_var, n_workers=n_workers,
+                                   timeout=sdm_timeout, retries=sdm_retries, log_dir=log_dir)
+            if failed:
+                raise CommandError(', '.join(failed), 'non-zero')
+    add_stage('jackknife', "Running jack-knife", jackknife, command=jackknife_engine + ' jackknife ' + analysis_name,
+              table_columns=selection, depends=['pp'], outputs=[analysis_name + '_JK_'])
+
+    #  run and threshold meta-regressions - these only need the preprocessed files, so run alongside everything else
     regression_vars = metareg_columns
 
     for j in regression_vars:
         metareg_name = analysis_name + '_' + j
-        print "Running " + metareg_name
-        print shlex.split(sdm_path + ' ' + metareg_name + ' = lm ' + j + ', ' + filter_var)
-        subprocess.call(shlex.split(sdm_path + ' ' + metareg_name + ' = lm ' + j + ', ' + filter_var))
-        print "Thresholding " + metareg_name
-        subprocess.call(shlex.split(sdm_path + ' threshold ' + metareg_name + '_1m0_z' + ', p, 0.0005, 1, 10'))
+        lm_arg = metareg_name + ' = lm ' + j + ', ' + filter_var
+        add_stage('lm_' + j, "Running " + metareg_name, lambda arg=lm_arg, j=j: sdm(arg, 'lm_' + j), command=lm_arg,
+                  table_columns=selection + [j], depends=['pp'], outputs=[metareg_name + '_1m0'])
+        threshold_arg = 'threshold ' + metareg_name + '_1m0_z' + ', p, 0.0005, 1, 10'
+        add_stage('threshold_lm_' + j, "Thresholding " + metareg_name,
+                  lambda arg=threshold_arg, j=j: sdm(arg, 'threshold_lm_' + j), command=threshold_arg,
+                  depends=['lm_' + j], outputs=[metareg_name + '_1m0_z_p_'])
 
     #  threshold JKs
-    print "Thresholding jack-knife images"
-    threshold_jackknife(ma_dir, sdm_path)
+    if threshold_engine == 'numpy':  # only the niftis are needed for the jack-knife checks
+        threshold_jk = lambda: threshold_maps(sdm_map_pairs(ma_dir, r'.+JK.+(?<!QH)_z\.nii\.gz$'), 0.005, 1, 10,
+                                              n_workers=n_workers)
+    else:
+        def threshold_jk():
+            failed = threshold_jackknife(ma_dir, sdm_path, timeout=sdm_timeout, retries=sdm_retries,
+                                         log_dir=log_dir)
+            if failed:
+                raise CommandError('threshold ' + ', '.join(failed), 'non-zero')
+    add_stage('threshold_jackknife', "Thresholding jack-knife images", threshold_jk,
+              command=threshold_engine + ' p, 0.005, 1, 10', depends=['jackknife'],
+              outputs=[analysis_name + '_JK_'])
 
     #  extract peaks from mean and meta-regressions
-    print "Extracting peak coordinates from mean analysis and meta-regressions"
-    mean_coords = get_coords(ma_dir + analysis_name + '_mean_z_p_0.00500_1.000_10.htm')
-    extract_coordinate_values(mean_coords, analysis_name + ' _mean', sdm_path)
-
-    for j in regression_vars:
-        metareg_name = analysis_name + '_' + j
-        print "Extracting peak coordinates from " + metareg_name
-        coords = get_coords(ma_dir + metareg_name + '_1m0_z_p_0.00050_1.000_10.htm')
-        extract_coordinate_values(coords, metareg_name, sdm_path)
+    def extract():
+        coords = {analysis_name + '_mean': get_coords(ma_dir + analysis_name + '_mean_z_p_0.00500_1.000_10.htm')}
+        for j in regression_vars:
+            metareg_name = analysis_name + '_' + j
+            coords[metareg_name] = get_coords(ma_dir + metareg_name + '_1m0_z_p_0.00050_1.000_10.htm')
+        extract_all_coordinate_values(coords, ma_dir, sdm_path, n_workers=n_workers,
+                                      out_file=analysis_name + '_extracted_values.csv',
+                                      store=extract_store, timeout=sdm_timeout, retries=sdm_retries,
+                                      log_dir=log_dir)
+
+    add_stage('extract', "Extracting peak coordinates from mean analysis and meta-regressions", extract,
+              command=str(sorted(regression_vars)),
+              depends=['threshold_mean'] + ['threshold_lm_' + j for j in regression_vars],
+              outputs=['extract_', analysis_name + '_extracted_values', analysis_name + '_mean_coords_'] +
+                      [analysis_name + '_' + j + '_coords_' for j in regression_vars])
+
+    #  random-effects models and Egger's tests of the extracted values, for funnel plots and small-study bias
+    add_stage('random_effects', "Fitting random-effects models and Egger's tests to extracted values",
+              lambda: cluster_meta_analyses(ma_dir + analysis_name + '_extracted_values.csv',
+                                            csv_name=analysis_name + '_random_effects.csv'),
+              depends=['extract'], outputs=[analysis_name + '_random_effects'])
 
     #  check jack-knife and meta-regressions
     mean_niftis = [ma_dir + analysis_name + '_mean_z_p_0.00500_1.000_10.nii.gz',
                    ma_dir + analysis_name + '_mean_z_p_0.00500_1.000_10_neg.nii.gz']
     qh_niftis = [ma_dir + analysis_name + '_mean_QH_z_p_0.00500_1.000_10.nii.gz',
                  ma_dir + analysis_name + '_mean_QH_z_p_0.00500_1.000_10.nii.gz']
-
-    print "Checking jackknife output against mean"
-    jackknife_check_output = check_jk_niftis(mean_niftis, ma_dir, csv_name=analysis_name + '_JK_check.csv')
-
-
-    print "Checking meta-regression outputs against mean"
-    metareg_mean_check_output = check_jk_niftis(mean_niftis, ma_dir, regex=r'^.+(?=_1m0)',
-                                                csv_name=analysis_name + '_mean_metareg_check.csv', metareg=True)
-    print "Checking meta-regression outputs against heterogeneity"
-    metareg_qh_check_output = check_jk_niftis(qh_niftis, ma_dir, regex=r'^.+(?=_1m0)',
-                                              csv_name=analysis_name + '_QH_metareg_check.csv', metareg=True)
+    metareg_thresholds = ['threshold_lm_' + j for j in regression_vars]
+
+    #  the checks run one after another, as each one may start its own pool of processes - each one lists the
+    #  outputs itself when it starts, as meta-regressions may have finished since the check before it did
+    def check(mean, **kwargs):
+        check_jk_niftis(mean, ma_dir, n_workers=n_workers, **kwargs)
+
+    add_stage('check_jackknife', "Checking jackknife output against mean",
+              lambda: check(mean_niftis, csv_name=analysis_name + '_JK_check.csv'),
+              depends=['threshold_mean', 'threshold_jackknife'], outputs=[analysis_name + '_JK_check'])
+    add_stage('check_metareg_mean', "Checking meta-regression outputs against mean",
+              lambda: check(mean_niftis, regex=r'^.+(?=_1m0)', csv_name=analysis_name + '_mean_metareg_check.csv',
+                            metareg=True),
+              depends=['threshold_mean'] + metareg_thresholds, after=['check_jackknife'],
+              outputs=[analysis_name + '_mean_metareg_check'])
+    add_stage('check_metareg_qh', "Checking meta-regression outputs against heterogeneity",
+              lambda: check(qh_niftis, regex=r'^.+(?=_1m0)', csv_name=analysis_name + '_QH_metareg_check.csv',
+                            metareg=True),
+              depends=['threshold_mean'] + metareg_thresholds, after=['check_metareg_mean'],
+              outputs=[analysis_name + '_QH_metareg_check'])
+
+    previous_sidecar_dir = use_sidecar_store(sidecar_dir) if sidecar_dir else None
+    try:
+        graph.run(max_workers=max_concurrent or n_workers)
+    finally:
+        if sidecar_dir:
+            use_sidecar_store(previous_sidecar_dir)
+        manifest.report()
+        summary()
+        if trace_file:
+            write_trace(trace_file)
 
 """
 ma_dir1 = 'C:/Users/k1327409/Documents/VBShare/script_test/Analysis_0901/'